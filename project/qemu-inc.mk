@@ -79,6 +79,24 @@ QEMU_PY := $(BUILDDIR)/qemu.py
 QEMU_ERROR_PY := $(BUILDDIR)/qemu_error.py
 QEMU_OPTIONS_PY := $(BUILDDIR)/qemu_options.py
 
+# Helper modules imported by qemu.py, copied under their own names
+QEMU_HELPER_PYS := \
+	$(BUILDDIR)/qemu_boot_timeline.py \
+	$(BUILDDIR)/qemu_console.py \
+	$(BUILDDIR)/qemu_core_dump.py \
+	$(BUILDDIR)/qemu_isolation.py \
+	$(BUILDDIR)/qemu_log_store.py \
+	$(BUILDDIR)/qemu_memory.py \
+	$(BUILDDIR)/qemu_metrics.py \
+	$(BUILDDIR)/qemu_prefetch.py \
+	$(BUILDDIR)/qemu_profiler.py \
+	$(BUILDDIR)/qemu_registry.py \
+	$(BUILDDIR)/qemu_sampler.py \
+	$(BUILDDIR)/qemu_setup.py \
+	$(BUILDDIR)/qemu_test_db.py \
+	$(BUILDDIR)/qemu_trace.py \
+	$(BUILDDIR)/qemu_watchdog.py \
+
 $(ATF_OUT_DIR):
 	mkdir -p $@
 
@@ -109,7 +127,8 @@ $(ATF_OUT_DIR)/RPMB_DATA: $(RPMB_DEV)
 QEMU_SCRIPTS := \
 	$(QEMU_PY) \
 	$(QEMU_ERROR_PY) \
-	$(QEMU_OPTIONS_PY)
+	$(QEMU_OPTIONS_PY) \
+	$(QEMU_HELPER_PYS) \
 
 $(QEMU_SCRIPTS): .PHONY
 EXTRA_BUILDDEPS += $(QEMU_SCRIPTS)
@@ -130,6 +149,11 @@ $(QEMU_OPTIONS_PY): $(PROJECT_QEMU_INC_LOCAL_DIR)/qemu/qemu_arm64_options.py
 	@echo copying $@
 	@cp $< $@
 
+# Copied so that the resulting build tree contains all files needed to run
+$(QEMU_HELPER_PYS): $(BUILDDIR)/% : $(PROJECT_QEMU_INC_LOCAL_DIR)/qemu/%
+	@echo copying $@
+	@cp $< $@
+
 # Copy Android prebuilts into the build directory so that the build does not
 # depend on any files in the source tree. We want to package the build artifacts
 # without any dependencies on the sources.
@@ -193,11 +217,15 @@ $(RUN_SCRIPT): $(QEMU_SCRIPTS) $(QEMU_CONFIG)
 
 EXTRA_BUILDDEPS += $(RUN_SCRIPT)
 
-# Create a script to stop all stale emulators.
-$(STOP_SCRIPT):
+# Create a script to stop emulators through the instance registry. By default
+# it reaps the emulators, rpmb daemons and temp files left behind by runners
+# that died; "stop ID..." or "stop --all" terminates specific instances.
+$(STOP_SCRIPT): $(QEMU_SCRIPTS)
 	@echo generating $@
 	@echo "#!/bin/sh" >$@
-	@echo 'killall qemu-system-aarch64' >>$@
+	@echo 'SCRIPT_DIR=$$(dirname "$$0")' >>$@
+	@echo 'if [ $$# -eq 0 ]; then set -- reap; fi' >>$@
+	@echo 'python2.7 "$$SCRIPT_DIR/qemu_registry.py" "$$@"' >>$@
 	@chmod +x $@
 
 EXTRA_BUILDDEPS += $(STOP_SCRIPT)
@@ -236,6 +264,7 @@ QEMU_BIN :=
 QEMU_BUILD_BASE :=
 QEMU_CONFIG :=
 QEMU_ERROR_PY :=
+QEMU_HELPER_PYS :=
 QEMU_OPTIONS_PY :=
 QEMU_PY :=
 QEMU_SCRIPTS :=
@@ -22,8 +22,12 @@
 # QEMU_PACKAGE_EXTRA_FILES: additional files and folders to include in the
 # 		package archive, which are not make targets. These files must be created
 # 		by a target in QEMU_PACKAGE_FILES.
+# QEMU_PACKAGE_BASE: optional previous chunked package. If set, the chunked
+# 		package only stores what changed since then, and is applied to a copy
+# 		of the previous package with "qemu_package.py update".
 
 QEMU_PACKAGE_ZIP := $(BUILDDIR)/trusty_qemu_package.zip
+QEMU_PACKAGE_DIR := $(BUILDDIR)/trusty_qemu_package
 QEMU_PACKAGE_LICENSE := $(BUILDDIR)/LICENSE
 
 QEMU_PACKAGE_LICENSE_FILES := \
@@ -59,9 +63,28 @@ $(QEMU_PACKAGE_ZIP): $(QEMU_PACKAGE_FILES)
 
 EXTRA_BUILDDEPS += $(QEMU_PACKAGE_ZIP)
 
+# Same contents, split into deduplicated chunks, so that consumers can fetch
+# only what changed and extract only what their config.json needs (see
+# qemu/qemu_package.py). Its "run" script extracts and runs the build.
+$(QEMU_PACKAGE_DIR): LOCAL_DIR := $(GET_LOCAL_DIR)
+$(QEMU_PACKAGE_DIR): BUILDDIR := $(BUILDDIR)
+$(QEMU_PACKAGE_DIR): QEMU_PACKAGE_EXTRA_FILES := $(QEMU_PACKAGE_EXTRA_FILES)
+$(QEMU_PACKAGE_DIR): QEMU_PACKAGE_BASE := $(QEMU_PACKAGE_BASE)
+$(QEMU_PACKAGE_DIR): $(QEMU_PACKAGE_FILES)
+	@echo Creating chunked QEMU package
+	$(NOECHO)rm -rf $@
+	$(NOECHO)python2.7 $(LOCAL_DIR)/qemu/qemu_package.py create $@ \
+		--root $(BUILDDIR) \
+		$(if $(QEMU_PACKAGE_BASE),--base $(QEMU_PACKAGE_BASE)) \
+		$(subst $(BUILDDIR)/,,$^ $(QEMU_PACKAGE_EXTRA_FILES))
+
+EXTRA_BUILDDEPS += $(QEMU_PACKAGE_DIR)
+
 QEMU_PACKAGE_CONFIG :=
 QEMU_PACKAGE_FILES :=
 QEMU_PACKAGE_EXTRA_FILES :=
 QEMU_PACKAGE_LICENSE :=
 QEMU_PACKAGE_LICENSE_FILES :=
 QEMU_PACKAGE_ZIP :=
+QEMU_PACKAGE_DIR :=
+QEMU_PACKAGE_BASE :=
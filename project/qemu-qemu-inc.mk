@@ -59,6 +59,10 @@ QEMU_AOSP_DISABLES := \
             --disable-vhdx \
             --disable-vhost-net \
 
+# The simple trace backend writes the binary traces decoded by qemu_trace.py;
+# the log backend keeps "-d trace:..." working alongside it. qemu.py only
+# passes "-trace" when trace events are chosen, as the option also redirects
+# the log backend's output.
 $(QEMU_MAKEFILE): QEMU_ROOT:=$(QEMU_ROOT)
 $(QEMU_MAKEFILE): QEMU_BUILD_BASE:=$(QEMU_BUILD_BASE)
 $(QEMU_MAKEFILE): QEMU_TARGET:=$(QEMU_TARGET)
@@ -72,7 +76,8 @@ $(QEMU_MAKEFILE):
 	# some hosts compiler will complain about stringop truncation.
 	cd $(QEMU_BUILD_BASE) && $(abspath $(QEMU_ROOT)/configure) \
 		--target-list=$(QEMU_TARGET) --with-git=true --disable-werror \
-		--disable-gcrypt --disable-vnc-png $(QEMU_AOSP_DISABLES)
+		--disable-gcrypt --disable-vnc-png $(QEMU_AOSP_DISABLES) \
+		--enable-trace-backends=log,simple
 
 $(QEMU_BIN): QEMU_BUILD_BASE:=$(QEMU_BUILD_BASE)
 $(QEMU_BIN): $(QEMU_MAKEFILE) .PHONY
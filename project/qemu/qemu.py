@@ -3,9 +3,25 @@
 import argparse
 import errno
 import fcntl
+import hashlib
 import json
 import os
+import Queue
+import qemu_boot_timeline
+import qemu_console
+import qemu_core_dump
+import qemu_isolation
+import qemu_log_store
+import qemu_metrics
 import qemu_options
+import qemu_prefetch
+import qemu_profiler
+import qemu_registry
+import qemu_sampler
+import qemu_setup
+import qemu_test_db
+import qemu_trace
+import qemu_watchdog
 import re
 import select
 import socket
@@ -22,6 +38,8 @@ from qemu_error import AdbFailure, ConfigError, RunnerGenericError, RunnerError,
 # ADB expects its first console on 5554, and control on 5555
 ADB_BASE_PORT = 5554
 
+# Shell tests starting with this prefix never run concurrently with others
+SERIAL_TEST_PREFIX = "serial:"
 
 class Config(object):
     """Stores a QEMU configuration for use with the runner
@@ -62,10 +80,40 @@ class Config(object):
         self.rpmbd = os.path.join(script_dir, config_dict.get("rpmbd"))
         self.arch = config_dict.get("arch")
         self.extra_qemu_flags = config_dict.get("extra_qemu_flags", [])
+        # Paths as given, relative to the config, identify the build
+        # wherever the workspace or package lives
+        self.config_paths = [config_dict.get(name) for name in
+                             ["atf", "qemu", "linux", "android"]]
+
+    def key(self):
+        """Returns a short string identifying this configuration
+
+        Different builds (e.g. arm32 and arm64, or gicv2 and gicv3 projects)
+        get different keys, so state recorded per configuration does not mix
+        between them. The same build keeps its key when its workspace is
+        moved or packaged.
+        """
+        ident = json.dumps([self.arch, self.linux_arch] + self.config_paths +
+                           [self.extra_qemu_flags])
+        return hashlib.sha1(ident).hexdigest()[:16]
+
+
+def is_serial_test(android_test):
+    return android_test.startswith(SERIAL_TEST_PREFIX)
+
 
+def shell_command(android_test):
+    """Returns the command of a shell test, without its serial marker"""
+    if is_serial_test(android_test):
+        return android_test[len(SERIAL_TEST_PREFIX):]
+    return android_test
 
-def alloc_ports():
-    """Allocates 2 sequential ports above 5554 for adb"""
+
+def alloc_ports(metrics=None):
+    """Allocates 2 sequential ports above 5554 for adb
+
+    Pairs skipped because a port was in use are counted in metrics.
+    """
     # adb uses ports in pairs
     PORT_WIDTH = 2
 
@@ -88,6 +136,8 @@ def alloc_ports():
         # We could increment by only 1, but if we are competing with other
         # adb sessions for ports, this will be more polite
         min_port += PORT_WIDTH
+        if metrics:
+            metrics.inc("port_alloc_retries")
 
 
 def forward_ports(ports):
@@ -118,6 +168,8 @@ class QEMUCommandPipe(object):
         ]
         self.com_pipe_in = None
         self.com_pipe_out = None
+        # Serializes commands from the runner and its sampling threads
+        self.lock = threading.Lock()
 
     def open(self):
         self.com_pipe_in = open("%s/com.in" % self.command_dir, "w", 0)
@@ -150,6 +202,10 @@ class QEMUCommandPipe(object):
     def qmp_command(self, qmp_command):
         """Send a qmp command and return result."""
 
+        with self.lock:
+            return self._qmp_command(qmp_command)
+
+    def _qmp_command(self, qmp_command):
         try:
             json.dump(qmp_command, self.com_pipe_in)
             for line in iter(self.com_pipe_out.readline, ""):
@@ -185,15 +241,25 @@ class QEMUCommandPipe(object):
             sys.stderr.write(res["return"])
 
 
-def qemu_handle_error(command_pipe, debug_on_error):
-    """Dump registers and/or wait for debugger."""
+def qemu_handle_error(command_pipe, debug_on_error, core_dumper=None):
+    """Dump registers and/or wait for debugger.
+
+    If a core_dumper is given, guest memory is dumped in the background
+    while registers are dumped.
+    """
 
     sys.stdout.flush()
 
+    if core_dumper:
+        core_dumper.start(command_pipe)
+
     sys.stderr.write("QEMU register dump:\n")
     command_pipe.monitor_command("info registers -a")
     sys.stderr.write("\n")
 
+    if core_dumper:
+        core_dumper.wait()
+
     if debug_on_error:
         command_pipe.monitor_command("gdbserver")
         print "Connect gdb, press enter when done "
@@ -201,7 +267,8 @@ def qemu_handle_error(command_pipe, debug_on_error):
         raw_input("\n")
 
 
-def qemu_exit(command_pipe, qemu_proc, has_error, debug_on_error):
+def qemu_exit(command_pipe, qemu_proc, has_error, debug_on_error,
+              core_dumper=None):
     """Ensures QEMU is terminated"""
     unclean_exit = False
 
@@ -211,7 +278,8 @@ def qemu_exit(command_pipe, qemu_proc, has_error, debug_on_error):
             try:
                 if has_error:
                     qemu_handle_error(command_pipe=command_pipe,
-                                      debug_on_error=debug_on_error)
+                                      debug_on_error=debug_on_error,
+                                      core_dumper=core_dumper)
                 command_pipe.qmp_execute("quit")
             except OSError:
                 pass
@@ -251,7 +319,37 @@ class Runner(object):
                  rpmb=True,
                  debug=False,
                  debug_on_error=False,
-                 timeout=None):
+                 timeout=None,
+                 test_db=None,
+                 test_order="given",
+                 shard=None,
+                 shard_cutoff=None,
+                 state_dir=None,
+                 log_dir=None,
+                 sample_interval=None,
+                 profile_rate=None,
+                 profile_elfs=None,
+                 core_dump=False,
+                 core_dump_budget=None,
+                 stall_timeout=None,
+                 shell_parallel=1,
+                 pin_cpus=False,
+                 cgroup_parent=None,
+                 cpu_quota=None,
+                 memory_limit=None,
+                 memory_backend=None,
+                 hugepages=False,
+                 mem_path=None,
+                 boot_profile="default",
+                 boot_timeline=False,
+                 prefetch=False,
+                 prefetch_profile=None,
+                 metrics_textfile=None,
+                 metrics_port=None,
+                 trace_events=None,
+                 trace_pairs=None,
+                 trace_key_arg=None,
+                 trace_cpu_arg=None):
         """Initializes the runner with provided settings.
 
         See .run() for the meanings of these.
@@ -274,6 +372,55 @@ class Runner(object):
         self.dump_stdout_on_error = False
         self.qemu_arch_options = None
         self.test_timeout = DEFAULT_TIMEOUT if timeout is None else timeout
+        self.test_db = test_db
+        self.test_order = test_order
+        self.shard = shard
+        self.shard_cutoff = shard_cutoff
+        self.state_dir = (qemu_registry.default_state_dir()
+                          if state_dir is None else state_dir)
+        self.instance = None
+        # QEMU runs in the ATF directory, so paths handed to it, e.g. for
+        # core dumps, must not be relative to ours
+        self.log_dir = os.path.abspath(log_dir) if log_dir else None
+        self.console_mux = None
+        self.console_tmp_dir = None
+        self.sample_interval = sample_interval
+        self.sampler = None
+        self.profile_rate = profile_rate
+        self.profile_elfs = profile_elfs if profile_elfs else []
+        self.profiler = None
+        self.gdb_sock_dir = None
+        self.core_dump = core_dump
+        self.core_dump_budget = core_dump_budget
+        self.core_dumper = None
+        self.stall_timeout = stall_timeout
+        self.shell_parallel = shell_parallel
+        self.qemu_pid = None
+        self.vcpu_threads = {}
+        self.pin_cpus = pin_cpus
+        self.cgroup_parent = cgroup_parent
+        self.cpu_quota = cpu_quota
+        self.memory_limit = memory_limit
+        self.pinning = None
+        self.cgroup = None
+        self.memory_backend = memory_backend
+        self.hugepages = hugepages
+        self.mem_path = mem_path
+        self.boot_timeline = (qemu_boot_timeline.BootTimeline()
+                              if boot_timeline else None)
+        self.prefetch = prefetch
+        self.prefetch_profile = prefetch_profile
+        self.prefetcher = None
+        self.metrics = qemu_metrics.Metrics()
+        self.metrics_textfile = metrics_textfile
+        self.metrics_port = metrics_port
+        self.metrics_server = None
+        self.launch_time = None
+        self.trace_events = trace_events if trace_events else []
+        self.trace_pairs = dict(trace_pairs) if trace_pairs else {}
+        self.trace_key_arg = trace_key_arg
+        self.trace_cpu_arg = trace_cpu_arg
+        self.trace_path = None
 
         # Python 2.7 does not have subprocess.DEVNULL, emulate it
         devnull = open(os.devnull, "r+")
@@ -292,8 +439,17 @@ class Runner(object):
         else:
             self.stdin = devnull
 
+        # Console and test output is kept in an indexed store in log_dir,
+        # opened by run()
+        self.log_store = None
+        self.squelched_stdout = None
+        self.stdout_start = 0
+
         if self.config.arch == 'arm64' or self.config.arch == 'arm':
-            self.qemu_arch_options = qemu_options.QemuArm64Options(self.config)
+            self.qemu_arch_options = qemu_options.QemuArm64Options(
+                self.config, memory_backend=memory_backend,
+                hugepages=hugepages, mem_path=mem_path,
+                boot_profile=boot_profile)
         elif self.config.arch == 'x86_64':
             self.qemu_arch_options = qemu_options.QemuX86_64Options(self.config)
         else:
@@ -317,13 +473,104 @@ c
         if self.dump_stdout_on_error:
             sys.stdout.flush()
             sys.stderr.write("System log:\n")
-            self.stdout.seek(0)
+            self.stdout.seek(self.stdout_start)
             sys.stderr.write(self.stdout.read())
 
+    def schedule_tests(self, tests):
+        """Selects this shard's shell tests and orders them as configured
+
+        Boot tests are not scheduled: test-runner gets them as one string,
+        so they run as a unit, in the first shard.
+        """
+        if self.shard:
+            index, count = self.shard
+            estimates = None
+            if self.test_db:
+                cutoff = self.shard_cutoff
+                if cutoff is None:
+                    cutoff = qemu_test_db.day_start(time.time())
+                estimates = self.test_db.shard_estimates(
+                    self.config.key(), "shell", tests, cutoff)
+            tests = qemu_test_db.shard(tests, index, count, estimates)
+        if self.test_db and self.test_order == "longest":
+            tests = self.test_db.longest_first(self.config.key(), "shell",
+                                               tests)
+        return tests
+
+    def test_begin(self, kind, test):
+        """Marks the start of a test, returning its start time"""
+        if self.log_store:
+            self.log_store.begin(test, kind)
+        if self.sampler:
+            self.sampler.mark("begin", test, kind)
+        return time.time()
+
+    def test_end(self, kind, test, start, result):
+        """Indexes a finished test's output and records its duration"""
+        if self.log_store:
+            self.log_store.end(test, kind, result)
+        if self.sampler:
+            self.sampler.mark("end", test, kind)
+        self.record_duration(kind, test, start, result)
+
+    def record_duration(self, kind, test, start, result):
+        """Stores how long a test took in the duration database"""
+        # Per test durations are in the duration database; a test label
+        # would make a series of every test ever run
+        self.metrics.observe("test_seconds", time.time() - start, kind=kind,
+                             result="pass" if result == 0 else "fail")
+        # Timings of debugged or interactive runs say nothing about the test
+        if self.test_db and not self.debug and not self.interactive:
+            self.test_db.record(self.config.key(), kind, test,
+                                time.time() - start, result)
+
+    def register_process(self, name, proc):
+        """Records a process in the instance registry, for reaping"""
+        if self.instance:
+            self.instance.add_process(name, proc.pid)
+
+    def register_path(self, path):
+        """Records a temporary file or directory in the instance registry"""
+        if self.instance:
+            self.instance.add_path(path)
+
+    def log_store_up(self):
+        """Opens the indexed store of console and test output, if any"""
+        if not self.log_dir:
+            return
+        self.log_store = qemu_log_store.LogStore(self.log_dir)
+        self.log_store.stream("test")
+        if self.dump_stdout_on_error:
+            self.squelched_stdout = self.stdout
+            self.stdout = self.log_store.stream("console")
+
+    def log_store_down(self):
+        if self.log_store:
+            self.log_store.close()
+            self.log_store = None
+        if self.squelched_stdout:
+            self.stdout = self.squelched_stdout
+            self.squelched_stdout = None
+
+    def instance_up(self):
+        """Reaps instances leaked by dead runners and registers this one"""
+        for instance in qemu_registry.reap(self.state_dir):
+            print "Reaped leaked instance %s" % instance.record["id"]
+        self.instance = qemu_registry.Instance.create(self.state_dir)
+        if self.log_store:
+            self.log_store.run = self.instance.record["id"]
+
+    def instance_down(self):
+        """Drops this runner's registry record after cleaning up"""
+        if self.instance:
+            self.instance.remove()
+            self.instance = None
+
     def get_qemu_arg_temp_file(self):
         """Returns a temp file that will be deleted after qemu exits."""
         tmp = tempfile.NamedTemporaryFile(delete=False)
         self.temp_files.append(tmp.name)
+        self.register_path(tmp.name)
         return tmp
 
     def rpmb_up(self):
@@ -331,11 +578,15 @@ c
         rpmb_data = self.qemu_arch_options.rpmb_data_path()
 
         self.rpmb_sock_dir = tempfile.mkdtemp()
+        self.register_path(self.rpmb_sock_dir)
         rpmb_sock = "%s/rpmb" % self.rpmb_sock_dir
+        # Other setup steps run concurrently; keep their pipes from leaking
+        # into the daemon
         rpmb_proc = subprocess.Popen([self.config.rpmbd,
                                       "-d", rpmb_data,
-                                      "--sock", rpmb_sock])
+                                      "--sock", rpmb_sock], close_fds=True)
         self.rpmb_proc = rpmb_proc
+        self.register_process("rpmbd", rpmb_proc)
 
         # Wait for RPMB socket to appear to avoid a race with QEMU
         test_sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
@@ -362,6 +613,409 @@ c
             shutil.rmtree(self.rpmb_sock_dir)
             self.rpmb_sock_dir = None
 
+    def console_up(self):
+        """Starts collecting the secure consoles, returning QEMU args
+
+        Without a log dir, the consoles of an interactive run are logged
+        under the state dir while it runs, so the user can still follow
+        them. Those logs are removed with the instance.
+        """
+        console_dir = self.log_dir
+        if self.interactive and not console_dir and self.instance:
+            console_dir = os.path.join(self.state_dir, "consoles",
+                                       self.instance.record["id"])
+            os.makedirs(console_dir)
+            self.register_path(console_dir)
+            self.console_tmp_dir = console_dir
+        self.console_mux = qemu_console.ConsoleMux(
+            self.qemu_arch_options.console_sources(), console_dir)
+        self.register_path(self.console_mux.sock_dir)
+        self.console_mux.start()
+
+        if self.log_store:
+            for source in self.console_mux.sources():
+                self.log_store.track(source)
+
+        if self.interactive and console_dir:
+            for source in self.console_mux.sources():
+                print "Console %s is logged to %s" % (
+                    source, self.console_mux.log_path(source))
+
+        return self.qemu_arch_options.console_options(
+            dict((source, self.console_mux.path(source))
+                 for source in self.console_mux.sources()))
+
+    def console_down(self):
+        if self.console_mux:
+            self.console_mux.stop()
+            self.console_mux = None
+        if self.console_tmp_dir:
+            shutil.rmtree(self.console_tmp_dir, ignore_errors=True)
+            self.console_tmp_dir = None
+
+    def sampler_up(self, command_pipe, qemu_proc):
+        """Starts sampling resource usage, if configured"""
+        if not self.sample_interval:
+            return
+        run = self.instance.record["id"] if self.instance else None
+        self.sampler = qemu_sampler.ResourceSampler(
+            command_pipe, qemu_proc.pid, self.sample_interval,
+            os.path.join(self.log_dir, "samples.jsonl"), run=run)
+        self.sampler.start()
+
+    def sampler_down(self):
+        """Stops sampling; must happen before QEMU is asked to quit"""
+        sampler = self.sampler
+        self.sampler = None
+        if sampler:
+            sampler.stop()
+
+    def profiler_args(self):
+        """Returns QEMU args exposing a gdbstub for the profiler"""
+        if not self.profile_rate:
+            return []
+        self.gdb_sock_dir = tempfile.mkdtemp()
+        self.register_path(self.gdb_sock_dir)
+        return ["-gdb", "unix:%s/gdb,server,nowait" % self.gdb_sock_dir]
+
+    def profiler_up(self):
+        """Starts sampling guest PCs once QEMU has been launched"""
+        if not self.profile_rate:
+            return
+        pc_reg, lr_reg = qemu_profiler.REGISTERS[self.config.arch]
+        self.profiler = qemu_profiler.GuestProfiler(
+            "%s/gdb" % self.gdb_sock_dir, self.profile_rate,
+            qemu_profiler.Symbolizer(self.profile_elfs),
+            os.path.join(self.log_dir, "profile.folded"), pc_reg, lr_reg)
+        self.profiler.start()
+
+    def profiler_down(self):
+        """Stops the profiler, leaving the guest running, and saves it"""
+        profiler = self.profiler
+        self.profiler = None
+        if profiler:
+            profiler.stop()
+            print "Profile of %d samples written to %s" % (profiler.samples,
+                                                          profiler.out_path)
+            if profiler.error:
+                print "Profiler stopped early: %s" % profiler.error
+        if self.gdb_sock_dir:
+            shutil.rmtree(self.gdb_sock_dir)
+            self.gdb_sock_dir = None
+
+    def trace_args(self):
+        """Returns QEMU args recording the chosen trace events, if any
+
+        QEMU must be built with the simple trace backend. The events and the
+        trace are kept in log_dir, named after the instance; log_dir is
+        absolute, as QEMU runs in the ATF directory. Without events, no
+        -trace option is passed: it would send the -d log to the trace
+        file with the log backend, and QEMU rejects it without a backend
+        that writes files.
+        """
+        if not self.trace_events:
+            return []
+        name = "trace"
+        if self.instance:
+            name = "trace-%s" % self.instance.record["id"]
+        events_path = os.path.join(self.log_dir, "%s.events" % name)
+        with open(events_path, "w") as events_file:
+            events_file.write("\n".join(self.trace_events) + "\n")
+        self.trace_path = os.path.join(self.log_dir, "%s.bin" % name)
+        return ["-trace", "events=%s,file=%s" % (events_path,
+                                                 self.trace_path)]
+
+    def trace_down(self):
+        """Reports call latencies in the trace; QEMU must have exited"""
+        trace_path = self.trace_path
+        self.trace_path = None
+        if not trace_path:
+            return
+        if not os.path.exists(trace_path):
+            sys.stderr.write("Warning: QEMU wrote no trace to %s; is it "
+                             "built with the simple trace backend?\n" %
+                             trace_path)
+            return
+        # The QEMU build lists the argument types of its events here
+        formats_path = None
+        qemu_dir = os.path.dirname(self.config.qemu)
+        for directory in [qemu_dir, os.path.dirname(qemu_dir)]:
+            if os.path.exists(os.path.join(directory, "trace-events-all")):
+                formats_path = os.path.join(directory, "trace-events-all")
+                break
+        try:
+            analyzer = qemu_trace.analyze(
+                trace_path, self.trace_pairs, self.trace_key_arg,
+                self.trace_cpu_arg, formats_path=formats_path)
+        except qemu_trace.TraceError as exn:
+            print "Cannot decode %s: %s" % (trace_path, exn)
+            return
+        analyzer.report(sys.stdout)
+        with open(os.path.splitext(trace_path)[0] + ".json",
+                  "w") as report_file:
+            json.dump(analyzer.to_dict(), report_file, indent=2,
+                      sort_keys=True)
+
+    def core_dumper_up(self, qemu_cmd):
+        """Prepares dumping guest memory on error, if configured"""
+        if not self.core_dump:
+            return
+        DEFAULT_BUDGET = 512 * 1024 * 1024
+        name = "core-%d" % time.time()
+        if self.instance:
+            name = "core-%s" % self.instance.record["id"]
+        self.core_dumper = qemu_core_dump.CoreDumper(
+            os.path.join(self.log_dir, "cores"), name,
+            DEFAULT_BUDGET if self.core_dump_budget is None
+            else self.core_dump_budget,
+            self.qemu_arch_options.image_paths(),
+            self.qemu_arch_options.MEMORY_MB * 1024 * 1024)
+        self.core_dumper.qemu_cmd = qemu_cmd
+
+    def guest_up(self, command_pipe, qemu_proc):
+        """Looks up the QEMU threads running the guest's vCPUs"""
+        self.qemu_pid = qemu_proc.pid
+        self.vcpu_threads = qemu_sampler.vcpu_threads(command_pipe)
+
+    def guest_cpu_seconds(self):
+        """Returns the CPU time the guest's vCPUs have used so far"""
+        return sum(qemu_sampler.thread_cpu_seconds(self.qemu_pid, tid)
+                   for tid in self.vcpu_threads.values())
+
+    def isolation_up(self, qemu_proc):
+        """Pins the guest's threads and limits its resources, if configured
+
+        QEMU and the rpmb daemon go into a cgroup of their own under
+        cgroup_parent. With pin_cpus, the QEMU main loop and the rpmb daemon
+        share one core and every vCPU gets another one, all claimed in the
+        instance registry so that concurrent runners use disjoint cores.
+        """
+        if not (self.pin_cpus or self.cgroup_parent):
+            return
+        helper_pids = [self.rpmb_proc.pid] if self.rpmb_proc else []
+        if self.cgroup_parent:
+            self.cgroup = qemu_isolation.Cgroup(
+                self.cgroup_parent,
+                "trusty-qemu-%s" % self.instance.record["id"])
+            self.register_path(self.cgroup.path)
+            self.cgroup.limit(self.cpu_quota, self.memory_limit)
+            for pid in [qemu_proc.pid] + helper_pids:
+                self.cgroup.add(pid)
+
+        self.pinning = qemu_isolation.Pinning(qemu_proc.pid,
+                                              self.vcpu_threads, helper_pids)
+        if not self.pin_cpus:
+            self.pinning.measure_start()
+            return
+        cpus = qemu_isolation.claim_cpus(self.state_dir, self.instance,
+                                         self.pinning.cpus_needed())
+        if cpus is None:
+            sys.stderr.write("Not enough free cores to pin %d vCPUs, "
+                             "running unpinned\n" % len(self.vcpu_threads))
+            self.pinning.measure_start()
+            return
+        self.pinning.pin(cpus)
+
+    def isolation_down(self):
+        """Reports the core assignment and vCPU scheduling jitter
+
+        Must happen before QEMU is asked to quit.
+        """
+        pinning = self.pinning
+        self.pinning = None
+        if not pinning:
+            return
+        report = pinning.report()
+        if report["assignment"]:
+            vcpus = report["assignment"]["vcpus"]
+            sys.stderr.write("Pinned QEMU main loop to cpu %d, vCPUs %s\n" % (
+                report["assignment"]["main"],
+                ", ".join("%d->cpu %d" % (index, cpu)
+                          for index, cpu in sorted(vcpus.items()))))
+        for index, stats in sorted(report["vcpus"].items()):
+            sys.stderr.write(
+                "vCPU %d: waited %.1fms for a core (%.2fms/s), %d "
+                "involuntary switches, %s migrations\n" % (
+                    index, stats["wait_ms"], stats["wait_ms_per_s"],
+                    stats["involuntary"],
+                    "?" if stats["migrations"] is None
+                    else stats["migrations"]))
+        if self.log_dir:
+            with open(os.path.join(self.log_dir, "isolation.json"),
+                      "w") as report_file:
+                json.dump(report, report_file, indent=2, sort_keys=True)
+
+    def cgroup_down(self):
+        """Removes the instance's cgroup once its processes are gone"""
+        if self.cgroup:
+            self.cgroup.remove()
+            self.cgroup = None
+
+    def boot_event(self, stage):
+        """Records that the guest reached a boot stage the runner observes"""
+        now = time.time()
+        if self.boot_timeline:
+            self.boot_timeline.event(stage, now)
+        if stage == "qemu":
+            self.launch_time = now
+            self.metrics.inc("boots")
+        elif self.launch_time:
+            self.metrics.observe("boot_seconds", now - self.launch_time,
+                                 stage=stage)
+        if self.prefetcher:
+            if stage == "qemu":
+                self.prefetcher.launched()
+            else:
+                self.prefetcher.reached(stage)
+
+    def metrics_up(self):
+        """Serves the run's metrics over HTTP, if a port is configured"""
+        if self.metrics_port:
+            self.metrics_server = qemu_metrics.MetricsServer(
+                self.metrics_port, self.metrics.render)
+            self.metrics_server.start()
+
+    def metrics_down(self, outcome):
+        """Counts the run and adds its metrics to the textfile, if any"""
+        self.metrics.inc("runs", outcome=outcome)
+        if self.metrics_server:
+            self.metrics_server.stop()
+            self.metrics_server = None
+        if self.metrics_textfile:
+            qemu_metrics.flush_textfile(self.metrics, self.metrics_textfile)
+
+    def prefetch_up(self):
+        """Starts loading the run's images into the page cache, if enabled"""
+        if not self.prefetch:
+            return
+        paths = self.qemu_arch_options.image_paths().values()
+        if self.use_rpmb:
+            paths += [self.config.rpmbd,
+                      self.qemu_arch_options.rpmb_data_path()]
+        profile = None
+        if self.prefetch_profile:
+            profile = qemu_prefetch.AccessProfile(self.prefetch_profile)
+        self.prefetcher = qemu_prefetch.Prefetcher(paths, profile)
+        self.prefetcher.start()
+
+    def prefetch_down(self):
+        """Reports what the prefetch saved; QEMU must have exited"""
+        prefetcher = self.prefetcher
+        self.prefetcher = None
+        if not prefetcher:
+            return
+        report = prefetcher.finish()
+        mib = 1024.0 * 1024
+        if report["learning"]:
+            sys.stderr.write("Prefetch skipped to learn what the run reads\n")
+        elif report["cold_at_launch"] is not None:
+            sys.stderr.write(
+                "Prefetched %.1f MiB of %d files, %.1f MiB of it cold, "
+                "%.1f MiB still cold when QEMU started\n" % (
+                    report["planned"] / mib, report["files"],
+                    report["cold"] / mib, report["cold_at_launch"] / mib))
+        stages = sorted(report["stages"].items(),
+                        key=lambda item: item[1]["seconds"])
+        for stage, times in stages:
+            sys.stderr.write("Boot to %s took %.2fs" % (stage,
+                                                        times["seconds"]))
+            if (times.get("prefetched") is not None and
+                    times.get("not_prefetched") is not None):
+                sys.stderr.write(
+                    "; median %.2fs prefetched, %.2fs not, %+.2fs" % (
+                        times["prefetched"], times["not_prefetched"],
+                        times["prefetched"] - times["not_prefetched"]))
+            sys.stderr.write("\n")
+        if self.log_dir:
+            with open(os.path.join(self.log_dir, "prefetch.json"),
+                      "w") as report_file:
+                json.dump(report, report_file, indent=2, sort_keys=True)
+
+    def boot_timeline_report(self, kernel_log=False):
+        """Reports the boot stages found so far, if configured
+
+        With kernel_log, the kernel stages are read from the guest's dmesg
+        over adb. Its uptime is read too, with the host time halfway through
+        the read, to place kernel log times on the host clock.
+        """
+        if not self.boot_timeline:
+            return
+        for source in self.console_mux.sources():
+            self.boot_timeline.add_console_log(
+                self.console_mux.log_path(source))
+        if kernel_log:
+            with tempfile.TemporaryFile() as uptime:
+                before = time.time()
+                self.check_adb(["shell", "cat /proc/uptime"], log=uptime)
+                when = (before + time.time()) / 2
+                uptime.seek(0)
+                guest_uptime = float(uptime.read().split()[0])
+            with tempfile.TemporaryFile() as dmesg:
+                self.check_adb(["shell", "dmesg"], log=dmesg)
+                dmesg.seek(0)
+                self.boot_timeline.add_kernel_log(dmesg.read(), guest_uptime,
+                                                  when)
+        self.boot_timeline.report(sys.stdout)
+        self.boot_timeline.write(os.path.join(self.log_dir,
+                                              "boot_timeline.json"))
+
+    def watchdog(self, timeout, on_expire, stall_timeout=None):
+        """Returns a watchdog for a test step, with progress probes
+
+        Console output, QEMU's own output and substantial guest CPU use
+        count as progress, besides what the caller pokes it with.
+        """
+        def expire(reason, limit):
+            self.metrics.inc("timeouts", reason=reason)
+            on_expire(reason, limit)
+
+        watchdog = qemu_watchdog.ProgressWatchdog(
+            timeout, expire, quiet_period=stall_timeout)
+        if not stall_timeout:
+            return watchdog
+        console_mux = self.console_mux
+        if console_mux:
+            watchdog.add_probe("console", lambda: console_mux.received)
+        if self.dump_stdout_on_error:
+            stdout_fd = self.stdout.fileno()
+            watchdog.add_probe("qemu output",
+                               lambda: os.fstat(stdout_fd).st_size)
+        if self.vcpu_threads:
+            # An idle guest still takes timer interrupts, so only count a
+            # quarter of a host CPU or more as activity
+            watchdog.add_probe("guest cpu", self.guest_cpu_seconds,
+                               min_rate=0.25)
+        return watchdog
+
+    def command_pipe_up(self):
+        """Creates the command channel used to quit QEMU after the tests"""
+        command_pipe = QEMUCommandPipe()
+        self.register_path(command_pipe.command_dir)
+        return command_pipe
+
+    def ports_up(self):
+        """Reserves the adb ports of the instance, returning them"""
+        ports = alloc_ports(self.metrics)
+        if self.instance:
+            self.instance.set_ports(ports)
+        return ports
+
+    def setup_report(self, setup):
+        """Reports when each setup step ran, and the critical path
+
+        The report is only printed if verbose; it is always written to
+        setup.json in log_dir.
+        """
+        for name, (start, end) in setup.times.items():
+            self.metrics.observe("setup_seconds", end - start, step=name)
+        if self.verbose:
+            setup.report(sys.stderr)
+        if self.log_dir and setup.finished:
+            with open(os.path.join(self.log_dir, "setup.json"),
+                      "w") as report_file:
+                json.dump(setup.to_dict(), report_file, indent=2,
+                          sort_keys=True)
+
     def msg_channel_up(self):
         """Create message channel between host and QEMU guest
 
@@ -373,6 +1027,7 @@ c
         """
 
         self.msg_sock_dir = tempfile.mkdtemp()
+        self.register_path(self.msg_sock_dir)
         msg_sock_file = "%s/msg" % self.msg_sock_dir
         self.msg_sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
         self.msg_sock.bind(msg_sock_file)
@@ -380,9 +1035,8 @@ c
         # Listen on message socket
         self.msg_sock.listen(1)
 
-        return ["-device",
-                "virtserialport,chardev=testrunner0,name=testrunner0",
-                "-chardev", "socket,id=testrunner0,path=%s" % msg_sock_file]
+        return self.qemu_arch_options.serial_port("testrunner0") + [
+            "-chardev", "socket,id=testrunner0,path=%s" % msg_sock_file]
 
     def msg_channel_down(self):
         if self.msg_sock_conn:
@@ -397,6 +1051,7 @@ c
 
         # Accept testrunner's connection request
         self.msg_sock_conn, _ = self.msg_sock.accept()
+        self.boot_event("testrunner")
 
     def msg_channel_send_msg(self, msg):
         """Send message to testrunner via testrunner0 port
@@ -424,7 +1079,6 @@ c
         """Run boot test cases"""
 
         has_error = False
-        result = 2
 
         if self.interactive:
             args = ["-serial", "mon:stdio"] + args
@@ -439,83 +1093,157 @@ c
 
         # Create command channel which used to quit QEMU after case execution
         command_pipe = QEMUCommandPipe()
+        self.register_path(command_pipe.command_dir)
         args += command_pipe.command_args
         cmd = [self.config.qemu] + args
 
         qemu_proc = subprocess.Popen(cmd, cwd=self.config.atf)
+        self.register_process("qemu", qemu_proc)
+        self.boot_event("qemu")
+        self.core_dumper_up(cmd)
 
         command_pipe.open()
+        self.guest_up(command_pipe, qemu_proc)
+        self.isolation_up(qemu_proc)
+        self.sampler_up(command_pipe, qemu_proc)
+        self.profiler_up()
         self.msg_channel_wait_for_connection()
+        self.boot_timeline_report()
 
-        def kill_testrunner():
+        def kill_testrunner(reason, limit):
+            self.profiler_down()
+            self.sampler_down()
+            self.isolation_down()
             self.msg_channel_down()
             unclean_exit = qemu_exit(command_pipe, qemu_proc,
                                      has_error=True,
-                                     debug_on_error=self.debug_on_error)
-            raise Timeout("Wait for boottest to complete", timeout)
-
-        kill_timer = threading.Timer(timeout, kill_testrunner)
+                                     debug_on_error=self.debug_on_error,
+                                     core_dumper=self.core_dumper)
+            if reason == "stalled":
+                raise Timeout("Wait for boottest progress", limit)
+            raise Timeout("Wait for boottest to complete", limit)
+
+        kill_timer = self.watchdog(timeout, kill_testrunner,
+                                   self.stall_timeout)
         if not self.debug:
             kill_timer.start()
 
-        testcase = "boottest " + "".join(self.boot_tests)
+        has_error = True
         try:
-            self.msg_channel_send_msg(testcase)
-
-            while True:
-                ret = self.msg_channel_recv()
-
-                # If connection is disconnected accidently by peer, for
-                # instance child QEMU process crashed, a message with length
-                # 0 would be received. We should drop this message, and
-                # indicate test framework that something abnormal happened.
-                if not len(ret):
-                    has_error = True
-                    break
-
-                # Print message to STDOUT. Since we might meet EAGAIN IOError
-                # when writting to STDOUT, use try except loop to catch EAGAIN
-                # and waiting STDOUT to be available, then try to write again.
-                def print_msg(msg):
-                    while True:
-                        try:
-                            sys.stdout.write(msg)
-                            break
-                        except IOError as e:
-                            if e.errno != errno.EAGAIN:
-                                RunnerGenericError("Failed to print message")
-                            select.select([], [sys.stdout], [])
-
-                # Please align message structure definition in testrunner.
-                if ord(ret[0]) == 0:
-                    print_msg(ret[2 : 2 + ord(ret[1])])
-                elif ord(ret[0]) == 1:
-                    result = ord(ret[1])
-                    break
-                else:
-                    # Unexpected type, return test result:TEST_FAILED
-                    has_error = True
-                    result = 1
-                    break
+            result, has_error = self.boottest_exchange(kill_timer)
         except:
             raise
         finally:
             kill_timer.cancel()
+            self.profiler_down()
+            self.sampler_down()
+            self.isolation_down()
             self.msg_channel_down()
             unclean_exit = qemu_exit(command_pipe, qemu_proc,
                                      has_error=has_error,
-                                     debug_on_error=self.debug_on_error)
+                                     debug_on_error=self.debug_on_error,
+                                     core_dumper=self.core_dumper)
+            # The Timeout raised by kill_testrunner in the watchdog thread
+            # takes precedence over the errors the kill caused here
+            kill_timer.check()
 
         if unclean_exit:
+            self.metrics.inc("unclean_exits")
             raise RunnerGenericError("QEMU did not exit cleanly")
 
         return result
 
+    def boottest_exchange(self, kill_timer):
+        """Runs boot_tests over the message channel of a booted test-runner
+
+        Returns the test result and whether the exchange itself failed.
+        """
+        has_error = False
+        result = 2
+
+        testcase = "boottest " + "".join(self.boot_tests)
+        self.msg_channel_send_msg(testcase)
+
+        while True:
+            ret = self.msg_channel_recv()
+
+            # If connection is disconnected accidently by peer, for
+            # instance child QEMU process crashed, a message with length
+            # 0 would be received. We should drop this message, and
+            # indicate test framework that something abnormal happened.
+            if not len(ret):
+                has_error = True
+                break
+            kill_timer.poke()
+
+            # Print message to STDOUT. Since we might meet EAGAIN IOError
+            # when writting to STDOUT, use try except loop to catch EAGAIN
+            # and waiting STDOUT to be available, then try to write again.
+            def print_msg(msg):
+                if self.log_store:
+                    self.log_store.write("test", msg)
+                while True:
+                    try:
+                        sys.stdout.write(msg)
+                        break
+                    except IOError as e:
+                        if e.errno != errno.EAGAIN:
+                            RunnerGenericError("Failed to print message")
+                        select.select([], [sys.stdout], [])
+
+            # Please align message structure definition in testrunner.
+            if ord(ret[0]) == 0:
+                print_msg(ret[2 : 2 + ord(ret[1])])
+            elif ord(ret[0]) == 1:
+                result = ord(ret[1])
+                break
+            else:
+                # Unexpected type, return test result:TEST_FAILED
+                has_error = True
+                result = 1
+                break
+
+        return result, has_error
+
+    def boottest_run_in_session(self, command_pipe):
+        """Runs boot_tests in the running session before Android is booted
+
+        Unlike boottest_run, QEMU is left running afterwards, so that
+        test-runner can go on to boot the secondary OS.
+        """
+        boot_test = "".join(self.boot_tests)
+
+        def abort_boottest(reason, limit):
+            qemu_handle_error(command_pipe=command_pipe,
+                              debug_on_error=self.debug_on_error,
+                              core_dumper=self.core_dumper)
+            # Wakes up the receive below with an empty message
+            self.msg_sock_conn.shutdown(socket.SHUT_RDWR)
+
+        kill_timer = self.watchdog(self.test_timeout, abort_boottest,
+                                   self.stall_timeout)
+        if not self.debug:
+            kill_timer.start()
+
+        start = self.test_begin("boot", boot_test)
+        try:
+            result, has_error = self.boottest_exchange(kill_timer)
+        finally:
+            kill_timer.cancel()
+        if kill_timer.expired == "stalled":
+            raise Timeout("Wait for boottest progress",
+                          kill_timer.quiet_period)
+        if kill_timer.expired:
+            raise Timeout("Wait for boottest to complete", self.test_timeout)
+        self.test_end("boot", boot_test, start, result)
+        return result
+
     def adb_bin(self):
         """Returns location of adb"""
         return "%s/out/host/linux-x86/bin/adb" % self.config.android
 
-    def adb(self, args, timeout=60, on_timeout=None, force_output=False):
+    def adb(self, args, timeout=60, on_timeout=None, force_output=False,
+            log=None, stall_timeout=None):
         """Runs an adb command
 
         If self.adb_transport is set, specializes the command to that
@@ -523,32 +1251,44 @@ c
 
         Timeout specifies a timeout for the command in seconds.
 
+        If stall_timeout is set, the command is also killed once neither it
+        nor the guest has made progress for that many seconds.
+
         If force_output is set true, will send results to stdout and
         stderr regardless of the runner's preferences.
+
+        If log is a file, the output is copied into it; unless force_output
+        is set, only there.
         """
+        command = args[0] if args else ""
         if self.adb_transport:
             args = ["-t", "%d" % self.adb_transport] + args
 
-        if force_output:
+        # Output also counts as progress, so it needs to pass through us
+        if log or (force_output and stall_timeout):
+            stdout = subprocess.PIPE
+            stderr = subprocess.STDOUT
+        elif force_output:
             stdout = None
             stderr = None
         else:
             stdout = self.stdout
             stderr = self.stderr
 
+        started = time.time()
         adb_proc = subprocess.Popen(
             [self.adb_bin()] + args, stdin=self.stdin, stdout=stdout,
             stderr=stderr)
 
         # This code simulates the timeout= parameter due to no python 3
 
-        def kill_adb():
+        def kill_adb(reason, limit):
             """Kills the running adb"""
             # Technically this races with wait - it is possible, though
             # unlikely, to get a spurious timeout message and kill
             # if .wait() returns, this function is triggered, and then
             # .cancel() runs
-            print "Timed out (%d s)" % timeout
+            print "%s (%d s)" % (reason.capitalize(), limit)
             if on_timeout:
                 on_timeout()
 
@@ -557,18 +1297,32 @@ c
             except OSError:
                 pass
 
+        watchdog = self.watchdog(timeout, kill_adb, stall_timeout)
         if not self.debug:
-            kill_timer = threading.Timer(timeout, kill_adb)
-            kill_timer.start()
+            watchdog.start()
         # Add finally here so that the python interpreter will exit quickly
         # in the event of an exception rather than waiting for the timer
         try:
+            if stdout == subprocess.PIPE:
+                # Killing adb on timeout closes the pipe and ends the copy
+                for chunk in iter(
+                        lambda: os.read(adb_proc.stdout.fileno(), 4096), ""):
+                    watchdog.poke()
+                    if force_output:
+                        sys.stdout.write(chunk)
+                    if log:
+                        log.write(chunk)
+                if force_output:
+                    sys.stdout.flush()
+                if log:
+                    log.flush()
+                adb_proc.stdout.close()
             exit_code = adb_proc.wait()
             return exit_code
         finally:
-            if not self.debug:
-                kill_timer.cancel()
-                kill_timer.join()
+            watchdog.cancel()
+            self.metrics.observe("adb_seconds", time.time() - started,
+                                 command=command)
 
     def check_adb(self, args, **kwargs):
         """As .adb(), but throws an exception if the command fails"""
@@ -623,6 +1377,7 @@ c
             except IOError:
                 connect_tries += 1
                 if connect_tries >= CONNECT_MAX_TRIES:
+                    self.metrics.inc("timeouts", reason="adbd socket")
                     raise Timeout("Wait for adbd socket", CONNECT_MAX_TRIES)
                 time.sleep(1)
         sock.close()
@@ -654,12 +1409,151 @@ c
                     sock.close()
                 connect_tries += 1
                 if connect_tries >= CONNECT_MAX_TRIES:
+                    self.metrics.inc("timeouts", reason="port forward")
                     raise Timeout("Wait for port forward to go away",
                                   CONNECT_MAX_TRIES)
                 time.sleep(1)
             except IOError:
                 break
 
+    def android_session_run(self, ports, command_pipe):
+        """Boots Android in the running session and runs android_tests"""
+        setup_start = self.test_begin("setup", "android")
+
+        # Send request to boot secondary OS
+        self.msg_channel_send_msg("Boot Secondary OS")
+
+        # Bring ADB up talking to the command port
+        self.adb_up(ports[1])
+        self.boot_event("adb")
+        self.test_end("setup", "android", setup_start, 0)
+        self.boot_timeline_report(kernel_log=True)
+
+        # Concurrent tests can time out together, but the guest is dumped,
+        # and handed to the debugger, once; the other tests wait for that
+        error_lock = threading.Lock()
+        error_handled = []
+
+        def on_adb_timeout():
+            with error_lock:
+                if error_handled:
+                    return
+                error_handled.append(True)
+                qemu_handle_error(command_pipe=command_pipe,
+                                  debug_on_error=self.debug_on_error,
+                                  core_dumper=self.core_dumper)
+
+        # Run android tests
+        if self.shell_parallel > 1:
+            return self.android_tests_run_concurrently(on_adb_timeout)
+        return self.android_tests_run(on_adb_timeout)
+
+    def android_tests_run(self, on_adb_timeout):
+        """Runs the shell tests one by one, stopping at the first failure"""
+        test_results = []
+        test_log = None
+        if self.log_store:
+            test_log = self.log_store.stream("test")
+        for android_test in self.android_tests:
+            start = self.test_begin("shell", android_test)
+            test_result = self.adb(["shell", shell_command(android_test)],
+                                   timeout=self.test_timeout,
+                                   on_timeout=on_adb_timeout,
+                                   force_output=True,
+                                   log=test_log,
+                                   stall_timeout=self.stall_timeout)
+            self.test_end("shell", android_test, start, test_result)
+            test_results.append(test_result)
+            if test_result:
+                break
+        return test_results
+
+    def android_test_run_captured(self, android_test, on_adb_timeout,
+                                  output_lock):
+        """Runs one shell test, printing its output once it is done"""
+        if self.sampler:
+            self.sampler.mark("begin", android_test, "shell")
+        start = time.time()
+        with tempfile.TemporaryFile() as output:
+            test_result = self.adb(["shell", shell_command(android_test)],
+                                   timeout=self.test_timeout,
+                                   on_timeout=on_adb_timeout,
+                                   log=output,
+                                   stall_timeout=self.stall_timeout)
+            output.seek(0)
+            test_output = output.read()
+        with output_lock:
+            sys.stdout.write("==== %s (exit %d) ====\n%s" % (
+                android_test, test_result, test_output))
+            sys.stdout.flush()
+        # Concurrent tests would interleave in the log store, so their
+        # output is stored in one piece
+        if self.log_store:
+            self.log_store.add(android_test, "shell", "test", test_output,
+                               start, test_result)
+        if self.sampler:
+            self.sampler.mark("end", android_test, "shell")
+        self.record_duration("shell", android_test, start, test_result)
+        return test_result
+
+    def android_tests_run_concurrently(self, on_adb_timeout):
+        """Runs up to shell_parallel shell tests at a time
+
+        Tests marked with SERIAL_TEST_PREFIX run on their own, after the
+        tests before them have finished. No new test is started after a
+        failure. Returns the results of the tests that ran, in input order.
+
+        Each test has its own timeout, but the progress probes of stall
+        detection (consoles, QEMU output, guest CPU) belong to the whole
+        instance: a stalled test is not detected while others progress,
+        only by its timeout.
+        """
+        tests = self.android_tests
+        results = [None] * len(tests)
+        output_lock = threading.Lock()
+        failed = threading.Event()
+        errors = []
+
+        def worker(queue):
+            while not failed.is_set():
+                try:
+                    index = queue.get_nowait()
+                except Queue.Empty:
+                    return
+                try:
+                    results[index] = self.android_test_run_captured(
+                        tests[index], on_adb_timeout, output_lock)
+                except Exception:
+                    errors.append(sys.exc_info())
+                    failed.set()
+                    return
+                if results[index]:
+                    failed.set()
+
+        start = 0
+        while start < len(tests) and not failed.is_set():
+            # Batch up the tests until the next serial-only one
+            end = start
+            while end < len(tests) and not is_serial_test(tests[end]):
+                end += 1
+            if end == start:
+                end += 1
+            queue = Queue.Queue()
+            for index in range(start, end):
+                queue.put(index)
+            workers = [threading.Thread(target=worker, args=(queue,))
+                       for _ in range(min(self.shell_parallel, end - start))]
+            for thread in workers:
+                thread.start()
+            for thread in workers:
+                thread.join()
+            start = end
+
+        if errors:
+            exc_type, exc_value, exc_traceback = errors[0]
+            raise exc_type, exc_value, exc_traceback
+        return [result for result in results if result is not None]
+
     def check_config(self):
         """Checks the runner/qemu config to make sure they are compatible"""
         # If we have any android tests, we need a linux dir and android dir
@@ -669,13 +1563,64 @@ c
             if not self.config.android:
                 raise ConfigError("Need Android to run android tests")
 
-        # For now, we can't run boot tests and android tests at the same time,
-        # because test-runner reports its exit code by terminating the
-        # emulator.
-        if self.android_tests:
-            if self.boot_tests:
-                raise ConfigError("Cannot run Android tests and boot"
-                                  " tests from same runner")
+        # The sampler talks to QEMU over the command channel and keeps its
+        # series next to the other logs
+        if self.sample_interval:
+            if self.interactive:
+                raise ConfigError("Cannot sample resources interactively")
+            if not self.log_dir:
+                raise ConfigError("Need a log dir to sample resources")
+
+        # The profiler brings up its own gdbstub and pauses the guest while
+        # sampling, which would get in the way of a user's debugger
+        if self.profile_rate:
+            if self.debug or self.debug_on_error:
+                raise ConfigError("Cannot profile while debugging")
+            if not self.log_dir:
+                raise ConfigError("Need a log dir to write the profile")
+            if self.config.arch not in qemu_profiler.REGISTERS:
+                raise ConfigError("Cannot profile %s guests" %
+                                  self.config.arch)
+
+        # Dumps are taken over the command channel and kept with the logs
+        if self.core_dump:
+            if self.interactive:
+                raise ConfigError("Cannot dump guest memory interactively")
+            if not self.log_dir:
+                raise ConfigError("Need a log dir to keep core dumps")
+
+        # Threads are found and pinned over the command channel
+        if self.pin_cpus or self.cgroup_parent:
+            if self.interactive:
+                raise ConfigError("Cannot isolate an interactive instance")
+        if (self.cpu_quota or self.memory_limit) and not self.cgroup_parent:
+            raise ConfigError("Need a cgroup parent to apply limits")
+
+        if self.prefetch_profile and not self.prefetch:
+            raise ConfigError("A prefetch profile needs prefetching enabled")
+
+        # Traces are kept with the logs
+        if self.trace_events and not self.log_dir:
+            raise ConfigError("Need a log dir to keep the trace")
+        if ((self.trace_pairs or self.trace_key_arg is not None or
+             self.trace_cpu_arg is not None) and not self.trace_events):
+            raise ConfigError("Trace analysis needs trace events")
+
+        # Stage markers come from the console logs
+        if self.boot_timeline and not self.log_dir:
+            raise ConfigError("Need a log dir for a boot timeline")
+
+        if not self.memory_backend:
+            if self.hugepages or self.mem_path:
+                raise ConfigError("Hugepages and mem path need a memory"
+                                  " backend")
+
+        if self.shell_parallel < 1:
+            raise ConfigError("Need at least one shell test at a time")
+
+        if self.stall_timeout and self.stall_timeout >= self.test_timeout:
+            raise ConfigError("Stall timeout must be shorter than the"
+                              " test timeout")
 
         # Since boot test utilizes virtio serial console port for communication
         # between QEMU guest and current process, it is not compatible with
@@ -710,6 +1655,10 @@ c
         Runs boot_tests through test_runner, android_tests through ADB,
         returning aggregated test return codes in a list.
 
+        When both are given, they share one session: the boot tests run
+        first, then test-runner boots Android for the android tests, unless
+        the boot tests failed. Boot test results come first in the list.
+
         If interactive is specified, it will leave the user connected
         to the serial console/monitor, and they are responsible for
         terminating execution.
@@ -726,10 +1675,110 @@ c
           A list of return codes for the provided tests.
           A negative return code indicates an internal tool failure.
 
+        If a log_dir is provided, the output of the QEMU console, the secure
+        consoles and each test is appended to an indexed log store in it (see
+        qemu_log_store.py).
+
+        If sample_interval is given, QEMU's guest state, block I/O and host
+        CPU and memory usage are sampled every sample_interval seconds into
+        samples.jsonl in log_dir, with test boundaries marked.
+
+        If profile_rate is given, the guest is halted profile_rate times per
+        second through a gdbstub to sample the PC and LR of every vCPU. The
+        samples are symbolized against profile_elfs (e.g. lk.elf and the bl31
+        ELF) and written as folded stacks to profile.folded in log_dir. Only
+        arm64 configs can be profiled.
+
+        If core_dump is set, guest memory of a failed run is dumped in a
+        compressed format to the cores directory of log_dir, together with a
+        manifest of the images used. Dumps larger than core_dump_budget bytes
+        are discarded.
+
+        If stall_timeout is given, a boot or shell test is declared hung
+        and killed once neither its output, the consoles nor the guest's CPU
+        use have shown progress for stall_timeout seconds. The test timeout
+        still applies as an upper bound. With shell_parallel, the progress
+        of any test counts, so stalls are only detected when all stall.
+
+        If shell_parallel is more than 1, up to that many android_tests run
+        at the same time in the guest, each with its output captured and
+        printed once it is done. Tests starting with SERIAL_TEST_PREFIX
+        ("serial:") always run on their own.
+
+        If pin_cpus is set, the QEMU main loop and rpmb daemon are pinned to
+        one host core and each vCPU thread to another, chosen so that
+        concurrent runners use disjoint cores. If cgroup_parent is given, the
+        instance is moved into a cgroup v2 group below it, limited to
+        cpu_quota CPUs and memory_limit bytes if given. Either way, the
+        assignment and each vCPU's scheduling delays are reported at the end,
+        and written to isolation.json in log_dir.
+
+        Guest RAM can be allocated from a memory_backend, "memfd" or "file"
+        (in mem_path), marked for KSM merging across instances, or on
+        hugepages, which KSM never merges; qemu_memory.py reports what
+        instances share.
+
+        boot_profile selects the kernel command line: "default", or "fast",
+        which sends the kernel console to a virtio console collected with the
+        secure consoles instead of the slow emulated UART, and only prints
+        warnings and worse. If boot_timeline is set, the times at which the
+        guest reached each boot stage (ATF, Trusty, test-runner, kernel,
+        init, adbd) are reported and written to boot_timeline.json in
+        log_dir.
+
+        If prefetch is set, the images and binaries of the run are loaded
+        into the page cache by parallel threads while rpmb and the device
+        tree are set up. Large images are only prefetched where earlier runs
+        read them, according to the access profile in prefetch_profile. Runs
+        that prefetch nothing now and then learn these ranges again, and
+        give the boot times that those of prefetched runs are compared to.
+        Boot stage times, and how much of the data was still cold at QEMU's
+        launch, are reported and written to prefetch.json in log_dir.
+
+        The setup steps before QEMU's launch (prefetch, rpmb daemon, device
+        tree, consoles, message channel, command channel and adb ports) run
+        in parallel as far as they do not depend on each other (see
+        qemu_setup.py). When each ran and the critical path are written to
+        setup.json in log_dir, and reported if verbose.
+
+        Boots, boot latency, test durations, adb command latency, timeouts,
+        unclean QEMU exits and adb port allocation retries are counted
+        throughout (see qemu_metrics.py). If metrics_textfile is given, they
+        are added at the end of the run to the totals of all runners using
+        it, rendered in the Prometheus textfile format. If metrics_port is
+        given, the run serves its own metrics at
+        http://localhost:<metrics_port>/metrics while it lasts.
+
+        If trace_events is given, QEMU records those trace events, or event
+        name patterns, into trace-<instance>.bin in log_dir, with the simple
+        trace backend. After the run, entry and exit events are paired into
+        calls, by trace_pairs (entry event: exit event) or by their name
+        suffixes, and latency histograms and the slowest calls per call type
+        are reported and written to trace-<instance>.json (see
+        qemu_trace.py). trace_key_arg tells calls apart by that argument of
+        their entry event, e.g. an SMC function id; trace_cpu_arg is the
+        argument holding the vCPU, for pairing calls per vCPU.
+
+        If a test_db is provided, the duration of each test is recorded in it.
+        It is also used to run android tests longest first when test_order is
+        "longest". When shard is given as (index, count), this runner only
+        runs its share of the android tests; the boot tests run as a unit in
+        shard 0. With a test_db, the shards are balanced by the durations
+        recorded before shard_cutoff, by default the start of the UTC day,
+        so that shards running at the same time agree on the plan; shards
+        started on different days must be given the same cutoff. Tests
+        without durations are assigned by a hash of their name. The
+        returned codes are in execution order.
+
+        The secure-world consoles are collected into timestamped logs in
+        log_dir, if given.
+
+        The processes, temporary files and ports of the run are recorded in
+        the instance registry under state_dir, and instances leaked by runners
+        that died are reaped before starting.
+
         Limitations:
-          Until test_runner is updated, only one of android_tests or boot_tests
-          may be provided.
-          Similarly, while boot_tests is a list, test_runner only knows how to
+          While boot_tests is a list, test_runner only knows how to
           correctly run a single test at a time.
           Again due to test_runner's current state, if boot_tests are
           specified, interactive will be ignored since the machine will
@@ -742,6 +1791,16 @@ c
         """
         self.check_config()
 
+        boot_tests = self.boot_tests
+        android_tests = self.android_tests
+        if self.shard and self.shard[0] != 0:
+            self.boot_tests = []
+        self.android_tests = self.schedule_tests(android_tests)
+        if ((boot_tests or android_tests) and
+                not (self.boot_tests or self.android_tests)):
+            # Sharding left nothing for this runner to do
+            return []
+
         ports = None
 
         args = self.universal_args()
@@ -751,31 +1810,87 @@ c
 
         qemu_proc = None
         has_error = False
+        crashed = False
 
         # Resource exists in multiple functions, wants to use the same
         # cleanup block regardless
         self.temp_files = []
 
+        # Without android tests, test-runner's session ends with the boot
+        # tests; otherwise they run in the Android session, see below
+        boot_only = bool(self.boot_tests and not self.android_tests)
+
+        # The device tree is dumped with the rpmb args, as QEMU runs with
+        # them, so it waits for the rpmb daemon. That also keeps the only
+        # steps that spawn processes apart: Python 2's subprocess is not
+        # safe to use from several threads at once. The adb ports are
+        # reserved once the consoles and message channel are up, so a run
+        # that fails to set those up holds no ports.
+        setup = qemu_setup.SetupPipeline()
+        setup.add("prefetch", self.prefetch_up)
+        if self.use_rpmb:
+            setup.add("rpmb", self.rpmb_up)
+        if self.config.linux:
+            dtb_args = list(args)
+            dtb_deps = ["rpmb"] if self.use_rpmb else []
+            setup.add("dtb", lambda: self.qemu_arch_options.gen_dtb(
+                dtb_args + setup.results.get("rpmb", []),
+                self.get_qemu_arg_temp_file()), dtb_deps)
+        setup.add("console", self.console_up)
+        setup.add("msg_channel", self.msg_channel_up)
+        if not boot_only:
+            # If we're noninteractive (e.g. testing) we need a command
+            # channel to tell the guest to exit
+            if not self.interactive:
+                setup.add("command_pipe", self.command_pipe_up)
+            setup.add("ports", self.ports_up,
+                      deps=["console", "msg_channel"])
+
         try:
-            if self.use_rpmb:
-                args += self.rpmb_up()
+            # Inside the try, so that the cleanup below also runs when
+            # registration fails half way
+            self.metrics_up()
+            self.log_store_up()
+            self.instance_up()
+
+            if self.dump_stdout_on_error:
+                # Only dump what this run logged
+                self.stdout.seek(0, os.SEEK_END)
+                self.stdout_start = self.stdout.tell()
+
+            try:
+                steps = setup.run()
+            finally:
+                self.setup_report(setup)
+            command_pipe = steps.get("command_pipe")
+            ports = steps.get("ports")
 
-            if self.config.linux:
-                args += self.qemu_arch_options.gen_dtb(
-                    args,
-                    self.get_qemu_arg_temp_file())
+            args += steps.get("rpmb", [])
+            args += steps.get("dtb", [])
 
             # Prepend the machine since we don't need to edit it as in gen_dtb
             args = self.qemu_arch_options.machine_options() + args
 
+            # How guest RAM is backed does not change the device tree either
+            args += self.qemu_arch_options.memory_options()
+
+            args += steps["console"]
+            args += self.profiler_args()
+            args += self.trace_args()
+
             if self.debug:
                 args += ["-s", "-S"]
 
-            # Create socket for communication channel
-            args += self.msg_channel_up()
+            # Socket for communication channel
+            args += steps["msg_channel"]
 
-            if self.boot_tests:
-                return [self.boottest_run(args, timeout=self.test_timeout)]
+            if boot_only:
+                boot_test = "".join(self.boot_tests)
+                start = self.test_begin("boot", boot_test)
+                result = self.boottest_run(args, timeout=self.test_timeout)
+                self.test_end("boot", boot_test, start, result)
+                test_results.append(result)
+                return test_results
 
             # Logging and terminal monitor
             # Prepend so that it is the *first* serial port and avoid
@@ -784,15 +1899,9 @@ c
             #print("###### Use -serial tcp:localhost:5552 instead of mon:stdio? #######")
             # NO! Disabling mon:stdio will break adb!
 
-            # If we're noninteractive (e.g. testing) we need a command channel
-            # to tell the guest to exit
-            if not self.interactive:
-                command_pipe = QEMUCommandPipe()
+            if command_pipe:
                 args += command_pipe.command_args
 
-            # Reserve ADB ports
-            ports = alloc_ports()
-
             # Write expected serial number (as given in adb) to stdout.
             sys.stdout.write('DEVICE_SERIAL: emulator-%d\n' % ports[0])
             sys.stdout.flush()
@@ -808,35 +1917,35 @@ c
                 stdin=self.stdin,
                 stdout=self.stdout,
                 stderr=self.stderr)
+            self.register_process("qemu", qemu_proc)
+            self.boot_event("qemu")
+            self.core_dumper_up(qemu_cmd)
 
             if command_pipe:
                 command_pipe.open()
+                self.guest_up(command_pipe, qemu_proc)
+                self.isolation_up(qemu_proc)
+                self.sampler_up(command_pipe, qemu_proc)
+            self.profiler_up()
             self.msg_channel_wait_for_connection()
 
             if self.debug:
                 print "Run gdb and \"target remote :1234\" to debug"
 
             try:
-                # Send request to boot secondary OS
-                self.msg_channel_send_msg("Boot Secondary OS")
-
-                # Bring ADB up talking to the command port
-                self.adb_up(ports[1])
+                # test-runner reports boot test results over the message
+                # channel, so they can run before it boots the secondary OS
+                if self.boot_tests:
+                    result = self.boottest_run_in_session(command_pipe)
+                    test_results.append(result)
+                    if result:
+                        has_error = True
 
-                def on_adb_timeout():
-                    qemu_handle_error(command_pipe=command_pipe,
-                                      debug_on_error=self.debug_on_error)
-
-                # Run android tests
-                for android_test in self.android_tests:
-                    test_result = self.adb(["shell", android_test],
-                                           timeout=self.test_timeout,
-                                           on_timeout=on_adb_timeout,
-                                           force_output=True)
-                    test_results.append(test_result)
-                    if test_result:
+                if not has_error:
+                    test_results += self.android_session_run(ports,
+                                                             command_pipe)
+                    if any(test_results):
                         has_error = True
-                        break
             # Finally is used here to ensure that ADB failures do not take away
             # the user's serial console in interactive mode.
             finally:
@@ -845,6 +1954,7 @@ c
                     qemu_proc.wait()
         except:
             has_error = True
+            crashed = True
             raise
         finally:
             # Clean up generated device tree
@@ -854,26 +1964,74 @@ c
             if has_error:
                 self.error_dump_output()
 
+            self.profiler_down()
+            self.sampler_down()
+            self.isolation_down()
+
+            # Setup may have failed after creating the command pipe
+            if not command_pipe:
+                command_pipe = setup.results.get("command_pipe")
             unclean_exit = qemu_exit(command_pipe, qemu_proc,
                                      has_error=has_error,
-                                     debug_on_error=self.debug_on_error)
+                                     debug_on_error=self.debug_on_error,
+                                     core_dumper=self.core_dumper)
 
             fcntl.fcntl(0, fcntl.F_SETFL,
                         fcntl.fcntl(0, fcntl.F_GETFL) & ~os.O_NONBLOCK)
 
             self.rpmb_down()
 
+            self.cgroup_down()
+
+            self.prefetch_down()
+
+            self.trace_down()
+
+            self.console_down()
+
             self.msg_channel_down()
 
             if self.adb_transport:
                 # Disconnect ADB and wait for our port to be released by qemu
                 self.adb_down(ports[1])
 
+            # Everything is cleaned up, nothing is left to reap
+            self.instance_down()
+
+            if unclean_exit:
+                self.metrics.inc("unclean_exits")
+            if crashed or unclean_exit:
+                outcome = "error"
+            else:
+                outcome = "fail" if any(test_results) else "pass"
+            self.metrics_down(outcome)
+
+            self.log_store_down()
+
             if unclean_exit:
                 raise RunnerGenericError("QEMU did not exit cleanly")
         return test_results
 
 
+def parse_shard(value):
+    """Parses a shard specification of the form INDEX/COUNT"""
+    match = re.match(r"^(\d+)/(\d+)$", value)
+    if not match or int(match.group(1)) >= int(match.group(2)):
+        raise argparse.ArgumentTypeError(
+            "expected INDEX/COUNT with INDEX < COUNT, got %r" % value)
+    return int(match.group(1)), int(match.group(2))
+
+
+def print_duration_report(test_db, config):
+    """Prints duration percentiles of the tests recorded for a config"""
+    print "%-6s %5s %9s %9s %9s %9s  %s" % ("kind", "runs", "p50", "p90",
+                                            "p99", "max", "test")
+    for kind, test, runs, p50, p90, p99, longest in test_db.report(
+            config.key()):
+        print "%-6s %5d %9.1f %9.1f %9.1f %9.1f  %s" % (
+            kind, runs, p50, p90, p99, longest, test)
+
+
 def main():
     argument_parser = argparse.ArgumentParser()
     argument_parser.add_argument("-c", "--config", type=file)
@@ -890,6 +2048,46 @@ def main():
     argument_parser.add_argument("--arch")
     argument_parser.add_argument("--disable-rpmb", action="store_true")
     argument_parser.add_argument("--timeout", type=int)
+    argument_parser.add_argument("--stall-timeout", type=int)
+    argument_parser.add_argument("--shell-parallel", type=int, default=1)
+    argument_parser.add_argument("--pin-cpus", action="store_true")
+    argument_parser.add_argument("--cgroup-parent")
+    argument_parser.add_argument("--cpu-quota", type=float)
+    argument_parser.add_argument("--memory-limit-mb", type=int)
+    argument_parser.add_argument(
+        "--memory-backend",
+        choices=qemu_options.QemuArm64Options.MEMORY_BACKENDS)
+    argument_parser.add_argument(
+        "--hugepages", action="store_true",
+        help="back guest RAM with hugepages; KSM never merges these, so "
+        "RAM is then not shared across instances")
+    argument_parser.add_argument("--mem-path")
+    argument_parser.add_argument(
+        "--boot-profile", default="default",
+        choices=qemu_options.QemuArm64Options.BOOT_PROFILES)
+    argument_parser.add_argument("--boot-timeline", action="store_true")
+    argument_parser.add_argument("--prefetch", action="store_true")
+    argument_parser.add_argument("--prefetch-profile")
+    argument_parser.add_argument("--metrics-textfile")
+    argument_parser.add_argument("--metrics-port", type=int)
+    argument_parser.add_argument("--trace-event", action="append")
+    argument_parser.add_argument("--trace-pair", action="append",
+                                 type=qemu_trace.parse_pair)
+    argument_parser.add_argument("--trace-key-arg", type=int)
+    argument_parser.add_argument("--trace-cpu-arg", type=int)
+    argument_parser.add_argument("--test-db")
+    argument_parser.add_argument("--test-order", choices=["given", "longest"],
+                                 default="given")
+    argument_parser.add_argument("--shard", type=parse_shard)
+    argument_parser.add_argument("--shard-cutoff", type=float)
+    argument_parser.add_argument("--duration-report", action="store_true")
+    argument_parser.add_argument("--state-dir")
+    argument_parser.add_argument("--log-dir")
+    argument_parser.add_argument("--sample-interval", type=float)
+    argument_parser.add_argument("--profile-rate", type=float)
+    argument_parser.add_argument("--profile-elf", action="append")
+    argument_parser.add_argument("--core-dump", action="store_true")
+    argument_parser.add_argument("--core-dump-budget-mb", type=int)
     argument_parser.add_argument("extra_qemu_flags", nargs="*")
     args = argument_parser.parse_args()
 
@@ -907,6 +2105,16 @@ def main():
     if args.extra_qemu_flags:
         config.extra_qemu_flags += args.extra_qemu_flags
 
+    test_db = None
+    if args.test_db:
+        test_db = qemu_test_db.TestDurationDb(args.test_db)
+    elif args.test_order != "given" or args.duration_report:
+        argument_parser.error("--test-db is required for test ordering")
+
+    if args.duration_report:
+        print_duration_report(test_db, config)
+        sys.exit(0)
+
     runner = Runner(config, boot_tests=args.boot_test,
                     android_tests=args.shell_command,
                     interactive=not args.headless,
@@ -914,7 +2122,39 @@ def main():
                     rpmb=not args.disable_rpmb,
                     debug=args.debug,
                     debug_on_error=args.debug_on_error,
-                    timeout=args.timeout)
+                    timeout=args.timeout,
+                    test_db=test_db,
+                    test_order=args.test_order,
+                    shard=args.shard,
+                    shard_cutoff=args.shard_cutoff,
+                    state_dir=args.state_dir,
+                    log_dir=args.log_dir,
+                    sample_interval=args.sample_interval,
+                    profile_rate=args.profile_rate,
+                    profile_elfs=args.profile_elf,
+                    core_dump=args.core_dump,
+                    core_dump_budget=(args.core_dump_budget_mb * 1024 * 1024
+                                      if args.core_dump_budget_mb else None),
+                    stall_timeout=args.stall_timeout,
+                    shell_parallel=args.shell_parallel,
+                    pin_cpus=args.pin_cpus,
+                    cgroup_parent=args.cgroup_parent,
+                    cpu_quota=args.cpu_quota,
+                    memory_limit=(args.memory_limit_mb * 1024 * 1024
+                                  if args.memory_limit_mb else None),
+                    memory_backend=args.memory_backend,
+                    hugepages=args.hugepages,
+                    mem_path=args.mem_path,
+                    boot_profile=args.boot_profile,
+                    boot_timeline=args.boot_timeline,
+                    prefetch=args.prefetch,
+                    prefetch_profile=args.prefetch_profile,
+                    metrics_textfile=args.metrics_textfile,
+                    metrics_port=args.metrics_port,
+                    trace_events=args.trace_event,
+                    trace_pairs=args.trace_pair,
+                    trace_key_arg=args.trace_key_arg,
+                    trace_cpu_arg=args.trace_cpu_arg)
 
     try:
         results = runner.run()
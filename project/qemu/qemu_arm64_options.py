@@ -10,11 +10,23 @@ class QemuArm64Options(object):
 
     MACHINE = "virt,secure=on,virtualization=on"
 
+    # Serial ports after the first, which carry secure-world output
+    SECURE_CONSOLES = ["serial1", "serial2"]
+
+    # Guest RAM in MiB
+    MEMORY_MB = 1024
+
+    # Backends guest RAM can be allocated from, see memory_options()
+    MEMORY_BACKENDS = ["memfd", "file"]
+
+    # Where the file backend puts guest RAM by default
+    MEMORY_FILE_DIR = "/dev/shm"
+    HUGEPAGES_DIR = "/dev/hugepages"
+
     BASIC_ARGS = [
-        "-serial", "tcp:localhost:5552",
-        "-serial", "tcp:localhost:5553",
-        "-nographic", "-cpu", "cortex-a57", "-smp", "4", "-m", "1024", "-d",
-        "unimp", "-semihosting-config", "enable,target=native", "-no-acpi",
+        "-nographic", "-cpu", "cortex-a57", "-smp", "4", "-m", str(MEMORY_MB),
+        "-d", "unimp", "-semihosting-config", "enable,target=native",
+        "-no-acpi",
     ]
 
     LINUX_ARGS = (
@@ -22,19 +34,77 @@ class QemuArm64Options(object):
         "loglevel=7 androidboot.selinux=permissive "
         "root=/dev/vda init=/init androidboot.hardware=qemu_trusty")
 
-    def __init__(self, config):
+    # Kernel command line variants, see linux_options()
+    BOOT_PROFILES = ["default", "fast"]
+
+    # Virtio-serial controller of the rpmb and test-runner ports, see
+    # serial_port()
+    SERIAL_PORT_BUS = "serialports"
+
+    # Virtio console the fast boot profile sends kernel output to
+    KERNEL_CONSOLE = "hvc0"
+
+    FAST_BOOT_LINUX_ARGS = (
+        "console=hvc0 loglevel=4 printk.time=1 "
+        "androidboot.selinux=permissive "
+        "root=/dev/vda init=/init androidboot.hardware=qemu_trusty")
+
+    def __init__(self, config, memory_backend=None, hugepages=False,
+                 mem_path=None, boot_profile="default"):
         self.args = []
         self.config = config
+        self.memory_backend = memory_backend
+        self.hugepages = hugepages
+        self.mem_path = mem_path
+        self.boot_profile = boot_profile
 
     def rpmb_data_path(self):
         return "%s/RPMB_DATA" % self.config.atf
 
+    def serial_port(self, name):
+        """Returns a virtio-serial port named name, fed by chardev name
+
+        The port is pinned to the controller rpmb_options() adds, as the
+        fast boot profile adds a second controller for its kernel console.
+        """
+        return ["-device", "virtserialport,bus=%s.0,chardev=%s,name=%s" %
+                (self.SERIAL_PORT_BUS, name, name)]
+
     def rpmb_options(self, sock):
         return [
-            "-device", "virtio-serial",
-            "-device", "virtserialport,chardev=rpmb0,name=rpmb0",
+            "-device", "virtio-serial,id=%s" % self.SERIAL_PORT_BUS
+        ] + self.serial_port("rpmb0") + [
             "-chardev", "socket,id=rpmb0,path=%s" % sock]
 
+    def console_sources(self):
+        """Returns the consoles to collect, see console_options()"""
+        if self.boot_profile == "fast":
+            return self.SECURE_CONSOLES + [self.KERNEL_CONSOLE]
+        return list(self.SECURE_CONSOLES)
+
+    def console_options(self, console_socks):
+        """Connects the consoles to the given unix sockets
+
+        console_socks maps each name in console_sources() to a socket path.
+        The secure console ports are numbered in order, after the first
+        serial port. The kernel console of the fast boot profile is a
+        virtio console on a virtio-serial bus of its own, so it does not
+        queue behind the rpmb or test-runner ports.
+        """
+        args = []
+        for name in self.SECURE_CONSOLES:
+            args += ["-chardev",
+                     "socket,id=%s,path=%s" % (name, console_socks[name]),
+                     "-serial", "chardev:%s" % name]
+        if self.KERNEL_CONSOLE in console_socks:
+            name = self.KERNEL_CONSOLE
+            args += ["-device", "virtio-serial,id=kernelcon",
+                     "-chardev",
+                     "socket,id=%s,path=%s" % (name, console_socks[name]),
+                     "-device",
+                     "virtconsole,bus=kernelcon.0,chardev=%s" % name]
+        return args
+
     def gen_dtb(self, args, dtb_tmp_file):
         """Computes a trusty device tree, returning a file for it"""
         with tempfile.NamedTemporaryFile() as dtb_gen:
@@ -42,14 +112,17 @@ class QemuArm64Options(object):
                 self.config.qemu, "-machine",
                 "%s,dumpdtb=%s" % (self.MACHINE, dtb_gen.name)
             ] + [arg for arg in args if arg != "-S"]
-            returncode = subprocess.call(dump_dtb_cmd)
+            # Setup steps run concurrently, so no subprocess may inherit
+            # another's pipes and keep them open
+            returncode = subprocess.call(dump_dtb_cmd, close_fds=True)
             if returncode != 0:
                 raise RunnerGenericError("dumping dtb failed with %d" %
                                          returncode)
             dtc = "%s/scripts/dtc/dtc" % self.config.linux
             dtb_to_dts_cmd = [dtc, "-q", "-O", "dts", dtb_gen.name]
             dtb_to_dts = subprocess.Popen(dtb_to_dts_cmd,
-                                          stdout=subprocess.PIPE)
+                                          stdout=subprocess.PIPE,
+                                          close_fds=True)
             dts = dtb_to_dts.communicate()[0]
             if dtb_to_dts.returncode != 0:
                 raise RunnerGenericError("dtb_to_dts failed with %d" %
@@ -64,21 +137,25 @@ class QemuArm64Options(object):
         dts_to_dtb_cmd = [dtc, "-q", "-O", "dtb"]
         dts_to_dtb = subprocess.Popen(dts_to_dtb_cmd,
                                       stdin=subprocess.PIPE,
-                                      stdout=dtb)
+                                      stdout=dtb,
+                                      close_fds=True)
         dts_to_dtb.communicate(dts)
         dts_to_dtb_ret = dts_to_dtb.wait()
         if dts_to_dtb_ret:
             raise RunnerGenericError("dts_to_dtb failed with %d" % dts_to_dtb_ret)
         return ["-dtb", dtb.name]
 
+    def android_image_path(self, image):
+        return "%s/out/target/product/trusty/%s.img" % (self.config.android,
+                                                         image)
+
     def drive_args(self, image, index):
         """Generates arguments for mapping a drive"""
         index_letter = chr(ord('a') + index)
-        image_dir = "%s/out/target/product/trusty" % self.config.android
         return [
             "-drive",
-            "file=%s/%s.img,index=%d,if=none,id=hd%s,format=raw,snapshot=on" %
-            (image_dir, image, index, index_letter), "-device",
+            "file=%s,index=%d,if=none,id=hd%s,format=raw,snapshot=on" %
+            (self.android_image_path(image), index, index_letter), "-device",
             "virtio-blk-device,drive=hd%s" % index_letter
         ]
 
@@ -92,7 +169,42 @@ class QemuArm64Options(object):
         return args
 
     def machine_options(self):
-        return ["-machine", self.MACHINE]
+        machine = self.MACHINE
+        if self.memory_backend:
+            machine += ",memory-backend=mem0"
+        return ["-machine", machine]
+
+    def memory_options(self):
+        """Allocates guest RAM from a memfd or file backend, if configured
+
+        Instances run identical images, so much of their RAM holds the same
+        pages. The backend is marked mergeable, letting KSM deduplicate it
+        across instances. KSM only merges private mappings, so the backend
+        is never shared; memfd would be by default.
+
+        Alternatively, hugepages cut page table overhead, but KSM never
+        merges hugetlb pages, so RAM on hugepages is not marked mergeable.
+        The file backend maps a private, unlinked file in mem_path, which
+        must be on hugetlbfs for hugepages.
+        """
+        if not self.memory_backend:
+            return []
+        props = ["id=mem0", "size=%dM" % self.MEMORY_MB]
+        if not self.hugepages:
+            props.append("merge=on")
+        if self.memory_backend == "memfd":
+            if self.hugepages:
+                props.append("hugetlb=on")
+        else:
+            mem_path = self.mem_path
+            if not mem_path:
+                mem_path = (self.HUGEPAGES_DIR if self.hugepages
+                            else self.MEMORY_FILE_DIR)
+            props.append("mem-path=%s" % mem_path)
+        props.append("share=off")
+        return ["-object",
+                "memory-backend-%s,%s" % (self.memory_backend,
+                                          ",".join(props))]
 
     def basic_options(self):
         return list(self.BASIC_ARGS)
@@ -100,12 +212,31 @@ class QemuArm64Options(object):
     def bios_options(self):
         return ["-bios", "%s/bl1.bin" % self.config.atf]
 
+    def kernel_path(self):
+        return "%s/arch/%s/boot/Image" % (self.config.linux,
+                                          self.config.linux_arch)
+
     def linux_options(self):
+        linux_args = self.LINUX_ARGS
+        if self.boot_profile == "fast":
+            linux_args = self.FAST_BOOT_LINUX_ARGS
         return [
-            "-kernel", "%s/arch/%s/boot/Image" % (self.config.linux,
-                                                  self.config.linux_arch),
-            "-append", self.LINUX_ARGS
+            "-kernel", self.kernel_path(),
+            "-append", linux_args
         ]
 
+    def image_paths(self):
+        """Returns the binaries and images a run loads, by name"""
+        images = {"qemu": self.config.qemu}
+        # bl1 loads the other stages from the ATF dir through semihosting
+        for stage in ["bl1", "bl2", "bl31", "bl32", "bl33"]:
+            images["%s.bin" % stage] = "%s/%s.bin" % (self.config.atf, stage)
+        if self.config.linux:
+            images["Image"] = self.kernel_path()
+        if self.config.android:
+            for image in ["system", "vendor", "userdata"]:
+                images["%s.img" % image] = self.android_image_path(image)
+        return images
+
     def android_trusty_user_data(self):
         return "%s/out/target/product/trusty/data" % self.config.android
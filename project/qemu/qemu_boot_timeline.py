@@ -0,0 +1,117 @@
+"""Reconstructs where guest boot time goes from console and kernel logs"""
+
+import json
+import re
+
+# Boot stages in the order the guest reaches them. Each is marked by the
+# first console line matching its pattern, or by an event of the runner.
+STAGES = ["qemu", "atf", "trusty", "testrunner", "kernel", "init", "adbd",
+          "adb"]
+
+# Lines of the secure consoles marking the start of a stage
+SECURE_MARKERS = [
+    ("atf", re.compile(r"Booting Trusted Firmware|BL1: ")),
+    ("trusty", re.compile(r"welcome to lk")),
+]
+
+# Kernel log messages marking the start of a stage
+KERNEL_MARKERS = [
+    ("kernel", re.compile(r"Booting Linux on physical CPU")),
+    ("init", re.compile(r"Run /init as init process|"
+                        r"init: init first stage started")),
+    ("adbd", re.compile(r"init: starting service 'adbd'")),
+]
+
+# A printk line, as printed on a console or by dmesg
+PRINTK_RE = re.compile(r"^(?:<\d+>)?\[\s*(\d+\.\d+)\]\s?(.*)$")
+
+
+def read_console_log(path):
+    """Yields (host time, line) from a console log written by ConsoleMux"""
+    with open(path) as log:
+        for line in log:
+            stamp, _, text = line.rstrip("\n").partition(" ")
+            try:
+                yield float(stamp), text
+            except ValueError:
+                continue
+
+
+def parse_printk(text):
+    """Yields (kernel time, message) from kernel log output"""
+    for line in text.splitlines():
+        match = PRINTK_RE.match(line.strip("\r"))
+        if match:
+            yield float(match.group(1)), match.group(2)
+
+
+class BootTimeline(object):
+    """Host times at which the guest reached each boot stage
+
+    Stages are found on the host-timestamped consoles, in the kernel log and
+    in events of the runner. Kernel log times count from kernel start; they
+    are moved onto the host clock with the guest's uptime, read at a known
+    host time. Times found on a console take precedence, as they were
+    observed directly.
+    """
+
+    def __init__(self):
+        self.points = {}
+
+    def event(self, stage, when):
+        self.points.setdefault(stage, when)
+
+    def add_console_log(self, path):
+        """Looks for stage markers in a ConsoleMux log
+
+        Kernel output on the console is matched too, for when the kernel
+        console is collected by ConsoleMux as in the fast boot profile.
+        """
+        for when, line in read_console_log(path):
+            match = PRINTK_RE.match(line)
+            message = match.group(2) if match else line
+            for stage, pattern in SECURE_MARKERS + KERNEL_MARKERS:
+                if stage not in self.points and pattern.search(message):
+                    self.points[stage] = when
+
+    def add_kernel_log(self, dmesg, uptime, when):
+        """Adds the kernel stages in dmesg, given the uptime at host time"""
+        kernel_start = when - uptime
+        for kernel_time, message in parse_printk(dmesg):
+            for stage, pattern in KERNEL_MARKERS:
+                if pattern.search(message):
+                    self.event(stage, kernel_start + kernel_time)
+
+    def stages(self):
+        """Returns the stages reached, with the time each one took
+
+        Each stage lasts until the next one that was found starts. Times
+        are relative to the first stage found.
+        """
+        found = [(stage, self.points[stage]) for stage in STAGES
+                 if stage in self.points]
+        if not found:
+            return []
+        origin = found[0][1]
+        stages = []
+        for index, (stage, when) in enumerate(found):
+            following = found[index + 1][1] if index + 1 < len(found) else None
+            stages.append({
+                "stage": stage,
+                "start": when - origin,
+                "duration": following - when if following else None,
+            })
+        return stages
+
+    def report(self, out):
+        for stage in self.stages():
+            duration = ("%8.3fs" % stage["duration"]
+                        if stage["duration"] is not None else "")
+            out.write("boot %-10s at %8.3fs %s\n" % (stage["stage"],
+                                                     stage["start"],
+                                                     duration))
+
+    def write(self, path):
+        with open(path, "w") as out:
+            json.dump({"points": self.points, "stages": self.stages()}, out,
+                      indent=2, sort_keys=True)
@@ -0,0 +1,156 @@
+"""Collects the output of QEMU serial consoles"""
+
+import errno
+import os
+import select
+import shutil
+import socket
+import tempfile
+import threading
+import time
+
+
+class ConsoleMux(object):
+    """Multiplexes consoles arriving on unix sockets into timestamped logs
+
+    Every console source gets its own listening unix socket, which QEMU
+    connects to as a client chardev, so concurrent instances never see each
+    other's output. A single collector thread waits on all sockets with
+    epoll and writes each line, prefixed by the host time its first byte
+    arrived, to <log_dir>/<source>.log. Without a log_dir the output is
+    drained and dropped, so the guest never blocks on a full console.
+    """
+
+    # Bytes read from a console per wakeup
+    READ_SIZE = 4096
+
+    def __init__(self, sources, log_dir=None):
+        self.sock_dir = tempfile.mkdtemp()
+        self.log_dir = log_dir
+        self.listeners = {}
+        self.conns = {}
+        self.logs = {}
+        self.pending = {}
+        self.wake_read, self.wake_write = os.pipe()
+        self.thread = None
+        # Total bytes received from all consoles, a sign of guest progress
+        self.received = 0
+
+        for source in sources:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.bind(self.path(source))
+            sock.listen(1)
+            self.listeners[sock.fileno()] = (source, sock)
+            self.pending[source] = (None, "")
+            if log_dir:
+                self.logs[source] = open(self.log_path(source), "a")
+
+    def path(self, source):
+        """Returns the socket QEMU should connect a console source to"""
+        return os.path.join(self.sock_dir, source)
+
+    def log_path(self, source):
+        return os.path.join(self.log_dir, "%s.log" % source)
+
+    def sources(self):
+        return sorted(source for source, _ in self.listeners.values())
+
+    def start(self):
+        self.thread = threading.Thread(target=self._collect)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        """Drains what the consoles have sent, then closes everything"""
+        if self.thread:
+            os.write(self.wake_write, "x")
+            self.thread.join()
+            self.thread = None
+        for source in self.pending:
+            self._flush(source)
+        for _, sock in self.conns.values() + self.listeners.values():
+            sock.close()
+        for log in self.logs.values():
+            log.close()
+        self.conns = {}
+        self.listeners = {}
+        self.logs = {}
+        os.close(self.wake_read)
+        os.close(self.wake_write)
+        shutil.rmtree(self.sock_dir)
+
+    def _write(self, source, data, now):
+        """Splits data into lines and logs the complete ones"""
+        self.received += len(data)
+        start, line = self.pending[source]
+        for chunk in data.splitlines(True):
+            if not line:
+                start = now
+            line += chunk
+            if line.endswith("\n") or line.endswith("\r"):
+                self._log(source, start, line)
+                line = ""
+        self.pending[source] = (start, line)
+
+    def _flush(self, source):
+        start, line = self.pending[source]
+        if line:
+            self._log(source, start, line)
+        self.pending[source] = (None, "")
+
+    def _log(self, source, timestamp, line):
+        log = self.logs.get(source)
+        if log:
+            log.write("%.6f %s\n" % (timestamp, line.rstrip("\r\n")))
+            log.flush()
+
+    def _read(self, epoll, fd):
+        """Reads one chunk from a console, returning False at end of stream"""
+        source, conn = self.conns[fd]
+        try:
+            data = conn.recv(self.READ_SIZE)
+        except socket.error as exn:
+            if exn.errno in (errno.EAGAIN, errno.EINTR):
+                return True
+            data = ""
+        if not data:
+            epoll.unregister(fd)
+            conn.close()
+            del self.conns[fd]
+            self._flush(source)
+            return False
+        self._write(source, data, time.time())
+        return True
+
+    def _collect(self):
+        epoll = select.epoll()
+        epoll.register(self.wake_read, select.EPOLLIN)
+        for fd in self.listeners:
+            epoll.register(fd, select.EPOLLIN)
+
+        try:
+            while True:
+                try:
+                    events = epoll.poll()
+                except IOError as exn:
+                    if exn.errno == errno.EINTR:
+                        continue
+                    raise
+                for fd, _ in events:
+                    if fd == self.wake_read:
+                        # Stopping: pick up whatever is still buffered
+                        for conn_fd in self.conns.keys():
+                            while self._read(epoll, conn_fd):
+                                if not select.select([conn_fd], [], [], 0)[0]:
+                                    break
+                        return
+                    if fd in self.listeners:
+                        source, sock = self.listeners[fd]
+                        conn, _ = sock.accept()
+                        conn.setblocking(False)
+                        self.conns[conn.fileno()] = (source, conn)
+                        epoll.register(conn.fileno(), select.EPOLLIN)
+                    elif fd in self.conns:
+                        self._read(epoll, fd)
+        finally:
+            epoll.close()
@@ -0,0 +1,127 @@
+"""Captures guest memory dumps of failed runs for offline triage"""
+
+import json
+import os
+import sys
+import time
+
+
+class CoreDumper(object):
+    """Dumps guest memory through QMP dump-guest-memory
+
+    The dump is written by QEMU in the background (detach), in the fastest
+    compressed format QEMU supports, while the runner carries on with its
+    other error handling. Dumps that exceed budget bytes are discarded. Each
+    dump gets a manifest describing the images the guest ran, so it can be
+    loaded into a debugger without the original run.
+    """
+
+    # Preferred formats, fastest to compress first
+    FORMATS = ["kdump-snappy", "kdump-lzo", "kdump-zlib", "elf"]
+
+    def __init__(self, dump_dir, name, budget, images, guest_size,
+                 timeout=300):
+        self.dump_dir = dump_dir
+        self.name = name
+        self.budget = budget
+        self.images = images
+        self.guest_size = guest_size
+        self.timeout = timeout
+        self.qemu_cmd = None
+        self.command_pipe = None
+        self.format = None
+        self.started = None
+        self.done = False
+
+    def path(self):
+        return os.path.join(self.dump_dir, "%s.core" % self.name)
+
+    def manifest_path(self):
+        return os.path.join(self.dump_dir, "%s.json" % self.name)
+
+    def pick_format(self, command_pipe):
+        res = command_pipe.qmp_execute("query-dump-guest-memory-capability")
+        if res and res.has_key("return"):
+            supported = res["return"]["formats"]
+        else:
+            supported = ["elf"]
+        for dump_format in self.FORMATS:
+            # An uncompressed dump is as large as guest memory
+            if dump_format == "elf" and self.guest_size > self.budget:
+                continue
+            if dump_format in supported:
+                return dump_format
+        return None
+
+    def start(self, command_pipe):
+        """Starts dumping in the background; only the first call dumps"""
+        if self.done or self.started:
+            return
+        self.format = self.pick_format(command_pipe)
+        if not self.format:
+            self.finish("skipped: no format fits the %d byte budget" %
+                        self.budget)
+            return
+        if not os.path.isdir(self.dump_dir):
+            os.makedirs(self.dump_dir)
+        res = command_pipe.qmp_execute("dump-guest-memory", {
+            "paging": False,
+            "protocol": "file:%s" % self.path(),
+            "detach": True,
+            "format": self.format,
+        })
+        if not res or not res.has_key("return"):
+            self.finish("failed to start")
+            return
+        self.command_pipe = command_pipe
+        self.started = time.time()
+
+    def wait(self):
+        """Waits for a started dump to complete and writes its manifest"""
+        if self.done or not self.started:
+            return
+        status = "timed out"
+        while time.time() - self.started < self.timeout:
+            res = self.command_pipe.qmp_execute("query-dump")
+            if not res or not res.has_key("return"):
+                status = "lost track of dump"
+                break
+            if res["return"]["status"] != "active":
+                status = res["return"]["status"]
+                break
+            time.sleep(0.2)
+
+        if (status == "completed" and
+                os.path.getsize(self.path()) > self.budget):
+            status = "discarded: larger than %d byte budget" % self.budget
+        if status != "completed" and os.path.exists(self.path()):
+            os.remove(self.path())
+        self.finish(status)
+
+    def finish(self, status):
+        self.done = True
+        duration = time.time() - self.started if self.started else 0
+        images = {}
+        for name, path in sorted(self.images.items()):
+            try:
+                stat = os.stat(path)
+                images[name] = {"path": os.path.realpath(path),
+                                "size": stat.st_size, "mtime": stat.st_mtime}
+            except OSError:
+                images[name] = {"path": path, "missing": True}
+        dump = os.path.basename(self.path()) if status == "completed" else None
+        manifest = {
+            "status": status,
+            "dump": dump,
+            "format": self.format,
+            "size": os.path.getsize(self.path()) if dump else 0,
+            "duration": duration,
+            "qemu_cmd": self.qemu_cmd,
+            "images": images,
+        }
+        if not os.path.isdir(self.dump_dir):
+            os.makedirs(self.dump_dir)
+        with open(self.manifest_path(), "w") as manifest_file:
+            json.dump(manifest, manifest_file, indent=2, sort_keys=True)
+        sys.stderr.write("Guest core dump %s: %s\n" % (status,
+                                                       self.manifest_path()))
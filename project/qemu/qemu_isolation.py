@@ -0,0 +1,218 @@
+"""Pins emulator threads to cores of their own and limits their resources"""
+
+import errno
+import os
+import subprocess
+import time
+
+import qemu_registry
+
+
+def parse_cpu_list(text):
+    """Parses a kernel CPU list such as "0-3,6,8-9" """
+    cpus = []
+    for part in text.strip().split(","):
+        if not part:
+            continue
+        if "-" in part:
+            first, last = part.split("-")
+            cpus += range(int(first), int(last) + 1)
+        else:
+            cpus.append(int(part))
+    return cpus
+
+
+def allowed_cpus():
+    """Returns the CPUs this process may run on"""
+    with open("/proc/self/status") as status:
+        for line in status:
+            if line.startswith("Cpus_allowed_list:"):
+                return parse_cpu_list(line.split(":", 1)[1])
+    return range(os.sysconf("SC_NPROCESSORS_ONLN"))
+
+
+def set_affinity(pid, cpus, all_threads=False):
+    """Restricts a thread, or all threads of a process, to cpus
+
+    Python 2 has no sched_setaffinity, so this goes through taskset.
+    """
+    cmd = ["taskset", "-p", "-c", ",".join(str(cpu) for cpu in cpus),
+           str(pid)]
+    if all_threads:
+        cmd.insert(1, "-a")
+    with open(os.devnull, "w") as devnull:
+        subprocess.check_call(cmd, stdout=devnull)
+
+
+def claim_cpus(state_dir, instance, count):
+    """Reserves count CPUs no other live instance has claimed
+
+    The claim is stored in the instance's registry record, so it is
+    released with the record, also when a dead runner's instance is
+    reaped. Returns the CPUs, or None if not enough are free.
+    """
+    with qemu_registry.StateLock(state_dir):
+        taken = set()
+        for other in qemu_registry.instances(state_dir):
+            if (other.record["id"] != instance.record["id"] and
+                    other.owner_alive()):
+                taken.update(other.record.get("cpus", []))
+        free = [cpu for cpu in allowed_cpus() if cpu not in taken]
+        if len(free) < count:
+            return None
+        cpus = free[:count]
+        instance.set("cpus", cpus)
+        return cpus
+
+
+def thread_sched_stats(pid, tid):
+    """Returns scheduling counters of a thread
+
+    wait is the time in ns the thread was runnable but waiting for a CPU,
+    the main source of timing jitter. migrations is None when the kernel
+    does not expose scheduler debug statistics.
+    """
+    task_dir = "/proc/%d/task/%d" % (pid, tid)
+    with open(os.path.join(task_dir, "schedstat")) as schedstat:
+        wait = int(schedstat.read().split()[1])
+    involuntary = 0
+    with open(os.path.join(task_dir, "status")) as status:
+        for line in status:
+            if line.startswith("nonvoluntary_ctxt_switches:"):
+                involuntary = int(line.split()[1])
+    migrations = None
+    try:
+        with open(os.path.join(task_dir, "sched")) as sched:
+            for line in sched:
+                if line.startswith("se.nr_migrations"):
+                    migrations = int(line.split(":")[1])
+    except IOError:
+        pass
+    return {"wait": wait, "involuntary": involuntary,
+            "migrations": migrations}
+
+
+class Cgroup(object):
+    """A cgroup v2 group for one instance, below a delegated parent
+
+    parent must be a cgroup directory the user may create groups in, e.g.
+    one made with "systemd-run --user --scope -p Delegate=yes".
+    """
+
+    CPU_PERIOD = 100000
+
+    def __init__(self, parent, name):
+        self.path = os.path.join(parent, name)
+        # Controllers must be enabled for the children of parent; they may
+        # already be, or be enabled by a parent we cannot write to
+        try:
+            with open(os.path.join(parent, "cgroup.subtree_control"),
+                      "w") as control:
+                control.write("+cpu +memory")
+        except IOError:
+            pass
+        os.mkdir(self.path)
+
+    def _write(self, name, value):
+        with open(os.path.join(self.path, name), "w") as control:
+            control.write(value)
+
+    def limit(self, cpu_quota=None, memory_limit=None):
+        """Limits the group to cpu_quota CPUs and memory_limit bytes"""
+        if cpu_quota:
+            self._write("cpu.max", "%d %d" % (cpu_quota * self.CPU_PERIOD,
+                                              self.CPU_PERIOD))
+        if memory_limit:
+            self._write("memory.max", "%d" % memory_limit)
+
+    def add(self, pid):
+        """Moves a process, with all its threads, into the group"""
+        self._write("cgroup.procs", "%d" % pid)
+
+    def remove(self, timeout=2.0):
+        """Removes the group once its processes have exited"""
+        deadline = time.time() + timeout
+        while True:
+            try:
+                os.rmdir(self.path)
+                return
+            except OSError as exn:
+                if exn.errno == errno.ENOENT:
+                    return
+                # Killed processes take a moment to leave the group
+                if exn.errno != errno.EBUSY or time.time() > deadline:
+                    raise
+            time.sleep(0.1)
+
+
+class Pinning(object):
+    """Pins a QEMU process to a set of CPUs and measures its vCPUs' jitter
+
+    The first CPU is shared by the QEMU main loop, its other threads and
+    helper processes such as the rpmb daemon; each vCPU thread gets one of
+    the other CPUs to itself.
+    """
+
+    def __init__(self, pid, vcpu_threads, helper_pids=()):
+        self.pid = pid
+        self.vcpu_threads = vcpu_threads
+        self.helper_pids = list(helper_pids)
+        self.assignment = None
+        self.started = None
+        self.baseline = {}
+
+    def cpus_needed(self):
+        return len(self.vcpu_threads) + 1
+
+    def pin(self, cpus):
+        main_cpu = cpus[0]
+        # Threads started later inherit the main thread's affinity
+        set_affinity(self.pid, [main_cpu], all_threads=True)
+        for pid in self.helper_pids:
+            set_affinity(pid, [main_cpu], all_threads=True)
+        vcpus = {}
+        for (index, tid), cpu in zip(sorted(self.vcpu_threads.items()),
+                                     cpus[1:]):
+            set_affinity(tid, [cpu])
+            vcpus[index] = cpu
+        self.assignment = {"main": main_cpu, "vcpus": vcpus}
+        self.measure_start()
+
+    def measure_start(self):
+        self.started = time.time()
+        for index, tid in self.vcpu_threads.items():
+            try:
+                self.baseline[index] = thread_sched_stats(self.pid, tid)
+            except (IOError, OSError):
+                continue
+
+    def report(self):
+        """Returns the assignment and per-vCPU scheduling jitter so far
+
+        Must be called while QEMU still runs, as the counters go away with
+        its threads.
+        """
+        duration = time.time() - self.started if self.started else 0
+        vcpus = {}
+        for index, tid in sorted(self.vcpu_threads.items()):
+            before = self.baseline.get(index)
+            try:
+                after = thread_sched_stats(self.pid, tid)
+            except (IOError, OSError):
+                continue
+            if not before:
+                continue
+            migrations = None
+            if after["migrations"] is not None:
+                migrations = after["migrations"] - before["migrations"]
+            wait_ms = (after["wait"] - before["wait"]) / 1e6
+            vcpus[index] = {
+                "cpu": (self.assignment["vcpus"].get(index)
+                        if self.assignment else None),
+                "wait_ms": wait_ms,
+                "wait_ms_per_s": wait_ms / duration if duration else 0,
+                "involuntary": after["involuntary"] - before["involuntary"],
+                "migrations": migrations,
+            }
+        return {"assignment": self.assignment, "duration": duration,
+                "vcpus": vcpus}
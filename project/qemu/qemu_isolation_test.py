@@ -0,0 +1,147 @@
+"""Tests of CPU claims, cgroup limits and vCPU jitter statistics"""
+
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+import qemu_isolation
+import qemu_registry
+
+
+class IsolationTest(unittest.TestCase):
+    """Replaces module functions that read the host for the test's length"""
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.saved = {}
+
+    def tearDown(self):
+        for name, value in self.saved.items():
+            setattr(qemu_isolation, name, value)
+        shutil.rmtree(self.tmp_dir)
+
+    def replace(self, name, value):
+        self.saved.setdefault(name, getattr(qemu_isolation, name))
+        setattr(qemu_isolation, name, value)
+
+
+class ClaimCpusTest(IsolationTest):
+
+    def setUp(self):
+        super(ClaimCpusTest, self).setUp()
+        self.state_dir = os.path.join(self.tmp_dir, "state")
+        self.replace("allowed_cpus", lambda: [0, 1, 2, 3, 4])
+        self.instance = qemu_registry.Instance.create(self.state_dir)
+
+    def other_instance(self, instance_id, cpus, owner=None):
+        record = dict(self.instance.record, id=instance_id, cpus=cpus)
+        if owner:
+            record["owner"] = owner
+        instance = qemu_registry.Instance(self.state_dir, record)
+        instance.save()
+        return instance
+
+    def test_parse_cpu_list(self):
+        self.assertEqual(qemu_isolation.parse_cpu_list("0-3,6,8-9\n"),
+                         [0, 1, 2, 3, 6, 8, 9])
+
+    def test_claims_free_cpus(self):
+        self.other_instance("other", [0, 2])
+        self.assertEqual(qemu_isolation.claim_cpus(self.state_dir,
+                                                   self.instance, 2), [1, 3])
+        # The claim is recorded, so the next runner sees it
+        record = [instance.record for instance
+                  in qemu_registry.instances(self.state_dir)
+                  if instance.record["id"] == self.instance.record["id"]][0]
+        self.assertEqual(record["cpus"], [1, 3])
+
+    def test_collision(self):
+        self.other_instance("other", [0, 1, 2, 3])
+        self.assertEqual(qemu_isolation.claim_cpus(self.state_dir,
+                                                   self.instance, 2), None)
+        self.assertNotIn("cpus", self.instance.record)
+
+    def test_own_and_dead_claims_are_free(self):
+        self.instance.set("cpus", [0, 1])
+        self.other_instance("dead", [2, 3],
+                            owner={"pid": os.getpid(), "start": -1})
+        self.assertEqual(qemu_isolation.claim_cpus(self.state_dir,
+                                                   self.instance, 5),
+                         [0, 1, 2, 3, 4])
+
+
+class CgroupTest(IsolationTest):
+
+    def read(self, *parts):
+        with open(os.path.join(self.tmp_dir, *parts)) as control:
+            return control.read()
+
+    def test_limits(self):
+        cgroup = qemu_isolation.Cgroup(self.tmp_dir, "qemu-1")
+        self.assertEqual(cgroup.path, os.path.join(self.tmp_dir, "qemu-1"))
+        self.assertEqual(self.read("cgroup.subtree_control"), "+cpu +memory")
+        cgroup.limit(cpu_quota=1.5, memory_limit=512 * 1024 * 1024)
+        self.assertEqual(self.read("qemu-1", "cpu.max"), "150000 100000")
+        self.assertEqual(self.read("qemu-1", "memory.max"), "536870912")
+        cgroup.add(1234)
+        self.assertEqual(self.read("qemu-1", "cgroup.procs"), "1234")
+
+    def test_no_limits(self):
+        cgroup = qemu_isolation.Cgroup(self.tmp_dir, "qemu-1")
+        cgroup.limit()
+        self.assertEqual(os.listdir(cgroup.path), [])
+        cgroup.remove()
+        self.assertFalse(os.path.exists(cgroup.path))
+        # Removing a group that is gone already is fine
+        cgroup.remove()
+
+
+class PinningTest(IsolationTest):
+
+    def test_thread_sched_stats(self):
+        pid = os.getpid()
+        stats = qemu_isolation.thread_sched_stats(pid, pid)
+        self.assertTrue(stats["wait"] >= 0)
+        self.assertTrue(stats["involuntary"] >= 0)
+
+    def test_jitter(self):
+        samples = {
+            1: [{"wait": 1000000, "involuntary": 3, "migrations": 1},
+                {"wait": 5000000, "involuntary": 10, "migrations": 4}],
+            2: [{"wait": 0, "involuntary": 0, "migrations": None},
+                {"wait": 2000000, "involuntary": 1, "migrations": None}],
+        }
+        self.replace("thread_sched_stats",
+                     lambda pid, tid: samples[tid].pop(0))
+        self.replace("set_affinity", lambda pid, cpus, all_threads=False:
+                     None)
+        pinning = qemu_isolation.Pinning(100, {0: 1, 1: 2})
+        self.assertEqual(pinning.cpus_needed(), 3)
+        pinning.pin([4, 5, 6])
+        self.assertEqual(pinning.assignment,
+                         {"main": 4, "vcpus": {0: 5, 1: 6}})
+        pinning.started = time.time() - 2.0
+
+        report = pinning.report()
+        vcpu = report["vcpus"][0]
+        self.assertEqual((vcpu["cpu"], vcpu["wait_ms"], vcpu["involuntary"],
+                          vcpu["migrations"]), (5, 4.0, 7, 3))
+        self.assertAlmostEqual(vcpu["wait_ms_per_s"], 2.0, places=1)
+        vcpu = report["vcpus"][1]
+        self.assertEqual((vcpu["cpu"], vcpu["wait_ms"], vcpu["migrations"]),
+                         (6, 2.0, None))
+        self.assertAlmostEqual(vcpu["wait_ms_per_s"], 1.0, places=1)
+
+    def test_jitter_without_baseline(self):
+        def sched_stats(pid, tid):
+            raise IOError("thread exited")
+        self.replace("thread_sched_stats", sched_stats)
+        pinning = qemu_isolation.Pinning(100, {0: 1})
+        pinning.measure_start()
+        self.assertEqual(pinning.report()["vcpus"], {})
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,177 @@
+#!/usr/bin/env python2.7
+"""Append-only store of runner output, indexed by test"""
+
+import argparse
+import json
+import mmap
+import os
+import sys
+import threading
+import time
+
+
+class LogStore(object):
+    """Append-only logs with an index of where each test's output lies
+
+    Output is appended to one file per stream, <store_dir>/<stream>.log,
+    e.g. the QEMU console, test output and the secure consoles. For every
+    test phase, index.jsonl records the byte range the phase occupies in
+    each stream, so one test's output can be read back with a seek instead
+    of a scan of the whole log.
+    """
+
+    INDEX = "index.jsonl"
+
+    def __init__(self, store_dir, run=None):
+        if not os.path.isdir(store_dir):
+            os.makedirs(store_dir)
+        self.store_dir = store_dir
+        self.run = run if run else "%d-%d" % (time.time(), os.getpid())
+        self.files = {}
+        self.tracked = set()
+        self.spans = {}
+        self.lock = threading.Lock()
+        self.index = open(os.path.join(store_dir, self.INDEX), "a")
+
+    def path(self, stream):
+        return os.path.join(self.store_dir, "%s.log" % stream)
+
+    def stream(self, stream):
+        """Returns a file appending to a stream, e.g. for a subprocess"""
+        with self.lock:
+            if stream not in self.files:
+                self.files[stream] = open(self.path(stream), "ab+")
+                self.tracked.add(stream)
+            return self.files[stream]
+
+    def track(self, stream):
+        """Indexes a stream that another writer appends to"""
+        with self.lock:
+            self.tracked.add(stream)
+
+    def write(self, stream, data):
+        log = self.stream(stream)
+        with self.lock:
+            log.write(data)
+            log.flush()
+
+    def size(self, stream):
+        try:
+            return os.path.getsize(self.path(stream))
+        except OSError:
+            return 0
+
+    def begin(self, test, phase):
+        """Marks the start of a test phase in every stream"""
+        with self.lock:
+            offsets = dict((stream, self.size(stream))
+                           for stream in self.tracked)
+            self.spans[(test, phase)] = (time.time(), offsets)
+
+    def end(self, test, phase, result=None):
+        """Indexes the output a test phase added to each stream"""
+        with self.lock:
+            start_time, offsets = self.spans.pop((test, phase))
+            end_time = time.time()
+            for stream, start in sorted(offsets.items()):
+                end = self.size(stream)
+                if end == start:
+                    continue
+                json.dump({"run": self.run, "test": test, "phase": phase,
+                           "stream": stream, "start": start, "end": end,
+                           "time": start_time,
+                           "duration": end_time - start_time,
+                           "result": result}, self.index)
+                self.index.write("\n")
+            self.index.flush()
+
+    def add(self, test, phase, stream, data, start_time, result=None):
+        """Appends a finished test phase's output and indexes it at once"""
+        log = self.stream(stream)
+        with self.lock:
+            start = self.size(stream)
+            log.write(data)
+            log.flush()
+            json.dump({"run": self.run, "test": test, "phase": phase,
+                       "stream": stream, "start": start,
+                       "end": start + len(data), "time": start_time,
+                       "duration": time.time() - start_time,
+                       "result": result}, self.index)
+            self.index.write("\n")
+            self.index.flush()
+
+    def close(self):
+        with self.lock:
+            for log in self.files.values():
+                log.close()
+            self.files = {}
+            self.index.close()
+
+
+def load_index(store_dir):
+    """Returns the index entries of a store, oldest first"""
+    entries = []
+    with open(os.path.join(store_dir, LogStore.INDEX)) as index:
+        for line in index:
+            try:
+                entries.append(json.loads(line))
+            except ValueError:
+                # Torn final line of a runner that was killed mid-write
+                continue
+    return entries
+
+
+def read_span(store_dir, entry, use_mmap=False):
+    """Reads the output an index entry points at"""
+    path = os.path.join(store_dir, "%s.log" % entry["stream"])
+    with open(path, "rb") as log:
+        if use_mmap:
+            mapped = mmap.mmap(log.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                return mapped[entry["start"]:entry["end"]]
+            finally:
+                mapped.close()
+        log.seek(entry["start"])
+        return log.read(entry["end"] - entry["start"])
+
+
+def main():
+    argument_parser = argparse.ArgumentParser(
+        description="Show the output of tests recorded in a log store")
+    argument_parser.add_argument("store_dir")
+    argument_parser.add_argument("--list", action="store_true",
+                                 help="list indexed test phases")
+    argument_parser.add_argument("--test")
+    argument_parser.add_argument("--phase")
+    argument_parser.add_argument("--stream")
+    argument_parser.add_argument("--run", help="run id, or 'last'")
+    argument_parser.add_argument("--mmap", action="store_true",
+                                 help="read logs through a memory map")
+    args = argument_parser.parse_args()
+
+    entries = load_index(args.store_dir)
+    run = args.run
+    if run == "last" and entries:
+        run = entries[-1]["run"]
+    entries = [entry for entry in entries
+               if (run is None or entry["run"] == run) and
+               (args.test is None or entry["test"] == args.test) and
+               (args.phase is None or entry["phase"] == args.phase) and
+               (args.stream is None or entry["stream"] == args.stream)]
+
+    for entry in entries:
+        if args.list:
+            print "%s %-8s %-10s %10d bytes %8.1fs result=%s  %s" % (
+                entry["run"], entry["phase"], entry["stream"],
+                entry["end"] - entry["start"], entry["duration"],
+                entry["result"], entry["test"])
+            continue
+        sys.stdout.write("==== %s %s [%s] ====\n" % (
+            entry["phase"], entry["test"], entry["stream"]))
+        sys.stdout.write(read_span(args.store_dir, entry, args.mmap))
+    if not entries:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,170 @@
+#!/usr/bin/env python2.7
+"""Reports how much memory concurrent QEMU instances share
+
+For every live instance in the registry, the QEMU process's memory is split
+into what only it maps (unique) and what it shares with other processes,
+e.g. page cache of the same images or pages merged by KSM, as read from
+/proc/<pid>/smaps_rollup. "measure" starts N runners, waits for them to
+boot, reports on them and stops them, to compare guest RAM backends.
+"""
+
+import argparse
+import os
+import subprocess
+import sys
+import time
+
+import qemu_registry
+
+KSM_DIR = "/sys/kernel/mm/ksm"
+
+
+def smaps_rollup(pid):
+    """Returns the counters of /proc/<pid>/smaps_rollup in bytes"""
+    counters = {}
+    with open("/proc/%d/smaps_rollup" % pid) as rollup:
+        for line in rollup:
+            fields = line.split()
+            if len(fields) == 3 and fields[2] == "kB":
+                counters[fields[0].rstrip(":")] = int(fields[1]) * 1024
+    return counters
+
+
+def memory_usage(pid):
+    """Splits the memory of a process into unique and shared bytes
+
+    Hugetlb pages are not part of Rss, so they are added separately. pss
+    charges each shared page to its users in equal parts, so the pss of all
+    instances adds up to what they use together.
+    """
+    counters = smaps_rollup(pid)
+    unique = (counters.get("Private_Clean", 0) +
+              counters.get("Private_Dirty", 0) +
+              counters.get("Private_Hugetlb", 0))
+    shared = (counters.get("Shared_Clean", 0) +
+              counters.get("Shared_Dirty", 0) +
+              counters.get("Shared_Hugetlb", 0))
+    return {"rss": unique + shared, "pss": counters.get("Pss", 0),
+            "unique": unique, "shared": shared,
+            "ksm": counters.get("KSM")}
+
+
+def ksm_status():
+    """Returns whether KSM runs and how many pages it merged, if known"""
+    status = {}
+    for name in ["run", "pages_shared", "pages_sharing"]:
+        try:
+            with open(os.path.join(KSM_DIR, name)) as counter:
+                status[name] = int(counter.read())
+        except (IOError, ValueError):
+            continue
+    return status
+
+
+def instance_usage(state_dir, since=None):
+    """Returns (instance id, usage) of live QEMUs in the registry
+
+    since limits the report to instances created after that time.
+    """
+    usage = []
+    for instance in qemu_registry.instances(state_dir):
+        record = instance.record
+        if since is not None and record["created"] < since:
+            continue
+        qemu = record["processes"].get("qemu")
+        if not qemu or not qemu_registry.proc_alive(qemu):
+            continue
+        try:
+            usage.append((record["id"], memory_usage(qemu["pid"])))
+        except IOError:
+            # QEMU exited while we were looking
+            continue
+    return usage
+
+
+def report(usage, out=sys.stdout):
+    mib = 1024.0 * 1024
+    out.write("%-20s %9s %9s %9s %9s %9s\n" % (
+        "instance", "rss MiB", "pss MiB", "unique", "shared", "ksm"))
+    for instance_id, mem in usage:
+        out.write("%-20s %9.1f %9.1f %9.1f %9.1f %9s\n" % (
+            instance_id, mem["rss"] / mib, mem["pss"] / mib,
+            mem["unique"] / mib, mem["shared"] / mib,
+            "-" if mem["ksm"] is None else "%.1f" % (mem["ksm"] / mib)))
+    if not usage:
+        return
+    total_rss = sum(mem["rss"] for _, mem in usage)
+    total_pss = sum(mem["pss"] for _, mem in usage)
+    out.write("%d instances: %.1f MiB resident in total, %.1f MiB each on "
+              "average; %.1f MiB (%.0f%%) saved by sharing\n" % (
+                  len(usage), total_pss / mib, total_pss / mib / len(usage),
+                  (total_rss - total_pss) / mib,
+                  100.0 * (total_rss - total_pss) / total_rss
+                  if total_rss else 0))
+    ksm = ksm_status()
+    if ksm:
+        out.write("KSM %s, %d pages shared by %d mappings\n" % (
+            "running" if ksm.get("run") == 1 else "stopped",
+            ksm.get("pages_shared", 0), ksm.get("pages_sharing", 0)))
+
+
+def stop_runners(state_dir, runners, since, grace=10.0):
+    """Stops runners started for a measurement and waits for them
+
+    Their emulators are stopped through the registry, so the runners clean
+    up after themselves and exit; runners still alive after grace seconds
+    are terminated.
+    """
+    ids = [instance.record["id"]
+           for instance in qemu_registry.instances(state_dir)
+           if instance.record["created"] >= since]
+    qemu_registry.stop(state_dir, ids)
+    deadline = time.time() + grace
+    while (time.time() < deadline and
+           any(runner.poll() is None for runner in runners)):
+        time.sleep(0.1)
+    for runner in runners:
+        if runner.poll() is None:
+            runner.terminate()
+        runner.wait()
+
+
+def main():
+    argument_parser = argparse.ArgumentParser(
+        description="Report unique and shared memory of QEMU instances")
+    argument_parser.add_argument("--state-dir",
+                                 default=qemu_registry.default_state_dir())
+    subparsers = argument_parser.add_subparsers(dest="command")
+    subparsers.add_parser("report", help="report on running instances")
+    measure_parser = subparsers.add_parser(
+        "measure", help="run N instances of a command and report on them")
+    measure_parser.add_argument("-n", "--instances", type=int, default=2)
+    measure_parser.add_argument("--settle", type=float, default=120,
+                                help="seconds to let the instances boot")
+    measure_parser.add_argument("runner_command", metavar="command",
+                                nargs=argparse.REMAINDER,
+                                help="runner command, e.g. ./run "
+                                     "--shell-command 'sleep 600' "
+                                     "--memory-backend memfd")
+    args = argument_parser.parse_args()
+
+    if args.command == "report":
+        report(instance_usage(args.state_dir))
+        return
+
+    command = args.runner_command
+    if command and command[0] == "--":
+        command = command[1:]
+    if not command:
+        argument_parser.error("measure needs a runner command")
+    started = time.time()
+    runners = [subprocess.Popen(command) for _ in range(args.instances)]
+    try:
+        time.sleep(args.settle)
+        report(instance_usage(args.state_dir, since=started))
+    finally:
+        stop_runners(args.state_dir, runners, started)
+
+
+if __name__ == "__main__":
+    main()
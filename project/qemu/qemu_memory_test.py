@@ -0,0 +1,39 @@
+"""Tests of stopping the runners of a memory measurement"""
+
+import shutil
+import subprocess
+import tempfile
+import time
+import unittest
+
+import qemu_memory
+import qemu_registry
+
+
+class StopRunnersTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_stops_instances_and_runners(self):
+        started = time.time()
+        # Exits once its emulator is gone, like a runner
+        runner = subprocess.Popen(["sh", "-c", "sleep 60 & echo $!; wait; "
+                                   "exit 0"], stdout=subprocess.PIPE)
+        emulator = int(runner.stdout.readline())
+        instance = qemu_registry.Instance.create(self.tmp_dir)
+        instance.add_process("qemu", emulator)
+        stubborn = subprocess.Popen(["sleep", "60"])
+
+        qemu_memory.stop_runners(self.tmp_dir, [runner, stubborn], started,
+                                 grace=1.0)
+        self.assertEqual(runner.returncode, 0)
+        self.assertNotEqual(stubborn.returncode, None)
+        self.assertEqual(instance.live_processes(), [])
+
+
+if __name__ == "__main__":
+    unittest.main()
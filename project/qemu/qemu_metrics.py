@@ -0,0 +1,246 @@
+#!/usr/bin/env python2.7
+"""Counters and histograms of runner activity, in Prometheus text format
+
+Runners count into an in-memory Metrics object, which costs a dict update
+per event. At the end of a run the counts are merged, under a lock, into a
+state file shared by all runners of the host, and rendered into a textfile
+for node_exporter's textfile collector. The same totals can be served over
+HTTP by "qemu_metrics.py TEXTFILE --serve PORT", and a runner can serve its
+own while it runs.
+"""
+
+import argparse
+import BaseHTTPServer
+import fcntl
+import json
+import os
+import threading
+
+PREFIX = "trusty_qemu_"
+
+BOOT_BUCKETS = [1, 2, 5, 10, 20, 30, 60, 120, 300]
+TEST_BUCKETS = [0.1, 0.5, 1, 5, 10, 30, 60, 120, 300, 600, 1800]
+ADB_BUCKETS = [0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60]
+SETUP_BUCKETS = [0.01, 0.05, 0.1, 0.25, 0.5, 1, 2, 5, 10, 30]
+
+# name: (type, help, histogram buckets)
+DEFINITIONS = {
+    "runs": ("counter", "Runner invocations, by outcome", None),
+    "boots": ("counter", "Emulator launches", None),
+    "boot_seconds": ("histogram",
+                     "Seconds from QEMU launch to reaching a boot stage",
+                     BOOT_BUCKETS),
+    "setup_seconds": ("histogram", "Seconds taken by each setup step",
+                      SETUP_BUCKETS),
+    "test_seconds": ("histogram", "Test durations in seconds", TEST_BUCKETS),
+    "adb_seconds": ("histogram", "adb command latency in seconds",
+                    ADB_BUCKETS),
+    "timeouts": ("counter", "Steps killed for running too long or stalling",
+                 None),
+    "unclean_exits": ("counter", "QEMU instances that refused to quit",
+                      None),
+    "port_alloc_retries": ("counter",
+                           "adb port pairs skipped because they were in use",
+                           None),
+}
+
+
+def label_key(labels):
+    return json.dumps(sorted(labels.items()))
+
+
+def empty_values():
+    return {"counters": {}, "histograms": {}}
+
+
+def merge(values, other):
+    """Adds the counts in other to values"""
+    for name, series in other["counters"].items():
+        totals = values["counters"].setdefault(name, {})
+        for key, value in series.items():
+            totals[key] = totals.get(key, 0) + value
+    for name, series in other["histograms"].items():
+        totals = values["histograms"].setdefault(name, {})
+        for key, counts in series.items():
+            if key in totals:
+                totals[key] = [a + b for a, b in zip(totals[key], counts)]
+            else:
+                totals[key] = list(counts)
+    return values
+
+
+def format_labels(key, extra=None):
+    labels = json.loads(key)
+    if extra:
+        labels.append(extra)
+    if not labels:
+        return ""
+    return "{%s}" % ",".join(
+        "%s=\"%s\"" % (name, str(value).replace("\\", "\\\\")
+                       .replace("\"", "\\\"").replace("\n", "\\n"))
+        for name, value in labels)
+
+
+def render(values):
+    """Returns values in the Prometheus text exposition format"""
+    lines = []
+    for name in sorted(DEFINITIONS):
+        metric_type, help_text, buckets = DEFINITIONS[name]
+        full_name = PREFIX + name
+        if metric_type == "counter":
+            full_name += "_total"
+            series = values["counters"].get(name, {})
+        else:
+            series = values["histograms"].get(name, {})
+        lines.append("# HELP %s %s" % (full_name, help_text))
+        lines.append("# TYPE %s %s" % (full_name, metric_type))
+        for key in sorted(series):
+            if metric_type == "counter":
+                lines.append("%s%s %s" % (full_name, format_labels(key),
+                                          series[key]))
+                continue
+            counts = series[key]
+            cumulative = 0
+            for bound, count in zip(buckets, counts):
+                cumulative += count
+                lines.append("%s_bucket%s %d" % (
+                    full_name, format_labels(key, ("le", "%g" % bound)),
+                    cumulative))
+            cumulative += counts[len(buckets)]
+            lines.append("%s_bucket%s %d" % (
+                full_name, format_labels(key, ("le", "+Inf")), cumulative))
+            lines.append("%s_sum%s %s" % (full_name, format_labels(key),
+                                          repr(counts[-2])))
+            lines.append("%s_count%s %d" % (full_name, format_labels(key),
+                                            counts[-1]))
+    return "\n".join(lines) + "\n"
+
+
+class Metrics(object):
+    """Thread-safe counters and histograms of one runner
+
+    A histogram series is stored as its bucket counts (the last one for
+    values above every bound), followed by the sum and count of values.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.values = empty_values()
+
+    def inc(self, name, value=1, **labels):
+        key = label_key(labels)
+        with self.lock:
+            series = self.values["counters"].setdefault(name, {})
+            series[key] = series.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        buckets = DEFINITIONS[name][2]
+        key = label_key(labels)
+        with self.lock:
+            series = self.values["histograms"].setdefault(name, {})
+            counts = series.setdefault(key, [0] * (len(buckets) + 3))
+            index = 0
+            while index < len(buckets) and value > buckets[index]:
+                index += 1
+            counts[index] += 1
+            counts[-2] += value
+            counts[-1] += 1
+
+    def take(self):
+        """Returns the counts so far and starts counting from zero"""
+        with self.lock:
+            values = self.values
+            self.values = empty_values()
+        return values
+
+    def render(self):
+        with self.lock:
+            return render(self.values)
+
+
+def state_path(textfile):
+    return "%s.state.json" % textfile
+
+
+def load_state(textfile):
+    try:
+        with open(state_path(textfile)) as state_file:
+            return json.load(state_file)
+    except (IOError, ValueError):
+        return empty_values()
+
+
+def flush_textfile(metrics, textfile):
+    """Adds a runner's counts to the host totals and rewrites the textfile
+
+    Runners sharing a textfile are serialized with a lock file. Both files
+    are replaced atomically, so collectors never see a partial write.
+    """
+    with open("%s.lock" % textfile, "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        values = merge(load_state(textfile), metrics.take())
+        for path, contents in [(state_path(textfile), json.dumps(values)),
+                               (textfile, render(values))]:
+            tmp_path = "%s.tmp%d" % (path, os.getpid())
+            with open(tmp_path, "w") as out:
+                out.write(contents)
+            os.rename(tmp_path, path)
+
+
+class MetricsServer(object):
+    """Serves the text returned by source() at /metrics"""
+
+    def __init__(self, port, source, address="127.0.0.1"):
+        class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?")[0] != "/metrics":
+                    self.send_error(404)
+                    return
+                body = source()
+                self.send_response(200)
+                self.send_header("Content-Type",
+                                 "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = BaseHTTPServer.HTTPServer((address, port), Handler)
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        if self.thread:
+            self.server.shutdown()
+            self.thread.join()
+            self.thread = None
+        self.server.server_close()
+
+
+def main():
+    argument_parser = argparse.ArgumentParser(
+        description="Show or serve the runner metrics of this host")
+    argument_parser.add_argument("textfile",
+                                 help="textfile runners flush metrics to")
+    argument_parser.add_argument("--serve", type=int, metavar="PORT",
+                                 help="serve the totals over HTTP")
+    argument_parser.add_argument("--address", default="127.0.0.1")
+    args = argument_parser.parse_args()
+
+    if not args.serve:
+        print render(load_state(args.textfile)),
+        return
+    server = MetricsServer(args.serve,
+                           lambda: render(load_state(args.textfile)),
+                           args.address)
+    server.server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,68 @@
+"""Tests of the QEMU command line built for a configuration"""
+
+import unittest
+
+import qemu_options
+
+
+class MemoryOptionsTest(unittest.TestCase):
+
+    def memory_object(self, **kwargs):
+        options = qemu_options.QemuArm64Options(None, **kwargs)
+        args = options.memory_options()
+        self.assertEqual(args[0], "-object")
+        backend, props = args[1].split(",", 1)
+        return backend, props.split(",")
+
+    def test_no_backend(self):
+        options = qemu_options.QemuArm64Options(None)
+        self.assertEqual(options.memory_options(), [])
+
+    def test_memfd_is_private_and_mergeable(self):
+        # memfd is shared by default, and KSM only merges private mappings
+        backend, props = self.memory_object(memory_backend="memfd")
+        self.assertEqual(backend, "memory-backend-memfd")
+        self.assertIn("merge=on", props)
+        self.assertIn("share=off", props)
+        self.assertNotIn("share=on", props)
+
+    def test_file_is_private_and_mergeable(self):
+        backend, props = self.memory_object(memory_backend="file")
+        self.assertEqual(backend, "memory-backend-file")
+        self.assertIn("merge=on", props)
+        self.assertIn("share=off", props)
+        self.assertIn("mem-path=/dev/shm", props)
+
+    def test_hugepages_are_not_merged(self):
+        _, props = self.memory_object(memory_backend="memfd", hugepages=True)
+        self.assertIn("hugetlb=on", props)
+        self.assertNotIn("merge=on", props)
+        _, props = self.memory_object(memory_backend="file", hugepages=True)
+        self.assertIn("mem-path=/dev/hugepages", props)
+        self.assertNotIn("merge=on", props)
+
+
+class SerialPortOptionsTest(unittest.TestCase):
+
+    def test_ports_on_rpmb_bus(self):
+        # The fast boot profile's kernel console adds a second controller,
+        # so the rpmb and test-runner ports name theirs
+        options = qemu_options.QemuArm64Options(None, boot_profile="fast")
+        args = options.rpmb_options("rpmb.sock")
+        args += options.serial_port("testrunner0")
+        args += options.console_options({"serial1": "s1", "serial2": "s2",
+                                         "hvc0": "hvc0.sock"})
+        devices = [args[i + 1] for i, arg in enumerate(args)
+                   if arg == "-device"]
+        self.assertEqual(devices, [
+            "virtio-serial,id=serialports",
+            "virtserialport,bus=serialports.0,chardev=rpmb0,name=rpmb0",
+            "virtserialport,bus=serialports.0,chardev=testrunner0,"
+            "name=testrunner0",
+            "virtio-serial,id=kernelcon",
+            "virtconsole,bus=kernelcon.0,chardev=hvc0",
+        ])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,506 @@
+#!/usr/bin/env python2.7
+"""Deduplicated, chunk-indexed packages of a QEMU build
+
+A package is a directory holding manifest.json, pack files under packs/ and
+a copy of this tool. Files are split into content-defined chunks, each
+chunk is stored once, and the manifest lists the chunks of every file and
+where each chunk lives. A package built against a previous one (--base)
+only carries the chunks the previous one lacks, so consumers that already
+have the previous package only fetch the new pack and manifest.
+
+Consumers extract lazily: "extract" and "run" only write the files a
+config.json needs, and skip files already extracted from the same chunks.
+"""
+
+import argparse
+import errno
+import fcntl
+import hashlib
+import json
+import mmap
+import os
+import shutil
+import sys
+import zlib
+
+FORMAT = 1
+MANIFEST = "manifest.json"
+PACK_DIR = "packs"
+STATE = ".package_state.json"
+
+
+class PackageError(Exception):
+    """The package is malformed, incomplete or does not fit the request."""
+
+
+def chunks(data_file, block_size=4096, mask=0xf, min_blocks=4,
+           max_blocks=64):
+    """Splits a file into content-defined chunks
+
+    A chunk ends after a block whose checksum has all mask bits set, so
+    boundaries follow the content rather than offsets, and changing a few
+    blocks only changes the chunks around them. Boundaries fall on block
+    multiples, which keeps the scan fast in Python and matches how the
+    filesystem images that make up most of a package change. With the
+    defaults, chunks are 64KiB on average, between 16KiB and 256KiB.
+    """
+    read_size = block_size * 256
+    chunk = []
+    blocks = 0
+    while True:
+        data = data_file.read(read_size)
+        if not data:
+            break
+        for offset in range(0, len(data), block_size):
+            block = data[offset:offset + block_size]
+            chunk.append(block)
+            blocks += 1
+            if (blocks >= max_blocks or
+                    (blocks >= min_blocks and
+                     zlib.crc32(block) & mask == mask)):
+                yield "".join(chunk)
+                chunk = []
+                blocks = 0
+    if chunk:
+        yield "".join(chunk)
+
+
+def manifest_id(manifest):
+    """Returns the digest identifying a manifest's contents"""
+    contents = dict((key, value) for key, value in manifest.items()
+                    if key != "id")
+    return hashlib.sha1(json.dumps(contents, sort_keys=True)).hexdigest()
+
+
+def load_manifest(package_dir):
+    with open(os.path.join(package_dir, MANIFEST)) as manifest_file:
+        manifest = json.load(manifest_file)
+    if manifest.get("format") != FORMAT:
+        raise PackageError("%s: unsupported package format %r" %
+                           (package_dir, manifest.get("format")))
+    return manifest
+
+
+def write_json(path, data):
+    """Replaces a JSON file atomically"""
+    tmp_path = "%s.tmp%d" % (path, os.getpid())
+    with open(tmp_path, "w") as out:
+        json.dump(data, out, sort_keys=True)
+    os.rename(tmp_path, path)
+
+
+def walk(root, paths):
+    """Yields the files under paths (relative to root), following links"""
+    for path in paths:
+        full_path = os.path.join(root, path)
+        if not os.path.isdir(full_path):
+            yield os.path.normpath(path)
+            continue
+        for dir_path, dir_names, file_names in os.walk(full_path,
+                                                       followlinks=True):
+            dir_names.sort()
+            for file_name in sorted(file_names):
+                yield os.path.relpath(os.path.join(dir_path, file_name),
+                                      root)
+
+
+def install_tool(package_dir):
+    """Makes a package usable on its own: this tool and a run wrapper"""
+    tool = os.path.join(package_dir, "qemu_package.py")
+    source = os.path.splitext(os.path.realpath(__file__))[0] + ".py"
+    shutil.copy(source, tool)
+    run = os.path.join(package_dir, "run")
+    with open(run, "w") as run_script:
+        run_script.write("#!/bin/sh\n"
+                         "SCRIPT_DIR=$(dirname \"$0\")\n"
+                         "exec python2.7 \"$SCRIPT_DIR/%s\" run "
+                         "\"$SCRIPT_DIR\" \"$@\"\n" % os.path.basename(tool))
+    os.chmod(run, 0755)
+
+
+class PackWriter(object):
+    """Appends new chunks to a pack file, named by its digest once done"""
+
+    def __init__(self, pack_dir, level=6):
+        if not os.path.isdir(pack_dir):
+            os.makedirs(pack_dir)
+        self.pack_dir = pack_dir
+        self.level = level
+        self.tmp_path = os.path.join(pack_dir, ".new.%d" % os.getpid())
+        self.pack = open(self.tmp_path, "wb")
+        self.digest = hashlib.sha1()
+        self.offset = 0
+        self.entries = {}
+
+    def add(self, chunk_id, chunk):
+        """Stores a chunk compressed, unless that does not save space"""
+        stored = zlib.compress(chunk, self.level)
+        compressed = len(stored) < len(chunk)
+        if not compressed:
+            stored = chunk
+        self.pack.write(stored)
+        self.digest.update(stored)
+        self.entries[chunk_id] = [self.offset, len(stored), len(chunk),
+                                  compressed]
+        self.offset += len(stored)
+
+    def close(self):
+        """Returns the pack's name and chunks; the name is None if empty"""
+        self.pack.close()
+        if not self.entries:
+            os.remove(self.tmp_path)
+            return None, {}
+        name = self.digest.hexdigest()
+        os.rename(self.tmp_path, os.path.join(self.pack_dir,
+                                              "%s.pack" % name))
+        return name, dict((chunk_id, [name] + entry)
+                          for chunk_id, entry in self.entries.items())
+
+
+def create(package_dir, root, paths, base_dir=None):
+    """Packages paths under root, storing only chunks base_dir lacks
+
+    Returns the manifest written to package_dir.
+    """
+    base = load_manifest(base_dir) if base_dir else None
+    known = dict(base["chunks"]) if base else {}
+    if not os.path.isdir(package_dir):
+        os.makedirs(package_dir)
+    writer = PackWriter(os.path.join(package_dir, PACK_DIR))
+
+    files = []
+    used = set()
+    for path in sorted(set(walk(root, paths))):
+        full_path = os.path.join(root, path)
+        file_chunks = []
+        size = 0
+        with open(full_path, "rb") as data_file:
+            for chunk in chunks(data_file):
+                chunk_id = hashlib.sha1(chunk).hexdigest()
+                if chunk_id not in known and chunk_id not in writer.entries:
+                    writer.add(chunk_id, chunk)
+                file_chunks.append(chunk_id)
+                used.add(chunk_id)
+                size += len(chunk)
+        files.append({
+            "path": path,
+            "mode": os.stat(full_path).st_mode & 0777,
+            "size": size,
+            "digest": hashlib.sha1("".join(file_chunks)).hexdigest(),
+            "chunks": file_chunks,
+        })
+
+    pack, new_chunks = writer.close()
+    known.update(new_chunks)
+    chunk_index = dict((chunk_id, known[chunk_id]) for chunk_id in used)
+    packs = sorted(set(entry[0] for entry in chunk_index.values()))
+    manifest = {
+        "format": FORMAT,
+        "base": base["id"] if base else None,
+        "new_packs": [pack] if pack else [],
+        "packs": packs,
+        "chunks": chunk_index,
+        "files": files,
+    }
+    manifest["id"] = manifest_id(manifest)
+    write_json(os.path.join(package_dir, MANIFEST), manifest)
+    install_tool(package_dir)
+    return manifest
+
+
+def update(package_dir, delta_dir):
+    """Applies a package built with package_dir as its base"""
+    manifest = load_manifest(package_dir)
+    delta = load_manifest(delta_dir)
+    if delta["base"] != manifest["id"]:
+        raise PackageError("%s is based on %s, not on %s" %
+                           (delta_dir, delta["base"], manifest["id"]))
+    pack_dir = os.path.join(package_dir, PACK_DIR)
+    for pack in delta["new_packs"]:
+        shutil.copy(os.path.join(delta_dir, PACK_DIR, "%s.pack" % pack),
+                    pack_dir)
+    missing = [pack for pack in delta["packs"]
+               if not os.path.exists(os.path.join(pack_dir,
+                                                  "%s.pack" % pack))]
+    if missing:
+        raise PackageError("Missing packs after update: %s" %
+                           " ".join(missing))
+    write_json(os.path.join(package_dir, MANIFEST), delta)
+    install_tool(package_dir)
+    # Packs the new manifest no longer references
+    for pack_file in os.listdir(pack_dir):
+        if (pack_file.endswith(".pack") and
+                pack_file[:-len(".pack")] not in delta["packs"]):
+            os.remove(os.path.join(pack_dir, pack_file))
+
+
+CONFIG_PATHS = ("qemu", "rpmbd", "atf", "linux", "android")
+
+
+def package_path(*parts):
+    """Returns a normalized package path, None if it is outside the package"""
+    path = os.path.normpath(os.path.join(*parts))
+    if path == ".." or path.startswith("../") or os.path.isabs(path):
+        return None
+    return "" if path == "." else path
+
+
+def external_paths(config, dest):
+    """Returns the config paths outside the package, resolved against dest
+
+    The runner resolves config paths relative to the directory holding the
+    config, so once extracted they point next to dest rather than into it.
+    The result maps config keys to those resolved paths.
+    """
+    return dict((name, os.path.normpath(os.path.join(dest, config[name])))
+                for name in CONFIG_PATHS
+                if config.get(name) and package_path(config[name]) is None)
+
+
+def config_needs(config):
+    """Returns the files and directories a run with a config.json uses
+
+    The result is (files, flat_dirs, trees) of package paths: single files,
+    directories whose direct files are needed, and whole directories.
+    Config paths are relative to the package root, where the runner
+    scripts and the config live. Paths outside the package, such as the
+    ATF and Android trees of the generated config, are not packaged; see
+    external_paths.
+    """
+    files = set()
+    flat_dirs = set([""])
+    trees = set()
+    if config.get("qemu"):
+        files.add(package_path(config["qemu"]))
+        # QEMU finds its firmware relative to its binary
+        trees.add(package_path(os.path.dirname(config["qemu"]), "..",
+                               "pc-bios"))
+    if config.get("rpmbd"):
+        files.add(package_path(config["rpmbd"]))
+    if config.get("atf"):
+        flat_dirs.add(package_path(config["atf"]))
+    if config.get("linux"):
+        files.add(package_path(config["linux"], "arch",
+                               config.get("linux_arch") or "arm64", "boot",
+                               "Image"))
+        files.add(package_path(config["linux"], "scripts", "dtc", "dtc"))
+    if config.get("android"):
+        product = os.path.join(config["android"], "out", "target",
+                               "product", "trusty")
+        flat_dirs.add(package_path(product))
+        trees.add(package_path(product, "data"))
+        trees.add(package_path(config["android"], "out", "host",
+                               "linux-x86"))
+    for paths in (files, flat_dirs, trees):
+        paths.discard(None)
+    return files, flat_dirs, trees
+
+
+def file_state(path, digest):
+    """Returns what identifies an extracted file, None if it is missing"""
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return [digest, stat.st_size, stat.st_mtime]
+
+
+class PackageReader(object):
+    """Reads files out of a package without unpacking all of it
+
+    Packs are memory-mapped, so only the pages holding the chunks that are
+    read get loaded from disk.
+    """
+
+    def __init__(self, package_dir):
+        self.package_dir = package_dir
+        self.manifest = load_manifest(package_dir)
+        self.files = dict((entry["path"], entry)
+                          for entry in self.manifest["files"])
+        self.maps = {}
+
+    def close(self):
+        for pack_file, mapped in self.maps.values():
+            mapped.close()
+            pack_file.close()
+        self.maps = {}
+
+    def missing_packs(self):
+        return [pack for pack in self.manifest["packs"]
+                if not os.path.exists(self.pack_path(pack))]
+
+    def pack_path(self, pack):
+        return os.path.join(self.package_dir, PACK_DIR, "%s.pack" % pack)
+
+    def chunk(self, chunk_id):
+        pack, offset, length, _, compressed = self.manifest["chunks"][chunk_id]
+        if pack not in self.maps:
+            pack_file = open(self.pack_path(pack), "rb")
+            self.maps[pack] = (pack_file, mmap.mmap(pack_file.fileno(), 0,
+                                                    access=mmap.ACCESS_READ))
+        stored = self.maps[pack][1][offset:offset + length]
+        return zlib.decompress(stored) if compressed else stored
+
+    def read(self, path):
+        try:
+            entry = self.files[path]
+        except KeyError:
+            raise PackageError("%s is not in the package" % path)
+        return "".join(self.chunk(chunk_id) for chunk_id in entry["chunks"])
+
+    def needed(self, config):
+        """Returns the package paths a config.json needs"""
+        files, flat_dirs, trees = config_needs(config)
+        return sorted(path for path in self.files
+                      if path in files or
+                      os.path.dirname(path) in flat_dirs or
+                      any(path.startswith(tree + "/") for tree in trees))
+
+    def extract(self, dest, paths):
+        """Writes paths under dest, skipping files extracted before
+
+        A file is only skipped if it still has the size and modification
+        time it was extracted with, so files a run changed in place, such
+        as RPMB_DATA, are restored. Returns the number of files and bytes
+        written.
+        """
+        state_path = os.path.join(dest, STATE)
+        try:
+            with open(state_path) as state_file:
+                state = json.load(state_file)
+        except (IOError, ValueError):
+            state = {}
+        written = 0
+        written_bytes = 0
+        try:
+            for path in paths:
+                entry = self.files[path]
+                out_path = os.path.join(dest, path)
+                extracted = state.get(path)
+                if (extracted and
+                        extracted == file_state(out_path, entry["digest"])):
+                    continue
+                if not os.path.isdir(os.path.dirname(out_path)):
+                    os.makedirs(os.path.dirname(out_path))
+                tmp_path = "%s.tmp%d" % (out_path, os.getpid())
+                with open(tmp_path, "wb") as out:
+                    for chunk_id in entry["chunks"]:
+                        out.write(self.chunk(chunk_id))
+                os.chmod(tmp_path, entry["mode"])
+                os.rename(tmp_path, out_path)
+                state[path] = file_state(out_path, entry["digest"])
+                written += 1
+                written_bytes += entry["size"]
+        finally:
+            write_json(state_path, state)
+        return written, written_bytes
+
+
+def extract_for_config(package_dir, dest, config_path="config.json"):
+    """Extracts what a run with a packaged config needs into dest
+
+    Concurrent extractions into the same dest are serialized.
+    """
+    if not os.path.isdir(dest):
+        os.makedirs(dest)
+    reader = PackageReader(package_dir)
+    try:
+        missing = reader.missing_packs()
+        if missing:
+            raise PackageError("%s lacks packs %s; apply it to its base "
+                               "package with update" %
+                               (package_dir, " ".join(missing)))
+        config = json.loads(reader.read(config_path))
+        with open(os.path.join(dest, ".lock"), "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            written = reader.extract(dest, reader.needed(config))
+    finally:
+        reader.close()
+    for name, path in sorted(external_paths(config, dest).items()):
+        sys.stderr.write("config %s is outside the package, using %s%s\n" %
+                         (name, path, "" if os.path.exists(path)
+                          else " (missing)"))
+    return written
+
+
+def main():
+    argument_parser = argparse.ArgumentParser(
+        description="Create, update and extract chunked QEMU packages")
+    subparsers = argument_parser.add_subparsers(dest="command")
+
+    create_parser = subparsers.add_parser("create", help="build a package")
+    create_parser.add_argument("package_dir")
+    create_parser.add_argument("--root", default=".",
+                               help="directory paths are relative to")
+    create_parser.add_argument("--base",
+                               help="package to store only changes against")
+    create_parser.add_argument("paths", nargs="+")
+
+    update_parser = subparsers.add_parser(
+        "update", help="apply a package built against this one")
+    update_parser.add_argument("package_dir")
+    update_parser.add_argument("delta_dir")
+
+    list_parser = subparsers.add_parser("list", help="list packaged files")
+    list_parser.add_argument("package_dir")
+    list_parser.add_argument("--config",
+                             help="only files this packaged config needs")
+
+    cat_parser = subparsers.add_parser("cat", help="print a packaged file")
+    cat_parser.add_argument("package_dir")
+    cat_parser.add_argument("path")
+
+    extract_parser = subparsers.add_parser(
+        "extract", help="extract files a packaged config needs")
+    extract_parser.add_argument("package_dir")
+    extract_parser.add_argument("dest")
+    extract_parser.add_argument("--config", default="config.json")
+
+    run_parser = subparsers.add_parser(
+        "run", help="extract what is needed, then run the packaged runner")
+    run_parser.add_argument("package_dir")
+    run_parser.add_argument("--dest",
+                            help="where to extract, default PACKAGE/tree")
+    run_parser.add_argument("args", nargs=argparse.REMAINDER)
+    args = argument_parser.parse_args()
+
+    try:
+        if args.command == "create":
+            manifest = create(args.package_dir, args.root, args.paths,
+                              args.base)
+            new_bytes = sum(os.path.getsize(os.path.join(
+                args.package_dir, PACK_DIR, "%s.pack" % pack))
+                            for pack in manifest["new_packs"])
+            sys.stderr.write("%d files, %d chunks, %d new bytes\n" % (
+                len(manifest["files"]), len(manifest["chunks"]), new_bytes))
+        elif args.command == "update":
+            update(args.package_dir, args.delta_dir)
+        elif args.command == "list":
+            reader = PackageReader(args.package_dir)
+            paths = sorted(reader.files)
+            if args.config:
+                paths = reader.needed(json.loads(reader.read(args.config)))
+            for path in paths:
+                print "%12d  %s" % (reader.files[path]["size"], path)
+        elif args.command == "cat":
+            reader = PackageReader(args.package_dir)
+            sys.stdout.write(reader.read(args.path))
+        elif args.command == "extract":
+            written, written_bytes = extract_for_config(
+                args.package_dir, args.dest, args.config)
+            sys.stderr.write("Extracted %d files, %d bytes\n" %
+                             (written, written_bytes))
+        else:
+            dest = args.dest or os.path.join(args.package_dir, "tree")
+            extract_for_config(args.package_dir, dest)
+            run = os.path.join(dest, "run")
+            os.execv("/bin/sh", ["sh", run] + args.args)
+    except PackageError as exn:
+        argument_parser.exit(1, "%s\n" % exn)
+    except IOError as exn:
+        if exn.errno != errno.EPIPE:
+            raise
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,124 @@
+"""Tests of packaging and lazy extraction"""
+
+import json
+import os
+import shutil
+import StringIO
+import sys
+import tempfile
+import unittest
+
+import qemu_package
+
+
+class PackageTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.root = os.path.join(self.tmp_dir, "root")
+        self.package_dir = os.path.join(self.tmp_dir, "package")
+        self.dest = os.path.join(self.tmp_dir, "dest")
+        self.config = {"atf": "atf", "rpmbd": "rpmb_dev"}
+        self.write("config.json", json.dumps(self.config))
+        self.write("rpmb_dev", "#!/bin/sh\n")
+        self.write("atf/bl31.bin", "\x01" * 10000)
+        self.write("atf/RPMB_DATA", "\0" * 8192)
+        self.write("unused/big.img", "\x02" * 10000)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def write(self, path, data, root=None):
+        full_path = os.path.join(root or self.root, path)
+        if not os.path.isdir(os.path.dirname(full_path)):
+            os.makedirs(os.path.dirname(full_path))
+        with open(full_path, "wb") as out:
+            out.write(data)
+
+    def read(self, path):
+        with open(os.path.join(self.dest, path), "rb") as data_file:
+            return data_file.read()
+
+    def test_extract_needed_files(self):
+        qemu_package.create(self.package_dir, self.root, ["."])
+        written, _ = qemu_package.extract_for_config(self.package_dir,
+                                                     self.dest)
+        self.assertEqual(written, 4)
+        self.assertFalse(os.path.exists(os.path.join(self.dest, "unused")))
+        self.assertEqual(self.read("atf/RPMB_DATA"), "\0" * 8192)
+
+        written, _ = qemu_package.extract_for_config(self.package_dir,
+                                                     self.dest)
+        self.assertEqual(written, 0)
+
+    def test_extract_restores_changed_in_place(self):
+        qemu_package.create(self.package_dir, self.root, ["."])
+        qemu_package.extract_for_config(self.package_dir, self.dest)
+        # A run writes to RPMB_DATA without changing its size
+        rpmb_data = os.path.join(self.dest, "atf", "RPMB_DATA")
+        with open(rpmb_data, "r+b") as out:
+            out.write("\xff" * 512)
+        stat = os.stat(rpmb_data)
+        os.utime(rpmb_data, (stat.st_atime, stat.st_mtime + 1))
+
+        written, written_bytes = qemu_package.extract_for_config(
+            self.package_dir, self.dest)
+        self.assertEqual((written, written_bytes), (1, 8192))
+        self.assertEqual(self.read("atf/RPMB_DATA"), "\0" * 8192)
+
+    def test_generated_config(self):
+        # Shaped like the config.json qemu-inc.mk generates: ATF and Android
+        # come from trees next to the build directory
+        config = {
+            "linux": "linux-build",
+            "linux_arch": "arm64",
+            "atf": "../../../optee/out/bin",
+            "qemu": "qemu-build/aarch64-softmmu/qemu-system-aarch64",
+            "extra_qemu_flags": ["-machine", "gic-version=3"],
+            "android": "../../../aosp",
+            "rpmbd": "host_tools/rpmb_dev",
+            "arch": "arm64",
+        }
+        root = os.path.join(self.tmp_dir, "build")
+        self.write("config.json", json.dumps(config), root)
+        self.write(config["qemu"], "qemu", root)
+        self.write("qemu-build/pc-bios/efi.rom", "rom", root)
+        self.write(config["rpmbd"], "#!/bin/sh\n", root)
+        self.write("linux-build/arch/arm64/boot/Image", "\x01" * 10000, root)
+        self.write("linux-build/scripts/dtc/dtc", "dtc", root)
+        self.write("linux-build/vmlinux", "\x02" * 10000, root)
+        qemu_package.create(self.package_dir, root, ["."])
+
+        stderr = sys.stderr
+        try:
+            sys.stderr = StringIO.StringIO()
+            written, _ = qemu_package.extract_for_config(self.package_dir,
+                                                         self.dest)
+            self.assertIn("config atf is outside the package",
+                          sys.stderr.getvalue())
+        finally:
+            sys.stderr = stderr
+        self.assertEqual(written, 6)
+        self.assertFalse(os.path.exists(os.path.join(self.dest,
+                                                     "linux-build",
+                                                     "vmlinux")))
+        self.assertEqual(self.read("qemu-build/pc-bios/efi.rom"), "rom")
+        self.assertEqual(
+            qemu_package.external_paths(config, self.dest),
+            {"atf": os.path.normpath(os.path.join(
+                self.dest, "../../../optee/out/bin")),
+             "android": os.path.normpath(os.path.join(self.dest,
+                                                      "../../../aosp"))})
+
+    def test_update(self):
+        qemu_package.create(self.package_dir, self.root, ["."])
+        self.write("atf/bl31.bin", "\x03" * 10000)
+        delta_dir = os.path.join(self.tmp_dir, "delta")
+        qemu_package.create(delta_dir, self.root, ["."], self.package_dir)
+        qemu_package.update(self.package_dir, delta_dir)
+        qemu_package.extract_for_config(self.package_dir, self.dest)
+        self.assertEqual(self.read("atf/bl31.bin"), "\x03" * 10000)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,342 @@
+"""Loads emulator images into the page cache ahead of QEMU"""
+
+import ctypes
+import ctypes.util
+import json
+import mmap
+import os
+import Queue
+import re
+import threading
+import time
+
+PAGE_SIZE = mmap.PAGESIZE
+
+POSIX_FADV_WILLNEED = 3
+
+_libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+_libc.posix_fadvise.argtypes = [ctypes.c_int, ctypes.c_int64,
+                                ctypes.c_int64, ctypes.c_int]
+_libc.mmap.restype = ctypes.c_void_p
+_libc.mmap.argtypes = [ctypes.c_void_p, ctypes.c_size_t, ctypes.c_int,
+                       ctypes.c_int, ctypes.c_int, ctypes.c_int64]
+_libc.munmap.argtypes = [ctypes.c_void_p, ctypes.c_size_t]
+_libc.mincore.argtypes = [ctypes.c_void_p, ctypes.c_size_t, ctypes.c_void_p]
+
+_RESIDENT_RE = re.compile("[^\x00]+")
+
+
+def fadvise_willneed(fd, offset, length):
+    """Starts reading a range of a file into the page cache"""
+    error = _libc.posix_fadvise(fd, offset, length, POSIX_FADV_WILLNEED)
+    if error:
+        raise OSError(error, os.strerror(error))
+
+
+def resident_ranges(path):
+    """Returns the [start, end) byte ranges of a file in the page cache"""
+    size = os.path.getsize(path)
+    if not size:
+        return []
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        addr = _libc.mmap(None, size, mmap.PROT_READ, mmap.MAP_SHARED, fd, 0)
+        if addr in (None, ctypes.c_void_p(-1).value):
+            raise OSError(ctypes.get_errno(), "mmap of %s failed" % path)
+        try:
+            pages = (size + PAGE_SIZE - 1) // PAGE_SIZE
+            vec = ctypes.create_string_buffer(pages)
+            if _libc.mincore(addr, size, vec) != 0:
+                raise OSError(ctypes.get_errno(),
+                              "mincore of %s failed" % path)
+            residency = vec.raw
+        finally:
+            _libc.munmap(addr, size)
+    finally:
+        os.close(fd)
+    return [[match.start() * PAGE_SIZE, min(match.end() * PAGE_SIZE, size)]
+            for match in _RESIDENT_RE.finditer(residency)]
+
+
+def range_bytes(ranges):
+    return sum(end - start for start, end in ranges)
+
+
+def merge_ranges(ranges, gap=0):
+    """Sorts ranges and merges those less than gap bytes apart"""
+    merged = []
+    for start, end in sorted(ranges):
+        if merged and start - merged[-1][1] <= gap:
+            merged[-1][1] = max(merged[-1][1], end)
+        else:
+            merged.append([start, end])
+    return merged
+
+
+def intersect_ranges(ranges, others):
+    """Returns the ranges two sorted, merged range lists share"""
+    shared = []
+    index = 0
+    for start, end in ranges:
+        while index < len(others) and others[index][1] <= start:
+            index += 1
+        probe = index
+        while probe < len(others) and others[probe][0] < end:
+            shared.append([max(start, others[probe][0]),
+                           min(end, others[probe][1])])
+            probe += 1
+    return shared
+
+
+def intersect_bytes(ranges, others):
+    """Returns how many bytes two sorted, merged range lists share"""
+    return range_bytes(intersect_ranges(ranges, others))
+
+
+def subtract_ranges(ranges, others):
+    """Returns the parts of sorted, merged ranges that others lack"""
+    left = []
+    index = 0
+    for start, end in ranges:
+        while index < len(others) and others[index][1] <= start:
+            index += 1
+        probe = index
+        while probe < len(others) and others[probe][0] < end:
+            if others[probe][0] > start:
+                left.append([start, others[probe][0]])
+            start = max(start, others[probe][1])
+            probe += 1
+        if start < end:
+            left.append([start, end])
+    return left
+
+
+def median(values):
+    values = sorted(values)
+    if not values:
+        return None
+    middle = len(values) // 2
+    if len(values) % 2:
+        return values[middle]
+    return (values[middle - 1] + values[middle]) / 2.0
+
+
+class AccessProfile(object):
+    """Ranges of large images that runs actually read, kept across runs
+
+    Ranges are keyed by the file's path, size and mtime, so a rebuilt image
+    starts afresh. They can only be learned in runs that prefetch nothing,
+    as prefetched pages are cached whether QEMU reads them or not: what
+    such a run brought into the page cache was read, and of what was cached
+    before, the ranges earlier runs read are kept. After RELEARN_RUNS
+    prefetched runs, the ranges are learned again, so they also shrink.
+
+    Boot stage times of runs with and without prefetching are kept too, so
+    what prefetching saves can be measured against recent runs without it.
+    """
+
+    # Ranges closer than this are fetched as one
+    GAP = 1024 * 1024
+    RELEARN_RUNS = 10
+    BOOT_HISTORY = 20
+
+    def __init__(self, path):
+        self.path = path
+        try:
+            with open(path) as profile_file:
+                profile = json.load(profile_file)
+        except (IOError, ValueError):
+            profile = {}
+        # Profiles of other layouts are started over
+        self.files = profile.get("files", {})
+        self.boots = profile.get("boots", {})
+
+    @staticmethod
+    def key(path):
+        stat = os.stat(path)
+        return "%s:%d:%d" % (os.path.realpath(path), stat.st_size,
+                             stat.st_mtime)
+
+    def ranges(self, path):
+        """Returns the hot ranges of a file, or None if due to be learned"""
+        entry = self.files.get(self.key(path))
+        if not entry or entry["uses"] >= self.RELEARN_RUNS:
+            return None
+        return entry["ranges"]
+
+    def used(self, path):
+        """Counts a run that prefetched a file's ranges"""
+        self.files[self.key(path)]["uses"] += 1
+
+    def learn(self, path, before, after):
+        """Records the ranges read in a run without prefetching
+
+        before and after are the file's resident ranges around the run.
+        """
+        entry = self.files.get(self.key(path))
+        known = entry["ranges"] if entry else []
+        ranges = (subtract_ranges(after, before) +
+                  intersect_ranges(known, before))
+        self.files[self.key(path)] = {
+            "ranges": merge_ranges(ranges, self.GAP), "uses": 0}
+
+    def record_boot(self, prefetched, stage, seconds):
+        """Keeps how long a run took to reach a boot stage"""
+        kind = "prefetched" if prefetched else "not_prefetched"
+        times = self.boots.setdefault(kind, {}).setdefault(stage, [])
+        times.append(seconds)
+        del times[:-self.BOOT_HISTORY]
+
+    def boot_median(self, prefetched, stage):
+        kind = "prefetched" if prefetched else "not_prefetched"
+        return median(self.boots.get(kind, {}).get(stage, []))
+
+    def save(self):
+        tmp_path = "%s.tmp%d" % (self.path, os.getpid())
+        with open(tmp_path, "w") as profile_file:
+            json.dump({"files": self.files, "boots": self.boots},
+                      profile_file)
+        os.rename(tmp_path, self.path)
+
+
+class Prefetcher(object):
+    """Prefetches files with parallel WILLNEED hints
+
+    Files up to large_size bytes are prefetched whole. Larger ones, such as
+    the Android images, are prefetched only where the access profile says
+    runs read them. If the profile lacks the ranges of one of them, or they
+    are due to be learned again, the run prefetches nothing and learns them
+    instead; without a profile, large files are left to QEMU.
+
+    Nothing waits for the prefetch: it overlaps with the rest of the setup.
+    The hints return before the data is read, so the prefetch is measured
+    by page cache residency, before it starts and when QEMU is launched,
+    and with a profile, by how long the boot stages take compared to runs
+    without prefetching.
+    """
+
+    # Bytes per WILLNEED hint, so that workers share large files
+    STEP = 8 * 1024 * 1024
+
+    def __init__(self, paths, profile=None, threads=4,
+                 large_size=64 * 1024 * 1024):
+        self.paths = sorted(set(os.path.realpath(path) for path in paths
+                                if os.path.isfile(path)))
+        self.profile = profile
+        self.threads = threads
+        self.large_size = large_size
+        self.large = [path for path in self.paths
+                      if os.path.getsize(path) > large_size]
+        self.learning = False
+        self.before = {}
+        self.plan = {}
+        self.cold = {}
+        self.queue = Queue.Queue()
+        self.workers = []
+        self.launch_time = None
+        self.cold_at_launch = None
+        self.stages = {}
+
+    def _plan(self, path):
+        size = os.path.getsize(path)
+        if size <= self.large_size:
+            return [[0, size]] if size else []
+        if self.profile:
+            return self.profile.ranges(path) or []
+        return []
+
+    def start(self):
+        # Residency before any hint: the baseline of both the cold data and
+        # of what a learning run reads
+        for path in self.paths:
+            self.before[path] = resident_ranges(path)
+        if self.profile:
+            self.learning = any(self.profile.ranges(path) is None
+                                for path in self.large)
+        if self.learning:
+            return
+        for path in self.paths:
+            ranges = self._plan(path)
+            if not ranges:
+                continue
+            self.plan[path] = ranges
+            self.cold[path] = (range_bytes(ranges) -
+                               intersect_bytes(ranges, self.before[path]))
+            if path in self.large:
+                self.profile.used(path)
+            for start, end in ranges:
+                for offset in range(start, end, self.STEP):
+                    self.queue.put((path, offset,
+                                    min(self.STEP, end - offset)))
+        for _ in range(self.threads):
+            worker = threading.Thread(target=self._work)
+            worker.daemon = True
+            worker.start()
+            self.workers.append(worker)
+
+    def _work(self):
+        fds = {}
+        try:
+            while True:
+                try:
+                    path, offset, length = self.queue.get_nowait()
+                except Queue.Empty:
+                    return
+                if path not in fds:
+                    fds[path] = os.open(path, os.O_RDONLY)
+                fadvise_willneed(fds[path], offset, length)
+        finally:
+            for fd in fds.values():
+                os.close(fd)
+
+    def resident_bytes(self):
+        """Returns how much of the planned ranges are in the page cache"""
+        return sum(intersect_bytes(ranges, resident_ranges(path))
+                   for path, ranges in self.plan.items())
+
+    def launched(self):
+        """Records how much planned data was still cold at QEMU's launch"""
+        self.launch_time = time.time()
+        planned = sum(range_bytes(ranges) for ranges in self.plan.values())
+        self.cold_at_launch = planned - self.resident_bytes()
+
+    def reached(self, stage):
+        """Records when the guest first reached a boot stage"""
+        if self.launch_time and stage not in self.stages:
+            self.stages[stage] = time.time() - self.launch_time
+
+    def finish(self):
+        """Waits for the prefetch, updates the access profile, and reports
+
+        The report has, for each boot stage reached, the seconds it took
+        from QEMU's launch, and with a profile, the median of recent runs
+        with and without prefetching.
+        """
+        for worker in self.workers:
+            worker.join()
+        self.workers = []
+        report = {
+            "learning": self.learning,
+            "files": len(self.plan),
+            "planned": sum(range_bytes(ranges)
+                           for ranges in self.plan.values()),
+            "cold": sum(self.cold.values()),
+            "cold_at_launch": self.cold_at_launch,
+            "stages": {},
+        }
+        for stage, seconds in self.stages.items():
+            report["stages"][stage] = {"seconds": seconds}
+        if self.profile:
+            if self.learning:
+                for path in self.large:
+                    self.profile.learn(path, self.before[path],
+                                       resident_ranges(path))
+            for stage, seconds in self.stages.items():
+                self.profile.record_boot(not self.learning, stage, seconds)
+                report["stages"][stage].update({
+                    "prefetched": self.profile.boot_median(True, stage),
+                    "not_prefetched": self.profile.boot_median(False,
+                                                               stage),
+                })
+            self.profile.save()
+        return report
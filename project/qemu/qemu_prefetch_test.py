@@ -0,0 +1,148 @@
+"""Tests of prefetch planning and the access profile"""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import qemu_prefetch
+
+MIB = 1024 * 1024
+
+
+class RangesTest(unittest.TestCase):
+
+    def test_merge(self):
+        self.assertEqual(qemu_prefetch.merge_ranges([[10, 20], [0, 5]]),
+                         [[0, 5], [10, 20]])
+        self.assertEqual(qemu_prefetch.merge_ranges([[10, 20], [0, 5]], 5),
+                         [[0, 20]])
+
+    def test_intersect(self):
+        ranges = [[0, 10], [20, 30]]
+        others = [[5, 25], [28, 40]]
+        self.assertEqual(qemu_prefetch.intersect_ranges(ranges, others),
+                         [[5, 10], [20, 25], [28, 30]])
+        self.assertEqual(qemu_prefetch.intersect_bytes(ranges, others), 12)
+
+    def test_subtract(self):
+        ranges = [[0, 10], [20, 30]]
+        self.assertEqual(qemu_prefetch.subtract_ranges(ranges, [[5, 25]]),
+                         [[0, 5], [25, 30]])
+        self.assertEqual(qemu_prefetch.subtract_ranges(ranges,
+                                                       [[2, 4], [6, 8]]),
+                         [[0, 2], [4, 6], [8, 10], [20, 30]])
+        self.assertEqual(qemu_prefetch.subtract_ranges(ranges, [[0, 30]]),
+                         [])
+        self.assertEqual(qemu_prefetch.subtract_ranges(ranges, []), ranges)
+
+
+class AccessProfileTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.image = os.path.join(self.tmp_dir, "system.img")
+        with open(self.image, "wb") as image:
+            image.truncate(128 * MIB)
+        self.profile_path = os.path.join(self.tmp_dir, "profile.json")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_learns_what_the_run_read(self):
+        profile = qemu_prefetch.AccessProfile(self.profile_path)
+        self.assertEqual(profile.ranges(self.image), None)
+        # [0, 4M) was cached already, [10M, 12M) read by the run
+        profile.learn(self.image, [[0, 4 * MIB]],
+                      [[0, 4 * MIB], [10 * MIB, 12 * MIB]])
+        self.assertEqual(profile.ranges(self.image),
+                         [[10 * MIB, 12 * MIB]])
+
+    def test_shrinks_when_learned_again(self):
+        profile = qemu_prefetch.AccessProfile(self.profile_path)
+        profile.learn(self.image, [], [[0, 4 * MIB], [10 * MIB, 12 * MIB]])
+        for _ in range(profile.RELEARN_RUNS - 1):
+            profile.used(self.image)
+            self.assertNotEqual(profile.ranges(self.image), None)
+        profile.used(self.image)
+        self.assertEqual(profile.ranges(self.image), None)
+
+        # Cached ranges read before are kept; the others must be read again
+        profile.learn(self.image, [[0, 20 * MIB]], [[0, 20 * MIB]])
+        self.assertEqual(profile.ranges(self.image), [[0, 4 * MIB],
+                                                      [10 * MIB, 12 * MIB]])
+        profile.learn(self.image, [], [[10 * MIB, 12 * MIB]])
+        self.assertEqual(profile.ranges(self.image), [[10 * MIB, 12 * MIB]])
+
+    def test_boot_times(self):
+        profile = qemu_prefetch.AccessProfile(self.profile_path)
+        for seconds in [5.0, 6.0, 7.0]:
+            profile.record_boot(False, "adb", seconds)
+        profile.record_boot(True, "adb", 4.0)
+        profile.record_boot(True, "adb", 5.0)
+        profile.save()
+
+        profile = qemu_prefetch.AccessProfile(self.profile_path)
+        self.assertEqual(profile.boot_median(False, "adb"), 6.0)
+        self.assertEqual(profile.boot_median(True, "adb"), 4.5)
+        self.assertEqual(profile.boot_median(True, "testrunner"), None)
+        for _ in range(profile.BOOT_HISTORY):
+            profile.record_boot(True, "adb", 1.0)
+        self.assertEqual(profile.boot_median(True, "adb"), 1.0)
+
+
+class PrefetcherTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.small = os.path.join(self.tmp_dir, "bl1.bin")
+        with open(self.small, "wb") as small:
+            small.write("\x01" * 8192)
+        self.large = os.path.join(self.tmp_dir, "system.img")
+        with open(self.large, "wb") as large:
+            large.truncate(2 * MIB)
+        self.profile = qemu_prefetch.AccessProfile(
+            os.path.join(self.tmp_dir, "profile.json"))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def prefetcher(self):
+        return qemu_prefetch.Prefetcher([self.small, self.large],
+                                        self.profile, large_size=MIB)
+
+    def test_learning_run_prefetches_nothing(self):
+        prefetcher = self.prefetcher()
+        prefetcher.start()
+        self.assertTrue(prefetcher.learning)
+        self.assertEqual(prefetcher.plan, {})
+        prefetcher.launched()
+        prefetcher.reached("adb")
+        report = prefetcher.finish()
+        self.assertTrue(report["learning"])
+        self.assertEqual(report["planned"], 0)
+        self.assertEqual(report["stages"]["adb"]["prefetched"], None)
+        self.assertNotEqual(report["stages"]["adb"]["not_prefetched"], None)
+        self.assertNotEqual(self.profile.ranges(self.large), None)
+
+    def test_prefetched_run(self):
+        self.profile.learn(self.large, [], [[0, 4096]])
+        prefetcher = self.prefetcher()
+        prefetcher.start()
+        self.assertFalse(prefetcher.learning)
+        self.assertEqual(prefetcher.plan, {
+            os.path.realpath(self.small): [[0, 8192]],
+            os.path.realpath(self.large): [[0, 4096]],
+        })
+        prefetcher.launched()
+        prefetcher.reached("adb")
+        report = prefetcher.finish()
+        self.assertEqual(report["planned"], 8192 + 4096)
+        self.assertNotEqual(report["stages"]["adb"]["prefetched"], None)
+        self.assertEqual(report["stages"]["adb"]["not_prefetched"], None)
+        # A prefetched run does not learn: the prefetch cached the ranges
+        self.assertEqual(self.profile.files.values()[0]["uses"], 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
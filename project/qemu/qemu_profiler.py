@@ -0,0 +1,290 @@
+"""Statistical guest profiler using QEMU's gdbstub"""
+
+import bisect
+import socket
+import struct
+import threading
+
+# gdb register numbers of the pc and the link register, by config arch.
+# Others are not supported: which layout the stub uses for an arm build
+# depends on the CPU QEMU emulates and the state it is in.
+REGISTERS = {
+    "arm64": (32, 30),
+}
+
+
+class GdbProtocolError(Exception):
+    """The stub sent something the client did not expect."""
+
+
+class GdbRemote(object):
+    """Minimal GDB remote serial protocol client
+
+    Only what sampling needs is implemented: halting, listing threads
+    (one per vCPU in QEMU), reading single registers and resuming. conn is
+    any connected stream socket, so the client can be driven by a scripted
+    stub as easily as by QEMU.
+    """
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.buf = ""
+        self.ack = True
+
+    def _read_byte(self):
+        if not self.buf:
+            self.buf = self.conn.recv(4096)
+            if not self.buf:
+                raise GdbProtocolError("connection closed by stub")
+        byte, self.buf = self.buf[0], self.buf[1:]
+        return byte
+
+    def send_packet(self, data):
+        packet = "$%s#%02x" % (data, sum(ord(c) for c in data) & 0xff)
+        while True:
+            self.conn.sendall(packet)
+            if not self.ack:
+                return
+            reply = self._read_byte()
+            if reply == "+":
+                return
+            if reply != "-":
+                raise GdbProtocolError("expected ack, got %r" % reply)
+
+    def recv_packet(self):
+        """Returns the payload of the next packet, unescaped"""
+        while self._read_byte() != "$":
+            pass
+        data = []
+        while True:
+            byte = self._read_byte()
+            if byte == "#":
+                break
+            if byte == "}":
+                byte = chr(ord(self._read_byte()) ^ 0x20)
+            data.append(byte)
+        self._read_byte()
+        self._read_byte()
+        if self.ack:
+            self.conn.sendall("+")
+        return "".join(data)
+
+    def command(self, data):
+        self.send_packet(data)
+        return self.recv_packet()
+
+    def start(self):
+        """Turns acks off, if the stub allows, to halve round trips"""
+        if self.command("QStartNoAckMode") == "OK":
+            self.ack = False
+
+    def interrupt(self):
+        """Halts all vCPUs, returning the stop reply"""
+        self.conn.sendall("\x03")
+        reply = self.recv_packet()
+        if reply[:1] not in ("S", "T"):
+            raise GdbProtocolError("expected stop reply, got %r" % reply)
+        return reply
+
+    def resume(self):
+        """Continues all vCPUs; the stub answers only on the next stop"""
+        self.send_packet("c")
+
+    def detach(self):
+        self.command("D")
+
+    def threads(self):
+        """Returns the ids of all threads, i.e. vCPUs"""
+        threads = []
+        reply = self.command("qfThreadInfo")
+        while reply.startswith("m"):
+            threads += reply[1:].split(",")
+            reply = self.command("qsThreadInfo")
+        return threads
+
+    def read_register(self, thread, regnum):
+        """Reads a register of a thread as an unsigned integer"""
+        if self.command("Hg%s" % thread) != "OK":
+            raise GdbProtocolError("cannot select thread %s" % thread)
+        reply = self.command("p%x" % regnum)
+        if not reply or reply.startswith("E"):
+            raise GdbProtocolError("cannot read register %d: %r" %
+                                   (regnum, reply))
+        # Registers are sent as target (little) endian bytes
+        return int("".join(reversed([reply[i:i + 2]
+                                     for i in range(0, len(reply), 2)])), 16)
+
+
+class ElfSymbols(object):
+    """Function symbols of a little-endian ELF32 or ELF64 file"""
+
+    SHT_SYMTAB = 2
+    STT_FUNC = 2
+
+    def __init__(self, path):
+        with open(path, "rb") as elf_file:
+            elf = elf_file.read()
+        if elf[:4] != "\x7fELF":
+            raise ValueError("%s is not an ELF file" % path)
+        is64 = elf[4] == "\x02"
+
+        if is64:
+            shoff, = struct.unpack_from("<Q", elf, 0x28)
+            shentsize, shnum = struct.unpack_from("<HH", elf, 0x3a)
+        else:
+            shoff, = struct.unpack_from("<I", elf, 0x20)
+            shentsize, shnum = struct.unpack_from("<HH", elf, 0x2e)
+
+        def section(index):
+            """Returns (type, offset, size, link, entsize) of a section"""
+            base = shoff + index * shentsize
+            if is64:
+                fields = struct.unpack_from("<IIQQQQIIQQ", elf, base)
+            else:
+                fields = struct.unpack_from("<IIIIIIIIII", elf, base)
+            return fields[1], fields[4], fields[5], fields[6], fields[9]
+
+        self.symbols = []
+        for index in range(shnum):
+            sh_type, offset, size, link, entsize = section(index)
+            if sh_type != self.SHT_SYMTAB or not entsize:
+                continue
+            _, str_offset, _, _, _ = section(link)
+            for sym in range(offset, offset + size, entsize):
+                if is64:
+                    name, info, _, _, value, sym_size = struct.unpack_from(
+                        "<IBBHQQ", elf, sym)
+                else:
+                    name, value, sym_size, info = struct.unpack_from(
+                        "<IIIB", elf, sym)
+                if info & 0xf != self.STT_FUNC or not value:
+                    continue
+                end = elf.index("\0", str_offset + name)
+                self.symbols.append((value, sym_size,
+                                     elf[str_offset + name:end]))
+        self.symbols.sort()
+        self.addresses = [value for value, _, _ in self.symbols]
+
+    def lookup(self, addr):
+        """Returns the function containing addr, or None"""
+        index = bisect.bisect_right(self.addresses, addr) - 1
+        if index < 0:
+            return None
+        value, size, name = self.symbols[index]
+        if addr < value + max(size, 1):
+            return name
+        return None
+
+
+class Symbolizer(object):
+    """Resolves addresses against several ELF files, e.g. lk.elf and bl31"""
+
+    def __init__(self, elf_paths):
+        self.elfs = [ElfSymbols(path) for path in elf_paths]
+        self.cache = {}
+
+    def name(self, addr):
+        if addr not in self.cache:
+            for elf in self.elfs:
+                name = elf.lookup(addr)
+                if name:
+                    break
+            else:
+                name = "0x%x" % addr
+            self.cache[addr] = name
+        return self.cache[addr]
+
+
+class GuestProfiler(object):
+    """Periodically halts the guest and records the PC and LR of each vCPU
+
+    Samples are aggregated as folded stacks ("lr;pc count" per line, caller
+    first), the input format of flame graph tools such as flamegraph.pl.
+    pc_reg and lr_reg are the gdb register numbers of the pc and the link
+    register, see REGISTERS.
+    """
+
+    def __init__(self, sock_path, rate, symbolizer, out_path, pc_reg,
+                 lr_reg):
+        self.sock_path = sock_path
+        self.period = 1.0 / rate
+        self.symbolizer = symbolizer
+        self.out_path = out_path
+        self.pc_reg = pc_reg
+        self.lr_reg = lr_reg
+        self.stacks = {}
+        self.samples = 0
+        self.stopping = threading.Event()
+        self.thread = None
+        self.error = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self._profile)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        """Stops sampling, leaving the guest running, and writes stacks"""
+        if not self.thread:
+            return
+        self.stopping.set()
+        self.thread.join()
+        self.thread = None
+        self.write()
+
+    def connect(self, tries=50):
+        """Connects to the stub QEMU creates once it has started"""
+        while True:
+            conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                conn.connect(self.sock_path)
+                return conn
+            except socket.error:
+                conn.close()
+                tries -= 1
+                if tries <= 0 or self.stopping.wait(0.1):
+                    raise
+
+    def sample(self, gdb, threads):
+        """Halts the guest once and counts each vCPU's stack"""
+        gdb.interrupt()
+        try:
+            for thread in threads:
+                pc = gdb.read_register(thread, self.pc_reg)
+                lr = gdb.read_register(thread, self.lr_reg)
+                stack = "%s;%s" % (self.symbolizer.name(lr),
+                                   self.symbolizer.name(pc))
+                self.stacks[stack] = self.stacks.get(stack, 0) + 1
+            self.samples += 1
+        finally:
+            gdb.resume()
+
+    def _profile(self):
+        try:
+            conn = self.connect()
+        except socket.error as exn:
+            self.error = exn
+            return
+        try:
+            gdb = GdbRemote(conn)
+            gdb.start()
+            # QEMU stops the guest when a debugger attaches; "?" returns
+            # the stop reply that gdb.interrupt() would otherwise wait for
+            gdb.command("?")
+            threads = gdb.threads()
+            gdb.resume()
+            while not self.stopping.wait(self.period):
+                self.sample(gdb, threads)
+            gdb.interrupt()
+            gdb.detach()
+        except (socket.error, GdbProtocolError) as exn:
+            # QEMU went away under us; keep what was sampled
+            self.error = exn
+        finally:
+            conn.close()
+
+    def write(self):
+        with open(self.out_path, "w") as out:
+            for stack, count in sorted(self.stacks.items(),
+                                       key=lambda item: -item[1]):
+                out.write("%s %d\n" % (stack, count))
@@ -0,0 +1,248 @@
+"""Tests of the guest profiler against a scripted gdb stub"""
+
+import os
+import shutil
+import socket
+import struct
+import tempfile
+import threading
+import unittest
+
+import qemu_profiler
+
+
+def checksum(data):
+    return sum(ord(c) for c in data) & 0xff
+
+
+class FakeStub(threading.Thread):
+    """A gdb stub answering from a table of vCPU registers
+
+    Packets with a bad checksum are rejected with "-", as a real stub
+    does. Every packet received is kept in packets. replies maps packets
+    to answers sent as is, e.g. to send escaped data.
+    """
+
+    def __init__(self, conn, registers, replies=None):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.conn = conn
+        self.registers = registers
+        self.replies = replies or {}
+        self.packets = []
+        self.bad_checksums = 0
+        self.interrupts = 0
+        self.ack = True
+        self.thread = None
+        self.buf = ""
+
+    def _read_byte(self):
+        if not self.buf:
+            self.buf = self.conn.recv(4096)
+            if not self.buf:
+                return None
+        byte, self.buf = self.buf[0], self.buf[1:]
+        return byte
+
+    def _send(self, data, raw=None):
+        self.conn.sendall(raw or "$%s#%02x" % (data, checksum(data)))
+        if self.ack:
+            assert self._read_byte() == "+"
+
+    def _answer(self, packet):
+        if packet in self.replies:
+            self._send(None, self.replies[packet])
+        elif packet == "QStartNoAckMode":
+            self._send("OK")
+            self.ack = False
+        elif packet == "?":
+            self._send("S05")
+        elif packet == "qfThreadInfo":
+            self._send("m" + ",".join(sorted(self.registers)))
+        elif packet == "qsThreadInfo":
+            self._send("l")
+        elif packet.startswith("Hg"):
+            self.thread = packet[2:]
+            self._send("OK" if self.thread in self.registers else "E01")
+        elif packet.startswith("p"):
+            value = self.registers[self.thread].get(int(packet[1:], 16))
+            if value is None:
+                self._send("E02")
+            else:
+                self._send(struct.pack("<Q", value).encode("hex"))
+        elif packet == "c":
+            pass
+        else:
+            # Unsupported packets get an empty reply
+            self._send("")
+
+    def run(self):
+        while True:
+            byte = self._read_byte()
+            if byte is None:
+                return
+            if byte == "\x03":
+                self.interrupts += 1
+                self._send("S02")
+                continue
+            if byte != "$":
+                continue
+            data = ""
+            byte = self._read_byte()
+            while byte != "#":
+                data += byte
+                byte = self._read_byte()
+            sent = int(self._read_byte() + self._read_byte(), 16)
+            if sent != checksum(data):
+                self.bad_checksums += 1
+                self.conn.sendall("-")
+                continue
+            if self.ack:
+                self.conn.sendall("+")
+            self.packets.append(data)
+            self._answer(data)
+            if data == "D":
+                return
+
+
+def write_elf64(path, symbols):
+    """Writes an ELF64 file with a symbol table of (name, value, size, info)"""
+    strtab = "\0"
+    syms = struct.pack("<IBBHQQ", 0, 0, 0, 0, 0, 0)
+    for name, value, size, info in symbols:
+        syms += struct.pack("<IBBHQQ", len(strtab), info, 0, 1, value, size)
+        strtab += name + "\0"
+    sym_offset = 64
+    str_offset = sym_offset + len(syms)
+    shoff = str_offset + len(strtab)
+    header = "\x7fELF\x02\x01\x01" + "\0" * 9
+    header += struct.pack("<HHIQQQIHHHHHH", 2, 183, 1, 0, 0, shoff, 0, 64,
+                          0, 0, 64, 3, 0)
+    sections = struct.pack("<IIQQQQIIQQ", 0, 0, 0, 0, 0, 0, 0, 0, 0, 0)
+    sections += struct.pack("<IIQQQQIIQQ", 0, 2, 0, 0, sym_offset,
+                            len(syms), 2, 1, 8, 24)
+    sections += struct.pack("<IIQQQQIIQQ", 0, 3, 0, 0, str_offset,
+                            len(strtab), 0, 0, 1, 0)
+    with open(path, "wb") as elf:
+        elf.write(header + syms + strtab + sections)
+
+
+class GdbRemoteTest(unittest.TestCase):
+
+    def setUp(self):
+        self.client, self.server = socket.socketpair()
+        self.stub = None
+
+    def tearDown(self):
+        # The stub sees the end of the stream and returns
+        self.client.close()
+        if self.stub:
+            self.stub.join(5)
+        self.server.close()
+
+    def start_stub(self, registers, replies=None):
+        self.stub = FakeStub(self.server, registers, replies)
+        self.stub.start()
+        return self.stub
+
+    def test_framing_and_registers(self):
+        stub = self.start_stub({"1": {32: 0xffff000012345678, 30: 0x40}})
+        gdb = qemu_profiler.GdbRemote(self.client)
+        self.assertEqual(gdb.command("?"), "S05")
+        self.assertEqual(gdb.threads(), ["1"])
+        self.assertEqual(gdb.read_register("1", 32), 0xffff000012345678)
+        self.assertEqual(gdb.read_register("1", 30), 0x40)
+        self.assertEqual(stub.bad_checksums, 0)
+        self.assertEqual(stub.packets, ["?", "qfThreadInfo", "qsThreadInfo",
+                                        "Hg1", "p20", "Hg1", "p1e"])
+
+    def test_no_ack_mode(self):
+        stub = self.start_stub({"1": {32: 1}})
+        gdb = qemu_profiler.GdbRemote(self.client)
+        gdb.start()
+        self.assertFalse(gdb.ack)
+        self.assertEqual(gdb.read_register("1", 32), 1)
+        gdb.detach()
+        stub.join(5)
+        self.assertEqual(stub.packets, ["QStartNoAckMode", "Hg1", "p20", "D"])
+
+    def test_escaped_reply(self):
+        # "}" escapes the next byte, xored with 0x20: "}\x03" is "#"
+        payload = "a}\x03b}]c"
+        self.start_stub({}, {"qEcho": "$%s#%02x" % (payload,
+                                                    checksum(payload))})
+        gdb = qemu_profiler.GdbRemote(self.client)
+        self.assertEqual(gdb.command("qEcho"), "a#b}c")
+
+    def test_resend_after_nack(self):
+        stub = self.start_stub({"1": {32: 7}})
+        self.client.sendall("$p20#00")
+        self.assertEqual(self.client.recv(1), "-")
+        gdb = qemu_profiler.GdbRemote(self.client)
+        self.assertEqual(gdb.read_register("1", 32), 7)
+        self.assertEqual(stub.bad_checksums, 1)
+
+    def test_register_error(self):
+        self.start_stub({"1": {}})
+        gdb = qemu_profiler.GdbRemote(self.client)
+        self.assertRaises(qemu_profiler.GdbProtocolError,
+                          gdb.read_register, "1", 32)
+
+    def test_closed_connection(self):
+        gdb = qemu_profiler.GdbRemote(self.client)
+        self.server.shutdown(socket.SHUT_RDWR)
+        self.assertRaises((qemu_profiler.GdbProtocolError, socket.error),
+                          gdb.command, "?")
+
+
+class ProfilerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.elf = os.path.join(self.tmp_dir, "lk.elf")
+        write_elf64(self.elf, [("foo", 0x1000, 0x100, 0x12),
+                               ("bar", 0x2000, 0, 0x12),
+                               ("data", 0x3000, 0x10, 0x11)])
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_elf_symbols(self):
+        symbols = qemu_profiler.ElfSymbols(self.elf)
+        self.assertEqual(symbols.lookup(0x1000), "foo")
+        self.assertEqual(symbols.lookup(0x10ff), "foo")
+        self.assertEqual(symbols.lookup(0x1100), None)
+        self.assertEqual(symbols.lookup(0x2000), "bar")
+        self.assertEqual(symbols.lookup(0x2001), None)
+        self.assertEqual(symbols.lookup(0x3000), None)
+        self.assertEqual(symbols.lookup(0x10), None)
+
+    def test_folded_stacks(self):
+        client, server = socket.socketpair()
+        pc_reg, lr_reg = qemu_profiler.REGISTERS["arm64"]
+        stub = FakeStub(server, {"1": {pc_reg: 0x1010, lr_reg: 0x2000},
+                                 "2": {pc_reg: 0x5000, lr_reg: 0x1020}})
+        stub.start()
+        out_path = os.path.join(self.tmp_dir, "profile.folded")
+        profiler = qemu_profiler.GuestProfiler(
+            None, 100, qemu_profiler.Symbolizer([self.elf]), out_path,
+            pc_reg, lr_reg)
+        gdb = qemu_profiler.GdbRemote(client)
+        gdb.start()
+        threads = gdb.threads()
+        for _ in range(3):
+            profiler.sample(gdb, threads)
+        profiler.write()
+        client.close()
+        stub.join(5)
+        server.close()
+
+        self.assertEqual(profiler.samples, 3)
+        self.assertEqual(stub.interrupts, 3)
+        with open(out_path) as folded:
+            self.assertEqual(sorted(folded.read().splitlines()),
+                             ["bar;foo 3", "foo;0x5000 3"])
+
+
+if __name__ == "__main__":
+    unittest.main()
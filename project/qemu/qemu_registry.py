@@ -0,0 +1,268 @@
+#!/usr/bin/env python2.7
+"""Registry of running QEMU instances and reaping of leaked ones
+
+Every runner records the processes, files and ports it owns in a state
+directory. If a runner dies without cleaning up (e.g. it was killed, or it
+crashed after "QEMU refused quit"), its record remains and the resources it
+lists can be reclaimed precisely, without touching other users' emulators.
+"""
+
+import argparse
+import errno
+import fcntl
+import json
+import os
+import shutil
+import signal
+import tempfile
+import threading
+import time
+
+
+def default_state_dir():
+    """Returns the per-user directory holding instance records"""
+    runtime_dir = os.environ.get("XDG_RUNTIME_DIR")
+    if runtime_dir:
+        return os.path.join(runtime_dir, "trusty-qemu")
+    return os.path.join(tempfile.gettempdir(),
+                        "trusty-qemu-%d" % os.getuid())
+
+
+def proc_start_time(pid):
+    """Returns the start time of a process, or None if it does not exist
+
+    The start time is stored along with each pid so that a reused pid is
+    never mistaken for the process that was registered.
+    """
+    try:
+        with open("/proc/%d/stat" % pid) as stat_file:
+            stat = stat_file.read()
+    except IOError:
+        return None
+    # The command name may contain spaces, so count fields from its end.
+    # Field 22 (starttime) is the 20th field after the command name.
+    return int(stat[stat.rindex(")") + 2:].split()[19])
+
+
+def kill(pid, signum):
+    """Sends a signal to a process, ignoring it if it already exited"""
+    try:
+        os.kill(pid, signum)
+    except OSError as exn:
+        if exn.errno != errno.ESRCH:
+            raise
+
+
+def proc_alive(proc):
+    """Checks whether a registered {"pid", "start"} process still runs"""
+    return proc_start_time(proc["pid"]) == proc["start"]
+
+
+class Instance(object):
+    """The record of resources owned by one runner"""
+
+    def __init__(self, state_dir, record):
+        self.state_dir = state_dir
+        self.record = record
+        self.path = os.path.join(state_dir, "%s.json" % record["id"])
+        # Setup steps running in parallel update the record concurrently
+        self.lock = threading.RLock()
+
+    @classmethod
+    def create(cls, state_dir):
+        """Registers a new instance owned by the current process"""
+        pid = os.getpid()
+        start = proc_start_time(pid)
+        record = {
+            "id": "%d-%d" % (pid, start),
+            "owner": {"pid": pid, "start": start},
+            "created": time.time(),
+            "processes": {},
+            "paths": [],
+            "ports": [],
+        }
+        if not os.path.isdir(state_dir):
+            os.makedirs(state_dir)
+        instance = cls(state_dir, record)
+        instance.save()
+        return instance
+
+    def save(self):
+        """Atomically writes the record to the state directory"""
+        tmp_path = "%s.tmp" % self.path
+        with self.lock:
+            with open(tmp_path, "w") as tmp_file:
+                json.dump(self.record, tmp_file)
+            os.rename(tmp_path, self.path)
+
+    def remove(self):
+        """Drops the record once its resources have been cleaned up"""
+        try:
+            os.remove(self.path)
+        except OSError as exn:
+            if exn.errno != errno.ENOENT:
+                raise
+
+    def add_process(self, name, pid):
+        start = proc_start_time(pid)
+        with self.lock:
+            self.record["processes"][name] = {"pid": pid, "start": start}
+            self.save()
+
+    def add_path(self, path):
+        with self.lock:
+            self.record["paths"].append(path)
+            self.save()
+
+    def set_ports(self, ports):
+        with self.lock:
+            self.record["ports"] = list(ports)
+            self.save()
+
+    def set(self, key, value):
+        """Stores additional information about the instance"""
+        with self.lock:
+            self.record[key] = value
+            self.save()
+
+    def owner_alive(self):
+        return proc_alive(self.record["owner"])
+
+    def live_processes(self):
+        return [(name, proc["pid"])
+                for name, proc in sorted(self.record["processes"].items())
+                if proc_alive(proc)]
+
+    def terminate(self, grace=2.0):
+        """Terminates the registered processes, escalating to SIGKILL"""
+        live = self.live_processes()
+        for _, pid in live:
+            kill(pid, signal.SIGTERM)
+        deadline = time.time() + grace
+        while time.time() < deadline and self.live_processes():
+            time.sleep(0.1)
+        for _, pid in self.live_processes():
+            kill(pid, signal.SIGKILL)
+        return live
+
+    def release(self):
+        """Removes the registered paths and the record itself"""
+        for path in self.record["paths"]:
+            if os.path.isdir(path):
+                shutil.rmtree(path, ignore_errors=True)
+            elif os.path.lexists(path):
+                os.remove(path)
+        self.remove()
+
+
+class StateLock(object):
+    """Serializes reaping and resource assignment between runners"""
+
+    def __init__(self, state_dir):
+        if not os.path.isdir(state_dir):
+            os.makedirs(state_dir)
+        self.lock_file = open(os.path.join(state_dir, "lock"), "w")
+
+    def __enter__(self):
+        fcntl.flock(self.lock_file, fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, *exc_info):
+        fcntl.flock(self.lock_file, fcntl.LOCK_UN)
+        self.lock_file.close()
+
+
+def instances(state_dir):
+    """Returns the instances recorded in state_dir"""
+    found = []
+    if not os.path.isdir(state_dir):
+        return found
+    for name in sorted(os.listdir(state_dir)):
+        if not name.endswith(".json"):
+            continue
+        try:
+            with open(os.path.join(state_dir, name)) as record_file:
+                found.append(Instance(state_dir, json.load(record_file)))
+        except (IOError, ValueError):
+            # Removed or replaced while we were listing
+            continue
+    return found
+
+
+def reap(state_dir):
+    """Reclaims the resources of instances whose runner has died
+
+    Returns the reaped instances.
+    """
+    reaped = []
+    with StateLock(state_dir):
+        for instance in instances(state_dir):
+            if instance.owner_alive():
+                continue
+            instance.terminate()
+            instance.release()
+            reaped.append(instance)
+    return reaped
+
+
+def stop(state_dir, ids=None):
+    """Terminates the given instances, or all of them if ids is None
+
+    Instances whose runner is still alive only have their processes
+    terminated; the runner notices and cleans up after itself. Returns the
+    instances that were stopped.
+    """
+    stopped = []
+    with StateLock(state_dir):
+        for instance in instances(state_dir):
+            if ids is not None and instance.record["id"] not in ids:
+                continue
+            instance.terminate()
+            if not instance.owner_alive():
+                instance.release()
+            stopped.append(instance)
+    return stopped
+
+
+def describe(instance):
+    record = instance.record
+    processes = " ".join("%s=%d" % proc for proc in instance.live_processes())
+    return "%-20s %-6s %6ds  ports=%s  %s" % (
+        record["id"], "live" if instance.owner_alive() else "stale",
+        time.time() - record["created"],
+        ",".join(str(port) for port in record["ports"]) or "-",
+        processes or "(no live processes)")
+
+
+def main():
+    argument_parser = argparse.ArgumentParser()
+    argument_parser.add_argument("--state-dir", default=default_state_dir())
+    subparsers = argument_parser.add_subparsers(dest="command")
+    subparsers.add_parser("list", help="list registered instances")
+    subparsers.add_parser("reap", help="clean up instances of dead runners")
+    stop_parser = subparsers.add_parser("stop", help="terminate instances")
+    stop_parser.add_argument("--all", action="store_true")
+    stop_parser.add_argument("ids", nargs="*")
+    args = argument_parser.parse_args()
+
+    if args.command == "list":
+        for instance in instances(args.state_dir):
+            print describe(instance)
+    elif args.command == "reap":
+        for instance in reap(args.state_dir):
+            print "Reaped %s" % instance.record["id"]
+    else:
+        if not args.ids and not args.all:
+            argument_parser.error("stop needs instance ids or --all")
+        ids = None if args.all else args.ids
+        stopped = stop(args.state_dir, ids)
+        for instance in stopped:
+            print "Stopped %s" % instance.record["id"]
+        missing = set(args.ids) - set(i.record["id"] for i in stopped)
+        if missing:
+            argument_parser.exit(1, "Unknown instances: %s\n" %
+                                 " ".join(sorted(missing)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,167 @@
+"""Samples guest and host resource usage of a running QEMU"""
+
+import json
+import os
+import threading
+import time
+
+
+CLOCK_TICKS = os.sysconf("SC_CLK_TCK")
+PAGE_SIZE = os.sysconf("SC_PAGE_SIZE")
+
+
+def proc_stat(path):
+    """Returns the fields of a /proc stat file that follow the command name
+
+    Index 0 is field 3 (state) of proc(5), since the command name may
+    contain spaces.
+    """
+    with open(path) as stat_file:
+        stat = stat_file.read()
+    return stat[stat.rindex(")") + 2:].split()
+
+
+def cpu_seconds(fields):
+    """Returns utime + stime of a process or thread, in seconds"""
+    return float(int(fields[11]) + int(fields[12])) / CLOCK_TICKS
+
+
+def thread_cpu_seconds(pid, tid):
+    return cpu_seconds(proc_stat("/proc/%d/task/%d/stat" % (pid, tid)))
+
+
+def vcpu_threads(command_pipe):
+    """Returns the host thread id of each vCPU, by cpu index"""
+    res = command_pipe.qmp_execute("query-cpus-fast")
+    if not res or not res.has_key("return"):
+        return {}
+    return dict((cpu["cpu-index"], cpu["thread-id"]) for cpu in res["return"])
+
+
+class ResourceSampler(object):
+    """Periodically records QMP and /proc statistics of one QEMU
+
+    Samples are appended to out_path as JSON lines with short keys, to keep
+    long series small:
+      t:    host time of the sample
+      st:   guest run state from query-status
+      cpu:  CPU seconds used by the QEMU process
+      rss:  resident set size of the QEMU process in bytes
+      vcpu: CPU seconds used by each vCPU thread, by cpu index
+      blk:  [rd_bytes, wr_bytes, rd_operations, wr_operations] by drive
+    Test boundaries are interleaved as {"t", "mark", "test", "phase"}
+    lines, so the series can be cut per test.
+
+    Sampling shares the QMP command channel with the runner. The time each
+    sample takes is measured, and the interval is stretched when needed so
+    that sampling uses at most max_overhead of the wall time. A summary
+    line with the sample count and measured overhead ends the series.
+    """
+
+    def __init__(self, command_pipe, pid, interval, out_path, run=None,
+                 max_overhead=0.02):
+        self.command_pipe = command_pipe
+        self.pid = pid
+        self.interval = interval
+        self.max_overhead = max_overhead
+        self.out = open(out_path, "a")
+        self.out_lock = threading.Lock()
+        self.stopping = threading.Event()
+        self.thread = None
+        self.vcpu_threads = {}
+        self.unsupported = set()
+        self.samples = 0
+        self.sample_time = 0.0
+        self.started = None
+        self.write({"t": time.time(), "run": run, "pid": pid,
+                    "interval": interval})
+
+    def write(self, record):
+        with self.out_lock:
+            json.dump(record, self.out, separators=(",", ":"))
+            self.out.write("\n")
+            self.out.flush()
+
+    def start(self):
+        self.started = time.time()
+        self.thread = threading.Thread(target=self._sample_loop)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        """Stops sampling and writes the overhead summary"""
+        if not self.thread:
+            return
+        self.stopping.set()
+        self.thread.join()
+        self.thread = None
+        elapsed = time.time() - self.started
+        self.write({"t": time.time(), "summary": {
+            "samples": self.samples,
+            "sample_time": round(self.sample_time, 6),
+            "overhead": round(self.sample_time / elapsed, 6) if elapsed else 0,
+        }})
+        self.out.close()
+
+    def mark(self, event, test, phase):
+        """Records a test boundary in the series"""
+        if self.thread:
+            self.write({"t": time.time(), "mark": event, "test": test,
+                        "phase": phase})
+
+    def qmp_return(self, execute):
+        """Runs a query, giving up on it for good if QEMU rejects it"""
+        if execute in self.unsupported:
+            return None
+        res = self.command_pipe.qmp_execute(execute)
+        if res and res.has_key("return"):
+            return res["return"]
+        if res and res.has_key("error"):
+            self.unsupported.add(execute)
+        return None
+
+    def sample(self):
+        """Takes one sample, returning it"""
+        record = {"t": round(time.time(), 3)}
+
+        status = self.qmp_return("query-status")
+        if status is not None:
+            record["st"] = status["status"]
+
+        cpus = self.qmp_return("query-cpus-fast")
+        if cpus is not None:
+            self.vcpu_threads = dict((cpu["cpu-index"], cpu["thread-id"])
+                                     for cpu in cpus)
+
+        blockstats = self.qmp_return("query-blockstats")
+        if blockstats:
+            record["blk"] = dict(
+                (dev.get("device") or dev.get("qdev", "?"),
+                 [dev["stats"]["rd_bytes"], dev["stats"]["wr_bytes"],
+                  dev["stats"]["rd_operations"],
+                  dev["stats"]["wr_operations"]])
+                for dev in blockstats)
+
+        try:
+            fields = proc_stat("/proc/%d/stat" % self.pid)
+            record["cpu"] = cpu_seconds(fields)
+            record["rss"] = int(fields[21]) * PAGE_SIZE
+            record["vcpu"] = dict(
+                (index, thread_cpu_seconds(self.pid, tid))
+                for index, tid in self.vcpu_threads.items())
+        except (IOError, OSError):
+            # QEMU is exiting
+            pass
+        return record
+
+    def _sample_loop(self):
+        interval = self.interval
+        while not self.stopping.wait(interval):
+            start = time.time()
+            record = self.sample()
+            cost = time.time() - start
+            self.samples += 1
+            self.sample_time += cost
+            # Keep the sampler within its overhead budget
+            interval = max(self.interval, cost / self.max_overhead)
+            self.write(record)
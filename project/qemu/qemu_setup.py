@@ -0,0 +1,139 @@
+"""Runs the setup steps of a run concurrently, as their dependencies allow"""
+
+import Queue
+import sys
+import threading
+import time
+
+
+def first_error(error, other):
+    """Returns which of two exc_info tuples to raise
+
+    That is the first one, unless only the other one stops the program.
+    """
+    stops = (KeyboardInterrupt, SystemExit)
+    if not error or (issubclass(other[0], stops) and
+                     not issubclass(error[0], stops)):
+        return other
+    return error
+
+
+class SetupPipeline(object):
+    """Steps with dependencies, each started as soon as those are done
+
+    Each step runs in a thread of its own; its result is kept under its
+    name. If a step fails, no further steps are started, the ones already
+    running are waited for, and the first failure is raised again, unless
+    a KeyboardInterrupt or SystemExit came meanwhile: those take precedence,
+    so that the run still stops. The caller's cleanup then finds no step
+    half way through; it must cope with steps that never ran.
+    """
+
+    def __init__(self):
+        self.steps = []
+        self.deps = {}
+        self.funcs = {}
+        self.results = {}
+        self.times = {}
+        self.started = None
+        self.finished = None
+
+    def add(self, name, func, deps=()):
+        """Adds a step; its dependencies must have been added before"""
+        for dep in deps:
+            if dep not in self.funcs:
+                raise ValueError("%s depends on unknown step %s" % (name, dep))
+        self.steps.append(name)
+        self.deps[name] = list(deps)
+        self.funcs[name] = func
+
+    def _run_step(self, name, done):
+        start = time.time()
+        try:
+            self.results[name] = self.funcs[name]()
+            error = None
+        except BaseException:
+            error = sys.exc_info()
+        self.times[name] = (start, time.time())
+        done.put((name, error))
+
+    def run(self):
+        """Runs all steps, returning their results by name"""
+        self.started = time.time()
+        done = Queue.Queue()
+        pending = list(self.steps)
+        running = set()
+        completed = set()
+        error = None
+        try:
+            while pending or running:
+                if not error:
+                    for name in list(pending):
+                        if all(dep in completed for dep in self.deps[name]):
+                            pending.remove(name)
+                            running.add(name)
+                            thread = threading.Thread(
+                                target=self._run_step, args=(name, done))
+                            thread.daemon = True
+                            thread.start()
+                if not running:
+                    break
+                # Waiting with a timeout would poll in Python 2 and delay
+                # dependent steps, so a signal is only seen between steps
+                name, step_error = done.get()
+                running.remove(name)
+                completed.add(name)
+                if step_error:
+                    error = first_error(error, step_error)
+        except BaseException:
+            error = first_error(error, sys.exc_info())
+            # Wait for the steps still running, uninterrupted this time
+            while running:
+                name, _ = done.get()
+                running.remove(name)
+        self.finished = time.time()
+        if error:
+            raise error[0], error[1], error[2]
+        return self.results
+
+    def critical_path(self):
+        """Returns the chain of steps that determined the setup time
+
+        Starting from the step that finished last, each step is preceded by
+        the dependency that finished last.
+        """
+        path = []
+        names = [name for name in self.steps if name in self.times]
+        while names:
+            name = max(names, key=lambda step: self.times[step][1])
+            path.insert(0, name)
+            names = [dep for dep in self.deps[name] if dep in self.times]
+        return path
+
+    def report(self, out):
+        """Writes when each step ran, and the critical path"""
+        if self.started is None:
+            return
+        for name in self.steps:
+            if name not in self.times:
+                out.write("setup %-14s not run\n" % name)
+                continue
+            start, end = self.times[name]
+            out.write("setup %-14s %7.3fs - %7.3fs %7.3fs\n" % (
+                name, start - self.started, end - self.started, end - start))
+        total = sum(end - start for start, end in self.times.values())
+        path = self.critical_path()
+        out.write("setup took %.3fs, %.3fs of steps; critical path: %s\n" % (
+            self.finished - self.started, total, " -> ".join(
+                "%s (%.3fs)" % (name, self.times[name][1] -
+                                self.times[name][0]) for name in path)))
+
+    def to_dict(self):
+        return {
+            "steps": dict((name, {"start": start - self.started,
+                                  "end": end - self.started,
+                                  "deps": self.deps[name]})
+                          for name, (start, end) in self.times.items()),
+            "duration": self.finished - self.started,
+            "critical_path": self.critical_path(),
+        }
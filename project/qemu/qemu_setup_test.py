@@ -0,0 +1,81 @@
+"""Tests of the concurrent setup pipeline"""
+
+import sys
+import thread
+import threading
+import unittest
+
+import qemu_setup
+
+
+def exc_info(exception):
+    try:
+        raise exception
+    except BaseException:
+        return sys.exc_info()
+
+
+class SetupPipelineTest(unittest.TestCase):
+
+    def test_dependencies(self):
+        order = []
+        setup = qemu_setup.SetupPipeline()
+        setup.add("a", lambda: order.append("a") or 1)
+        setup.add("b", lambda: order.append("b") or 2, ["a"])
+        setup.add("c", lambda: order.append("c") or 3, ["a", "b"])
+        self.assertEqual(setup.run(), {"a": 1, "b": 2, "c": 3})
+        self.assertEqual(order, ["a", "b", "c"])
+        self.assertEqual(setup.critical_path(), ["a", "b", "c"])
+
+    def test_unknown_dependency(self):
+        setup = qemu_setup.SetupPipeline()
+        self.assertRaises(ValueError, setup.add, "a", lambda: None, ["b"])
+
+    def test_failure_stops_new_steps(self):
+        release = threading.Event()
+
+        def fail():
+            raise RuntimeError("failed")
+
+        setup = qemu_setup.SetupPipeline()
+        setup.add("slow", lambda: release.wait(5))
+        setup.add("fail", fail)
+        setup.add("after", lambda: None, ["fail"])
+        threading.Timer(0.1, release.set).start()
+        self.assertRaises(RuntimeError, setup.run)
+        self.assertIn("slow", setup.times)
+        self.assertNotIn("after", setup.times)
+
+    def test_interrupt_takes_precedence(self):
+        failed = threading.Event()
+
+        def fail():
+            try:
+                raise RuntimeError("failed")
+            finally:
+                failed.set()
+
+        def interrupt():
+            # Ctrl-C while the runner waits for this step
+            failed.wait(5)
+            thread.interrupt_main()
+
+        setup = qemu_setup.SetupPipeline()
+        setup.add("fail", fail)
+        setup.add("interrupt", interrupt)
+        self.assertRaises(KeyboardInterrupt, setup.run)
+
+    def test_first_error(self):
+        error = exc_info(RuntimeError())
+        other = exc_info(ValueError())
+        interrupt = exc_info(KeyboardInterrupt())
+        exit = exc_info(SystemExit())
+        self.assertIs(qemu_setup.first_error(None, error), error)
+        self.assertIs(qemu_setup.first_error(error, other), error)
+        self.assertIs(qemu_setup.first_error(error, interrupt), interrupt)
+        self.assertIs(qemu_setup.first_error(interrupt, error), interrupt)
+        self.assertIs(qemu_setup.first_error(exit, interrupt), exit)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,130 @@
+"""Tests of the runner's handling of its configuration and options"""
+
+import json
+import os
+import shutil
+import StringIO
+import sys
+import tempfile
+import unittest
+
+import qemu
+import qemu_test_db
+
+
+class FakeCommandPipe(object):
+    """Records QMP commands and answers them successfully"""
+
+    def __init__(self):
+        self.commands = []
+
+    def qmp_execute(self, command, args=None):
+        self.commands.append((command, args))
+        return {"return": {}}
+
+
+class RunnerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = os.path.realpath(tempfile.mkdtemp())
+        self.cwd = os.getcwd()
+        os.chdir(self.tmp_dir)
+        self.config = qemu.Config(StringIO.StringIO(json.dumps({
+            "android": "android",
+            "linux": "linux",
+            "linux_arch": "arm64",
+            "atf": "atf",
+            "rpmbd": "rpmbd",
+            "arch": "arm64",
+        })))
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.tmp_dir)
+
+    def test_relative_log_dir(self):
+        runner = qemu.Runner(self.config, log_dir="logs", core_dump=True,
+                             state_dir=os.path.join(self.tmp_dir, "state"))
+        log_dir = os.path.join(self.tmp_dir, "logs")
+        self.assertEqual(runner.log_dir, log_dir)
+
+        # QEMU writes the dump from the ATF directory
+        runner.core_dumper_up(["qemu-system-aarch64"])
+        command_pipe = FakeCommandPipe()
+        runner.core_dumper.pick_format = lambda command_pipe: "elf"
+        runner.core_dumper.start(command_pipe)
+        command, args = command_pipe.commands[-1]
+        self.assertEqual(command, "dump-guest-memory")
+        self.assertTrue(args["protocol"].startswith(
+            "file:%s/" % os.path.join(log_dir, "cores")))
+
+    def test_concurrent_tests_record_durations(self):
+        test_db = qemu_test_db.TestDurationDb(
+            os.path.join(self.tmp_dir, "durations.db"))
+        tests = ["test%d" % i for i in range(6)]
+        runner = qemu.Runner(self.config, android_tests=tests,
+                             shell_parallel=3, test_db=test_db,
+                             interactive=False,
+                             state_dir=os.path.join(self.tmp_dir, "state"))
+        runner.adb = lambda args, **kwargs: 0
+        stdout = sys.stdout
+        try:
+            sys.stdout = StringIO.StringIO()
+            results = runner.android_tests_run_concurrently(None)
+        finally:
+            sys.stdout = stdout
+        self.assertEqual(results, [0] * len(tests))
+        for test in tests:
+            self.assertEqual(len(test_db.durations(self.config.key(),
+                                                   "shell", test)), 1)
+        test_db.close()
+
+    def test_rejected_config_leaves_no_logs(self):
+        runner = qemu.Runner(self.config, log_dir="logs", shell_parallel=0,
+                             state_dir=os.path.join(self.tmp_dir, "state"))
+        self.assertRaises(qemu.ConfigError, runner.run)
+        self.assertFalse(os.path.exists("logs"))
+
+    def test_interactive_console_logs(self):
+        state_dir = os.path.join(self.tmp_dir, "state")
+        runner = qemu.Runner(self.config, interactive=True,
+                             state_dir=state_dir)
+        runner.instance_up()
+        stdout = sys.stdout
+        try:
+            # The log paths are printed for the user
+            sys.stdout = StringIO.StringIO()
+            runner.console_up()
+            self.assertIn("serial1.log", sys.stdout.getvalue())
+            console_dir = os.path.join(state_dir, "consoles",
+                                       runner.instance.record["id"])
+            self.assertTrue(os.path.isdir(console_dir))
+            # Reaping a leaked instance removes its console logs too
+            self.assertIn(console_dir, runner.instance.record["paths"])
+            runner.console_down()
+            self.assertFalse(os.path.exists(console_dir))
+        finally:
+            sys.stdout = stdout
+            runner.console_down()
+            runner.instance_down()
+
+    def test_trace_args(self):
+        runner = qemu.Runner(self.config, log_dir="logs",
+                             state_dir=os.path.join(self.tmp_dir, "state"))
+        # Without events, QEMU's trace and log backends keep their defaults
+        self.assertEqual(runner.trace_args(), [])
+
+        runner.trace_events = ["arm_smc_*"]
+        runner.log_store_up()
+        option, value = runner.trace_args()
+        self.assertEqual(option, "-trace")
+        events = os.path.join(self.tmp_dir, "logs", "trace.events")
+        self.assertEqual(value, "events=%s,file=%s" % (
+            events, os.path.join(self.tmp_dir, "logs", "trace.bin")))
+        with open(events) as events_file:
+            self.assertEqual(events_file.read(), "arm_smc_*\n")
+        runner.log_store_down()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,168 @@
+"""Historical test durations used to schedule tests under QEMU"""
+
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+
+
+def percentile(values, pct):
+    """Returns the nearest-rank percentile of a list of numbers"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = int(round(pct / 100.0 * (len(ordered) - 1)))
+    return ordered[rank]
+
+
+def hash_shard(test, count):
+    """Returns the shard of a test with no recorded duration"""
+    return int(hashlib.sha1(test).hexdigest(), 16) % count
+
+
+def day_start(now):
+    """Returns the start of the UTC day now falls in"""
+    return now - now % (24 * 60 * 60)
+
+
+def shard(tests, index, count, estimates=None):
+    """Returns the subset of tests to run in shard index of count
+
+    Tests with an estimated duration in estimates are spread over the
+    shards longest first, each to the shard with the least work so far.
+    Tests without one go to a shard picked by a hash of their name. Every
+    shard computes the same plan as long as it is given the same
+    estimates. The returned tests keep their input order.
+    """
+    estimates = estimates or {}
+    known = sorted(set(test for test in tests
+                       if estimates.get(test) is not None),
+                   key=lambda test: (-estimates[test], test))
+    loads = [0.0] * count
+    owners = {}
+    for test in known:
+        owner = loads.index(min(loads))
+        owners[test] = owner
+        loads[owner] += estimates[test]
+    return [test for test in tests
+            if owners.get(test, hash_shard(test, count)) == index]
+
+
+class TestDurationDb(object):
+    """Records how long tests take, keyed by runner configuration
+
+    Each duration is stored with the key of the configuration it was measured
+    under (see Config.key()), so e.g. arm32 and arm64 or gicv2 and gicv3
+    builds sharing a database do not pollute each other's estimates.
+
+    Concurrently run shell tests record from their worker threads, so the
+    connection is shared between threads and used under a lock.
+    """
+
+    # Number of most recent runs of a test used to estimate its duration
+    HISTORY = 20
+
+    def __init__(self, path):
+        db_dir = os.path.dirname(os.path.abspath(path))
+        if not os.path.isdir(db_dir):
+            os.makedirs(db_dir)
+        # Parallel runners share the database, so wait for their writes
+        # rather than failing on a locked database.
+        self.conn = sqlite3.connect(path, timeout=60,
+                                    check_same_thread=False)
+        self.lock = threading.Lock()
+        with self.conn:
+            self.conn.execute("""
+                CREATE TABLE IF NOT EXISTS durations (
+                    config TEXT NOT NULL,
+                    kind TEXT NOT NULL,
+                    test TEXT NOT NULL,
+                    duration REAL NOT NULL,
+                    result INTEGER,
+                    recorded REAL NOT NULL)""")
+            self.conn.execute("""
+                CREATE INDEX IF NOT EXISTS durations_test
+                ON durations (config, kind, test)""")
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+    def record(self, config_key, kind, test, duration, result):
+        """Stores one run of a test"""
+        with self.lock, self.conn:
+            self.conn.execute(
+                "INSERT INTO durations VALUES (?, ?, ?, ?, ?, ?)",
+                (config_key, kind, test, duration, result, time.time()))
+
+    def durations(self, config_key, kind, test, before=None):
+        """Returns the most recent durations recorded for a test
+
+        If before is given, only durations recorded before that time count.
+        """
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT duration FROM durations"
+                " WHERE config = ? AND kind = ? AND test = ? AND recorded < ?"
+                " ORDER BY recorded DESC LIMIT ?",
+                (config_key, kind, test,
+                 float("inf") if before is None else before, self.HISTORY))
+            return [row[0] for row in rows]
+
+    def estimate(self, config_key, kind, test, before=None):
+        """Returns the median recent duration of a test, or None if unknown"""
+        return percentile(self.durations(config_key, kind, test, before), 50)
+
+    def shard_estimates(self, config_key, kind, tests, before):
+        """Returns the estimates shard() balances, as of a fixed time
+
+        Shards running at the same time record durations as they go, so
+        they only agree on a plan made from what was recorded before a time
+        they share.
+        """
+        return dict((test, self.estimate(config_key, kind, test, before))
+                    for test in tests)
+
+    def estimates(self, config_key, kind, tests):
+        """Returns estimated durations for tests, filling in unknown ones
+
+        Tests that were never recorded are assumed to take as long as the
+        longest known test, so that they are scheduled early and their
+        duration gets recorded.
+        """
+        known = [self.estimate(config_key, kind, test) for test in tests]
+        fallback = max([est for est in known if est is not None] or [1.0])
+        return [fallback if est is None else est for est in known]
+
+    def longest_first(self, config_key, kind, tests):
+        """Returns tests ordered by decreasing estimated duration
+
+        The sort is stable, so tests with equal estimates keep their
+        relative order.
+        """
+        estimates = self.estimates(config_key, kind, tests)
+        order = sorted(range(len(tests)), key=lambda i: -estimates[i])
+        return [tests[i] for i in order]
+
+    def report(self, config_key):
+        """Returns duration percentiles for every test seen in a config
+
+        Each row is (kind, test, runs, p50, p90, p99, max), sorted by
+        decreasing median duration.
+        """
+        samples = {}
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT kind, test, duration FROM durations WHERE config = ?",
+                (config_key,)).fetchall()
+        for kind, test, duration in rows:
+            samples.setdefault((kind, test), []).append(duration)
+
+        report = []
+        for (kind, test), values in samples.iteritems():
+            report.append((kind, test, len(values), percentile(values, 50),
+                           percentile(values, 90), percentile(values, 99),
+                           max(values)))
+        report.sort(key=lambda row: -row[3])
+        return report
@@ -0,0 +1,89 @@
+"""Tests of the duration database and duration-balanced sharding"""
+
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+import qemu_test_db
+
+
+class ShardTest(unittest.TestCase):
+
+    def test_partition_by_duration(self):
+        estimates = {"a": 100.0, "b": 60.0, "c": 50.0, "d": 40.0, "e": 10.0}
+        tests = sorted(estimates)
+        shards = [qemu_test_db.shard(tests, index, 2, estimates)
+                  for index in range(2)]
+        # Longest first, to the shard with less work: a to 0, b and c to 1
+        # (110), then d to 0 (140) and e to 1 (120)
+        self.assertEqual(shards, [["a", "d"], ["b", "c", "e"]])
+        self.assertEqual(sorted(shards[0] + shards[1]), tests)
+
+    def test_unknown_tests_are_hashed(self):
+        tests = ["test%d" % i for i in range(20)]
+        shards = [qemu_test_db.shard(tests, index, 3, {"test0": 5.0})
+                  for index in range(3)]
+        self.assertEqual(sorted(sum(shards, [])), sorted(tests))
+        self.assertIn("test0", shards[0])
+        for test in tests[1:]:
+            self.assertIn(test, shards[qemu_test_db.hash_shard(test, 3)])
+
+    def test_keeps_input_order(self):
+        tests = ["z", "y", "x", "w"]
+        estimates = dict((test, 1.0) for test in tests)
+        shard = qemu_test_db.shard(tests, 0, 2, estimates)
+        self.assertEqual(shard, [test for test in tests if test in shard])
+
+
+class TestDurationDbTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.db = qemu_test_db.TestDurationDb(
+            os.path.join(self.tmp_dir, "durations.db"))
+
+    def tearDown(self):
+        self.db.close()
+        shutil.rmtree(self.tmp_dir)
+
+    def test_estimates(self):
+        for duration in [1.0, 2.0, 9.0]:
+            self.db.record("key", "shell", "a", duration, 0)
+        self.assertEqual(self.db.estimate("key", "shell", "a"), 2.0)
+        self.assertEqual(self.db.estimate("other", "shell", "a"), None)
+        self.assertEqual(self.db.longest_first("key", "shell", ["b", "a"]),
+                         ["b", "a"])
+
+    def test_shard_estimates_ignore_later_records(self):
+        self.db.record("key", "shell", "a", 10.0, 0)
+        cutoff = time.time() + 1
+        self.db.conn.execute(
+            "INSERT INTO durations VALUES (?, ?, ?, ?, ?, ?)",
+            ("key", "shell", "b", 20.0, 0, cutoff + 1))
+        estimates = self.db.shard_estimates("key", "shell", ["a", "b"],
+                                            cutoff)
+        self.assertEqual(estimates, {"a": 10.0, "b": None})
+        self.assertEqual(self.db.estimate("key", "shell", "b"), 20.0)
+
+    def test_record_from_threads(self):
+        threads = [threading.Thread(
+            target=self.db.record,
+            args=("key", "shell", "test%d" % i, float(i), 0))
+                   for i in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual([self.db.estimate("key", "shell", "test%d" % i)
+                          for i in range(8)], [float(i) for i in range(8)])
+
+    def test_day_start(self):
+        self.assertEqual(qemu_test_db.day_start(86400 * 3 + 5000.5),
+                         86400 * 3)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,403 @@
+#!/usr/bin/env python2.7
+"""Decodes QEMU simpletrace files into call latencies
+
+QEMU built with the simple trace backend writes enabled trace events into a
+binary file (format version 4): a header, then records each prefixed by a
+type. Mapping records name the event ids; event records hold an event id,
+a host timestamp in ns, the record length, QEMU's pid and the arguments,
+each a u64 or, for strings, a u32 length and the bytes.
+
+Events are paired into calls: an entry event starts a call, and the matching
+exit event ends the innermost call still open. The latency of each call is
+added to a log2 histogram per call type, and the slowest calls are kept as
+outliers. Records are read one at a time, so traces of any size can be
+decoded, also ones recorded earlier, e.g.:
+
+  qemu_trace.py trace.bin --pair arm_smc_enter=arm_smc_exit --key-arg 0
+"""
+
+import argparse
+import heapq
+import json
+import re
+import struct
+import sys
+
+HEADER_EVENT_ID = 0xffffffffffffffff
+HEADER_MAGIC = 0xf2b177cb0aa429b4
+HEADER_VERSION = 4
+DROPPED_EVENT_ID = 0xfffffffffffffffe
+
+RECORD_TYPE_MAPPING = 0
+RECORD_TYPE_EVENT = 1
+
+# Size of an event record before its arguments
+RECORD_HEADER_SIZE = 24
+
+# Suffixes pairing events by name when no explicit pair is given
+ENTRY_SUFFIXES = ["_enter", "_entry", "_begin", "_start"]
+EXIT_SUFFIXES = ["_exit", "_return", "_end", "_done"]
+
+_EVENT_RE = re.compile(r"^\s*(?:(?:disable|tcg|vcpu)\s+)*(\w+)\((.*?)\)")
+
+
+class TraceError(Exception):
+    pass
+
+
+def read_event_formats(path):
+    """Returns the argument types of each event in a trace-events file
+
+    Only whether an argument is a string matters for decoding, so each
+    event maps to a list of booleans.
+    """
+    formats = {}
+    with open(path) as events:
+        for line in events:
+            if line.lstrip().startswith("#"):
+                continue
+            match = _EVENT_RE.match(line)
+            if not match:
+                continue
+            args = match.group(2).strip()
+            if args in ("", "void"):
+                formats[match.group(1)] = []
+                continue
+            formats[match.group(1)] = [
+                "char*" in arg.replace(" ", "") for arg in args.split(",")]
+    return formats
+
+
+class TraceReader(object):
+    """Yields (name, timestamp_ns, pid, args) for each event of a trace
+
+    Without the event's formats, all arguments are decoded as u64. A record
+    cut short, as when QEMU was killed while writing, ends the trace;
+    truncated is set then.
+    """
+
+    def __init__(self, trace_file, formats=None):
+        self.trace_file = trace_file
+        self.formats = formats or {}
+        self.names = {}
+        self.truncated = False
+
+    def _read(self, size):
+        data = self.trace_file.read(size)
+        if len(data) != size:
+            if data:
+                self.truncated = True
+            return None
+        return data
+
+    def _read_header(self):
+        header = self._read(24)
+        if header is None:
+            raise TraceError("trace is too short for a header")
+        event_id, magic, version = struct.unpack("=QQQ", header)
+        if event_id != HEADER_EVENT_ID or magic != HEADER_MAGIC:
+            raise TraceError("not a simpletrace file")
+        if version != HEADER_VERSION:
+            raise TraceError("unsupported simpletrace version %d" % version)
+
+    def _decode_args(self, name, data):
+        is_string = self.formats.get(name)
+        if is_string is None:
+            count = len(data) // 8
+            return list(struct.unpack("=%dQ" % count, data[:count * 8]))
+        args = []
+        offset = 0
+        for string in is_string:
+            if string:
+                length, = struct.unpack_from("=I", data, offset)
+                offset += 4
+                args.append(data[offset:offset + length])
+                offset += length
+            else:
+                args.append(struct.unpack_from("=Q", data, offset)[0])
+                offset += 8
+        return args
+
+    def __iter__(self):
+        self._read_header()
+        while True:
+            data = self._read(8)
+            if data is None:
+                return
+            record_type, = struct.unpack("=Q", data)
+            if record_type == RECORD_TYPE_MAPPING:
+                data = self._read(12)
+                if data is None:
+                    return
+                event_id, length = struct.unpack("=QI", data)
+                name = self._read(length)
+                if name is None:
+                    return
+                self.names[event_id] = name
+                continue
+            if record_type != RECORD_TYPE_EVENT:
+                raise TraceError("unknown record type %d" % record_type)
+            data = self._read(RECORD_HEADER_SIZE)
+            if data is None:
+                return
+            event_id, timestamp, length, pid = struct.unpack("=QQII", data)
+            if length < RECORD_HEADER_SIZE:
+                raise TraceError("bad record length %d" % length)
+            data = self._read(length - RECORD_HEADER_SIZE)
+            if data is None:
+                return
+            if event_id == DROPPED_EVENT_ID:
+                name = "dropped"
+                args = self._decode_args(None, data)
+            else:
+                name = self.names.get(event_id, "event%d" % event_id)
+                try:
+                    args = self._decode_args(name, data)
+                except struct.error:
+                    raise TraceError("record of %s does not match its "
+                                     "format" % name)
+            yield name, timestamp, pid, args
+
+
+class LatencyHistogram(object):
+    """Call latencies in power of two buckets of microseconds"""
+
+    def __init__(self):
+        self.buckets = {}
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = None
+
+    def add(self, latency_ns):
+        bucket = (latency_ns // 1000).bit_length()
+        self.buckets[bucket] = self.buckets.get(bucket, 0) + 1
+        self.count += 1
+        self.total += latency_ns
+        self.min = latency_ns if self.min is None else min(self.min,
+                                                            latency_ns)
+        self.max = latency_ns if self.max is None else max(self.max,
+                                                            latency_ns)
+
+    @staticmethod
+    def bucket_limit(bucket):
+        """Returns the upper bound of a bucket, in microseconds"""
+        return (1 << bucket) if bucket else 1
+
+    def percentile(self, fraction):
+        """Returns the upper bound in microseconds of a latency percentile"""
+        rank = fraction * self.count
+        seen = 0
+        for bucket in sorted(self.buckets):
+            seen += self.buckets[bucket]
+            if seen >= rank:
+                return self.bucket_limit(bucket)
+        return None
+
+    def to_dict(self):
+        return {
+            "count": self.count,
+            "total_ns": self.total,
+            "min_ns": self.min,
+            "max_ns": self.max,
+            "buckets_us": dict((self.bucket_limit(bucket), count)
+                               for bucket, count in self.buckets.items()),
+        }
+
+
+class LatencyAnalyzer(object):
+    """Pairs entry and exit events into per-call-type latencies
+
+    pairs maps entry event names to exit event names; other events pair by
+    their suffixes (see ENTRY_SUFFIXES), and events that do not pair are
+    only counted. With key_arg, calls are also told apart by that argument
+    of their entry event, e.g. an SMC function id. With cpu_arg, calls are
+    only paired with events carrying the same value in that argument, so
+    that calls on different vCPUs do not get mixed up.
+    """
+
+    def __init__(self, pairs=None, key_arg=None, cpu_arg=None, top=10):
+        self.entries = dict(pairs or {})
+        self.exits = dict((exit, entry)
+                          for entry, exit in self.entries.items())
+        self.key_arg = key_arg
+        self.cpu_arg = cpu_arg
+        self.top = top
+        self.roles = {}
+        self.open_calls = {}
+        self.histograms = {}
+        self.outliers = []
+        self.events = {}
+        self.unmatched = 0
+        self.dropped = 0
+        self.first = None
+        self.last = None
+
+    @staticmethod
+    def call_name(entry):
+        """Names calls of an explicit pair after their entry event"""
+        for suffix in ENTRY_SUFFIXES:
+            if entry.endswith(suffix):
+                return entry[:-len(suffix)]
+        return entry
+
+    def role(self, name):
+        """Returns ("entry" or "exit", call name), or None"""
+        if name not in self.roles:
+            role = None
+            if name in self.entries:
+                role = ("entry", self.call_name(name))
+            elif name in self.exits:
+                role = ("exit", self.call_name(self.exits[name]))
+            else:
+                for suffix in ENTRY_SUFFIXES:
+                    if name.endswith(suffix):
+                        role = ("entry", name[:-len(suffix)])
+                for suffix in EXIT_SUFFIXES:
+                    if name.endswith(suffix):
+                        role = ("exit", name[:-len(suffix)])
+            self.roles[name] = role
+        return self.roles[name]
+
+    def _arg(self, args, index):
+        if index is None or index >= len(args):
+            return None
+        return args[index]
+
+    def add(self, name, timestamp, args):
+        if self.first is None:
+            self.first = timestamp
+        self.last = timestamp
+        self.events[name] = self.events.get(name, 0) + 1
+        if name == "dropped":
+            # Lost events leave the open calls without their exits
+            self.dropped += args[0] if args else 0
+            self.unmatched += sum(len(calls)
+                                  for calls in self.open_calls.values())
+            self.open_calls = {}
+            return
+        role = self.role(name)
+        if not role:
+            return
+        kind, call = role
+        stream = (call, self._arg(args, self.cpu_arg))
+        if kind == "entry":
+            key = self._arg(args, self.key_arg)
+            call_type = call if key is None else "%s:%s" % (
+                call, "0x%x" % key if isinstance(key, (int, long)) else key)
+            self.open_calls.setdefault(stream, []).append(
+                (timestamp, call_type))
+            return
+        calls = self.open_calls.get(stream)
+        if not calls:
+            self.unmatched += 1
+            return
+        start, call_type = calls.pop()
+        latency = timestamp - start
+        if call_type not in self.histograms:
+            self.histograms[call_type] = LatencyHistogram()
+        self.histograms[call_type].add(latency)
+        outlier = (latency, start, call_type)
+        if len(self.outliers) < self.top:
+            heapq.heappush(self.outliers, outlier)
+        elif outlier > self.outliers[0]:
+            heapq.heapreplace(self.outliers, outlier)
+
+    def feed(self, reader):
+        for name, timestamp, _, args in reader:
+            self.add(name, timestamp, args)
+        return self
+
+    def report(self, out):
+        by_total = sorted(self.histograms.items(),
+                          key=lambda item: -item[1].total)
+        out.write("%-32s %9s %10s %9s %9s %9s %10s\n" % (
+            "call", "count", "total ms", "mean us", "p50 us", "p99 us",
+            "max us"))
+        for call_type, histogram in by_total:
+            out.write("%-32s %9d %10.3f %9.2f %9s %9s %10.2f\n" % (
+                call_type, histogram.count, histogram.total / 1e6,
+                histogram.total / 1e3 / histogram.count,
+                "<=%d" % histogram.percentile(0.5),
+                "<=%d" % histogram.percentile(0.99), histogram.max / 1e3))
+        if self.outliers:
+            out.write("slowest calls:\n")
+            for latency, start, call_type in sorted(self.outliers,
+                                                    reverse=True):
+                out.write("  %10.2f us  %-32s at %.6fs\n" % (
+                    latency / 1e3, call_type, (start - self.first) / 1e9))
+        if self.unmatched or self.dropped:
+            out.write("%d unmatched exits or entries, %d events dropped "
+                      "by QEMU\n" % (self.unmatched + sum(
+                          len(calls) for calls in self.open_calls.values()),
+                                     self.dropped))
+
+    def to_dict(self):
+        return {
+            "calls": dict((call_type, histogram.to_dict())
+                          for call_type, histogram
+                          in self.histograms.items()),
+            "outliers": [{"latency_ns": latency,
+                          "start_ns": start - self.first,
+                          "call": call_type}
+                         for latency, start, call_type
+                         in sorted(self.outliers, reverse=True)],
+            "events": self.events,
+            "unmatched": self.unmatched + sum(
+                len(calls) for calls in self.open_calls.values()),
+            "dropped": self.dropped,
+            "duration_ns": (self.last - self.first
+                            if self.first is not None else 0),
+        }
+
+
+def parse_pair(value):
+    """Parses an event pair of the form ENTRY=EXIT"""
+    entry, sep, exit = value.partition("=")
+    if not sep or not entry or not exit:
+        raise argparse.ArgumentTypeError(
+            "expected ENTRY=EXIT, got %r" % value)
+    return entry, exit
+
+
+def analyze(trace_path, pairs=None, key_arg=None, cpu_arg=None, top=10,
+            formats_path=None):
+    """Decodes a trace file and returns its LatencyAnalyzer"""
+    formats = read_event_formats(formats_path) if formats_path else None
+    analyzer = LatencyAnalyzer(pairs, key_arg, cpu_arg, top)
+    with open(trace_path, "rb") as trace_file:
+        reader = TraceReader(trace_file, formats)
+        analyzer.feed(reader)
+    if reader.truncated:
+        sys.stderr.write("%s ends in a partial record\n" % trace_path)
+    return analyzer
+
+
+def main():
+    argument_parser = argparse.ArgumentParser(
+        description="Report call latencies in a QEMU simpletrace file")
+    argument_parser.add_argument("trace")
+    argument_parser.add_argument("--events-file",
+                                 help="QEMU's trace-events-all, to decode "
+                                      "string arguments")
+    argument_parser.add_argument("--pair", action="append", type=parse_pair,
+                                 metavar="ENTRY=EXIT",
+                                 help="pair these events into calls")
+    argument_parser.add_argument("--key-arg", type=int,
+                                 help="tell calls apart by this argument")
+    argument_parser.add_argument("--cpu-arg", type=int,
+                                 help="argument holding the vCPU index")
+    argument_parser.add_argument("--top", type=int, default=10)
+    argument_parser.add_argument("--json", help="also write the results here")
+    args = argument_parser.parse_args()
+
+    analyzer = analyze(args.trace, args.pair, args.key_arg, args.cpu_arg,
+                       args.top, args.events_file)
+    analyzer.report(sys.stdout)
+    if args.json:
+        with open(args.json, "w") as out:
+            json.dump(analyzer.to_dict(), out, indent=2, sort_keys=True)
+
+
+if __name__ == "__main__":
+    main()
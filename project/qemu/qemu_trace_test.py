@@ -0,0 +1,102 @@
+"""Tests of simpletrace decoding against a recorded fixture
+
+testdata/smc.simpletrace holds a version 4 header, mappings of the events
+in testdata/trace-events, SMC calls on vCPUs 0 and 1, a string event and a
+record of 3 dropped events, which leaves an entry and an exit unmatched.
+"""
+
+import os
+import StringIO
+import struct
+import unittest
+
+import qemu_trace
+
+TESTDATA = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                        "testdata")
+TRACE = os.path.join(TESTDATA, "smc.simpletrace")
+EVENTS = os.path.join(TESTDATA, "trace-events")
+
+
+class TraceReaderTest(unittest.TestCase):
+
+    def read(self, formats=None):
+        with open(TRACE, "rb") as trace_file:
+            reader = qemu_trace.TraceReader(trace_file, formats)
+            return list(reader), reader
+
+    def test_event_formats(self):
+        self.assertEqual(qemu_trace.read_event_formats(EVENTS), {
+            "arm_smc_enter": [False, False],
+            "arm_smc_exit": [False, False],
+            "guest_log": [True],
+        })
+
+    def test_records(self):
+        records, reader = self.read(qemu_trace.read_event_formats(EVENTS))
+        self.assertFalse(reader.truncated)
+        self.assertEqual(records[0], ("arm_smc_enter", 1000, 4242,
+                                      [0, 0x32000004]))
+        self.assertEqual(records[4], ("guest_log", 10000, 4242, ["hello"]))
+        self.assertEqual(records[6], ("dropped", 12000, 4242, [3]))
+        self.assertEqual([name for name, _, _, _ in records], [
+            "arm_smc_enter", "arm_smc_enter", "arm_smc_exit", "arm_smc_exit",
+            "guest_log", "arm_smc_enter", "dropped", "arm_smc_exit",
+            "arm_smc_enter", "arm_smc_exit"])
+
+    def test_truncated(self):
+        with open(TRACE, "rb") as trace_file:
+            data = trace_file.read()
+        reader = qemu_trace.TraceReader(StringIO.StringIO(data[:-4]))
+        self.assertEqual(len(list(reader)), 9)
+        self.assertTrue(reader.truncated)
+
+    def test_not_a_trace(self):
+        reader = qemu_trace.TraceReader(StringIO.StringIO(
+            struct.pack("=QQQ", qemu_trace.HEADER_EVENT_ID, 0, 4)))
+        self.assertRaises(qemu_trace.TraceError, list, reader)
+
+
+class LatencyAnalyzerTest(unittest.TestCase):
+
+    def test_latencies(self):
+        analyzer = qemu_trace.analyze(TRACE, key_arg=1, cpu_arg=0,
+                                      formats_path=EVENTS)
+        result = analyzer.to_dict()
+        fast = result["calls"]["arm_smc:0x32000004"]
+        self.assertEqual((fast["count"], fast["min_ns"], fast["max_ns"],
+                          fast["total_ns"]), (2, 2000, 5000, 7000))
+        self.assertEqual(fast["buckets_us"], {4: 1, 8: 1})
+        slow = result["calls"]["arm_smc:0x84000000"]
+        self.assertEqual((slow["count"], slow["total_ns"]), (1, 8000))
+        self.assertEqual([(outlier["latency_ns"], outlier["start_ns"])
+                          for outlier in result["outliers"]],
+                         [(8000, 500), (5000, 19000), (2000, 0)])
+        # The entry open at the dropped record, and the exit after it
+        self.assertEqual(result["unmatched"], 2)
+        self.assertEqual(result["dropped"], 3)
+        self.assertEqual(result["duration_ns"], 24000)
+
+    def test_explicit_pair_without_cpu(self):
+        # Without cpu_arg, the exit at 3000 ends the innermost open call,
+        # the one entered at 1500 on vCPU 1
+        analyzer = qemu_trace.analyze(
+            TRACE, pairs=[("arm_smc_enter", "arm_smc_exit")],
+            formats_path=EVENTS)
+        calls = analyzer.to_dict()["calls"]
+        self.assertEqual(calls.keys(), ["arm_smc"])
+        self.assertEqual((calls["arm_smc"]["min_ns"],
+                          calls["arm_smc"]["max_ns"]), (1500, 8500))
+
+    def test_report(self):
+        out = StringIO.StringIO()
+        qemu_trace.analyze(TRACE, key_arg=1, cpu_arg=0,
+                           formats_path=EVENTS).report(out)
+        lines = out.getvalue().splitlines()
+        self.assertTrue(lines[1].startswith("arm_smc:0x84000000"))
+        self.assertEqual(lines[-1], "2 unmatched exits or entries, 3 events "
+                                    "dropped by QEMU")
+
+
+if __name__ == "__main__":
+    unittest.main()
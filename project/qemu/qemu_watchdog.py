@@ -0,0 +1,114 @@
+"""Detects tests that stop making progress"""
+
+import sys
+import threading
+import time
+
+
+class ProgressWatchdog(object):
+    """Fires when a step stalls or runs past its hard timeout
+
+    Progress is observed through probes, callables returning a growing
+    counter such as bytes received on a channel or CPU seconds used, and
+    through explicit poke() calls. A probe counts as progress when it grows
+    by more than min_rate per second since the last poll, which lets noisy
+    counters (e.g. an idle guest's CPU time) be ignored.
+
+    on_expire(reason, timeout) is called at most once, from the watchdog
+    thread: with "stalled" after quiet_period seconds without progress, or
+    with "timed out" after hard_timeout seconds regardless of progress.
+    A quiet_period of None disables stall detection. An exception raised
+    by on_expire, e.g. a Timeout, is kept and raised again by check() in
+    the caller's thread.
+    """
+
+    def __init__(self, hard_timeout, on_expire, quiet_period=None,
+                 poll_interval=1.0, clock=time.time):
+        self.hard_timeout = hard_timeout
+        self.quiet_period = quiet_period
+        self.on_expire = on_expire
+        self.poll_interval = poll_interval
+        self.clock = clock
+        self.probes = []
+        self.lock = threading.Lock()
+        self.stopping = threading.Event()
+        self.thread = None
+        self.started = None
+        self.last_progress = None
+        self.last_poll = None
+        self.expired = None
+        self.error = None
+
+    def add_probe(self, name, probe, min_rate=0.0):
+        self.probes.append([name, probe, min_rate, None])
+
+    def poke(self):
+        """Records progress signalled by the caller"""
+        with self.lock:
+            self.last_progress = self.clock()
+
+    def start(self):
+        self.started = self.clock()
+        self.last_progress = self.started
+        self.last_poll = self.started
+        self.thread = threading.Thread(target=self._watch)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def cancel(self):
+        """Stops watching; waits for an expiry callback in progress"""
+        if not self.thread:
+            return
+        self.stopping.set()
+        if self.thread is not threading.current_thread():
+            self.thread.join()
+        self.thread = None
+
+    def check(self):
+        """Raises again the exception on_expire raised, if any"""
+        if self.error:
+            error, self.error = self.error, None
+            raise error[0], error[1], error[2]
+
+    def _poll_probes(self, elapsed):
+        progressed = False
+        for probe in self.probes:
+            name, read, min_rate, last = probe
+            try:
+                value = read()
+            except (IOError, OSError):
+                # The source went away, e.g. QEMU exited
+                continue
+            if last is not None and value - last > min_rate * elapsed:
+                progressed = True
+            probe[3] = value
+        return progressed
+
+    def _expire(self, reason, limit):
+        self.expired = reason
+        try:
+            self.on_expire(reason, limit)
+        except BaseException:
+            self.error = sys.exc_info()
+
+    def poll(self):
+        """Checks for progress; returns whether the watchdog expired"""
+        now = self.clock()
+        if self._poll_probes(now - self.last_poll):
+            self.poke()
+        self.last_poll = now
+
+        with self.lock:
+            quiet = now - self.last_progress
+        if now - self.started >= self.hard_timeout:
+            self._expire("timed out", self.hard_timeout)
+            return True
+        if self.quiet_period is not None and quiet >= self.quiet_period:
+            self._expire("stalled", self.quiet_period)
+            return True
+        return False
+
+    def _watch(self):
+        while not self.stopping.wait(self.poll_interval):
+            if self.poll():
+                return
@@ -0,0 +1,133 @@
+"""Tests of stall and timeout detection, driven by a fake clock"""
+
+import unittest
+
+import qemu_watchdog
+from qemu_error import Timeout
+
+
+class FakeClock(object):
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class ProgressWatchdogTest(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = FakeClock()
+        self.expiries = []
+        self.counter = 0
+
+    def watchdog(self, hard_timeout=100, quiet_period=10, on_expire=None):
+        watchdog = qemu_watchdog.ProgressWatchdog(
+            hard_timeout, on_expire or self.on_expire,
+            quiet_period=quiet_period, clock=self.clock)
+        # Polled by hand rather than from the watchdog thread
+        watchdog.started = self.clock()
+        watchdog.last_progress = watchdog.started
+        watchdog.last_poll = watchdog.started
+        return watchdog
+
+    def on_expire(self, reason, limit):
+        self.expiries.append((reason, limit))
+
+    def advance(self, watchdog, seconds, step=1):
+        """Polls every step seconds; returns whether the watchdog expired"""
+        for _ in range(int(seconds / step)):
+            self.clock.now += step
+            if watchdog.poll():
+                return True
+        return False
+
+    def test_stall(self):
+        watchdog = self.watchdog()
+        self.assertFalse(self.advance(watchdog, 9))
+        self.assertTrue(self.advance(watchdog, 1))
+        self.assertEqual(watchdog.expired, "stalled")
+        self.assertEqual(self.expiries, [("stalled", 10)])
+
+    def test_poke_resets_stall(self):
+        watchdog = self.watchdog()
+        self.assertFalse(self.advance(watchdog, 9))
+        watchdog.poke()
+        self.assertFalse(self.advance(watchdog, 9))
+        self.assertTrue(self.advance(watchdog, 1))
+        self.assertEqual(self.expiries, [("stalled", 10)])
+
+    def test_probe_resets_stall(self):
+        watchdog = self.watchdog()
+        watchdog.add_probe("counter", lambda: self.counter)
+        self.assertFalse(self.advance(watchdog, 9))
+        # Seen as progress by the next poll
+        self.counter += 1
+        self.assertFalse(self.advance(watchdog, 10))
+        self.assertTrue(self.advance(watchdog, 1))
+
+    def test_probe_below_min_rate(self):
+        watchdog = self.watchdog()
+        watchdog.add_probe("cpu", lambda: self.counter, min_rate=0.25)
+
+        def tick():
+            # 0.2 per second is idle noise
+            self.counter += 0.2
+            return watchdog.poll()
+
+        for _ in range(9):
+            self.clock.now += 1
+            self.assertFalse(tick())
+        self.clock.now += 1
+        self.assertTrue(tick())
+        self.assertEqual(watchdog.expired, "stalled")
+
+    def test_probe_errors_are_no_progress(self):
+        def gone():
+            raise OSError("QEMU exited")
+
+        watchdog = self.watchdog()
+        watchdog.add_probe("gone", gone)
+        self.assertTrue(self.advance(watchdog, 10))
+        self.assertEqual(watchdog.expired, "stalled")
+
+    def test_hard_timeout_despite_progress(self):
+        watchdog = self.watchdog(hard_timeout=30)
+        for _ in range(29):
+            watchdog.poke()
+            self.assertFalse(self.advance(watchdog, 1))
+        watchdog.poke()
+        self.assertTrue(self.advance(watchdog, 1))
+        self.assertEqual(self.expiries, [("timed out", 30)])
+
+    def test_no_stall_detection(self):
+        watchdog = self.watchdog(hard_timeout=30, quiet_period=None)
+        self.assertFalse(self.advance(watchdog, 29))
+        self.assertTrue(self.advance(watchdog, 1))
+        self.assertEqual(watchdog.expired, "timed out")
+
+    def test_callback_error_is_raised_by_check(self):
+        def kill(reason, limit):
+            raise Timeout("Wait for boottest progress", limit)
+
+        watchdog = self.watchdog(on_expire=kill)
+        self.assertTrue(self.advance(watchdog, 10))
+        self.assertRaises(Timeout, watchdog.check)
+        # Raised once only
+        watchdog.check()
+
+    def test_callback_error_in_thread(self):
+        def kill(reason, limit):
+            raise Timeout("Wait for boottest to complete", limit)
+
+        watchdog = qemu_watchdog.ProgressWatchdog(0, kill, poll_interval=0.01)
+        watchdog.start()
+        watchdog.thread.join(5)
+        watchdog.cancel()
+        self.assertEqual(watchdog.expired, "timed out")
+        self.assertRaises(Timeout, watchdog.check)
+
+
+if __name__ == "__main__":
+    unittest.main()